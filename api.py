@@ -0,0 +1,353 @@
+"""Versioned JSON API for Warbler.
+
+The same operations as the HTML views, for clients that don't want to
+scrape pages: batch follows and likes, batch user lookups and
+cursor-paginated timelines. Requests are authenticated by the site's
+session cookie (log in through /login), and writes must be sent as
+application/json, which a cross-site form can't do.
+
+Batch writes take up to API_BATCH_LIMIT ids and run as a fixed handful of
+set-based statements in one transaction, however many ids there are.
+
+    GET    /api/v1/users?ids=1,2,3          users, with follow state
+    POST   /api/v1/follows   {"user_ids": [...]}
+    DELETE /api/v1/follows   {"user_ids": [...]}
+    POST   /api/v1/likes     {"message_ids": [...]}
+    DELETE /api/v1/likes     {"message_ids": [...]}
+    GET    /api/v1/timeline                 the home timeline
+    GET    /api/v1/users/<id>/messages
+    GET    /api/v1/users/<id>/likes
+
+Timelines take the same ?before= / ?after= cursors as the pages, and
+?limit=.
+"""
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+from sqlalchemy import and_, exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import HTTPException
+
+import counters
+from likebuffer import like_buffer
+from models import db, User, Message, Follows, Likes
+from pagination import paginate_messages, per_page
+from recommendations import recommendations
+from timelines import timelines
+from trending import trending
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+@api.record_once
+def configure(state):
+    state.app.config.setdefault('API_BATCH_LIMIT', 100)
+
+
+@api.errorhandler(HTTPException)
+def json_error(e):
+    return jsonify(error=e.description), e.code
+
+
+@api.before_request
+def require_json():
+    if request.method != 'GET' and not request.is_json:
+        abort(415, "Send a JSON body.")
+
+
+def require_login():
+    if not g.user:
+        abort(401, "Log in first.")
+
+
+##############################################################################
+# Request parsing
+
+def batch(ids):
+    """Check a batch of ids; returns them deduplicated, in order."""
+
+    limit = current_app.config['API_BATCH_LIMIT']
+
+    if (not isinstance(ids, list)
+            or not all(type(id_) is int for id_ in ids)):
+        abort(400, "Expected a list of ids.")
+
+    if len(ids) > limit:
+        abort(400, f"At most {limit} ids at once.")
+
+    return list(dict.fromkeys(ids))
+
+
+def body_ids(name):
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict):
+        abort(400, "Expected a JSON object.")
+
+    return batch(body.get(name))
+
+
+def query_ids(name):
+    try:
+        return batch([int(id_) for id_
+                      in request.args.get(name, '').split(',') if id_])
+    except ValueError:
+        abort(400, "Expected comma-separated ids.")
+
+
+def page_limit():
+    """?limit=, clamped to the page size the HTML views use."""
+
+    limit = request.args.get('limit', per_page(), type=int)
+    return min(max(limit, 1), per_page())
+
+
+##############################################################################
+# Payloads
+
+def user_card(user, following=(), followed_by=()):
+    card = {column: getattr(user, column) for column in User.CARD_COLUMNS}
+
+    if g.user:
+        card['following'] = user.id in following
+        card['follows_you'] = user.id in followed_by
+
+    return card
+
+
+def message_page(page):
+    """A timeline page, with each author listed once."""
+
+    message_ids = [msg.id for msg in page.items]
+    liked = like_buffer.liked_ids(g.user.id, message_ids) if g.user else set()
+    authors = {}
+
+    for msg in page.items:
+        authors.setdefault(msg.user_id, dict(
+            id=msg.user_id,
+            username=msg.user.username,
+            image_url=msg.user.image_url,
+        ))
+
+    return jsonify(
+        messages=[dict(id=msg.id,
+                       text=msg.text,
+                       timestamp=msg.timestamp.isoformat(),
+                       user_id=msg.user_id,
+                       liked=msg.id in liked)
+                  for msg in page.items],
+        users=list(authors.values()),
+        older=page.older,
+        newer=page.newer,
+    )
+
+
+##############################################################################
+# Set-based writes; the caller commits
+
+def follow(user_id, ids):
+    """Follow the users in `ids`; returns the ids newly followed."""
+
+    new_ids = [id_ for (id_,) in (
+        db.session
+        .query(User.id)
+        .filter(User.id.in_(ids), User.id != user_id)
+        .filter(~exists().where(and_(
+            Follows.user_being_followed_id == User.id,
+            Follows.user_following_id == user_id))))]
+
+    if not new_ids:
+        return []
+
+    db.session.execute(Follows.__table__.insert().values([
+        dict(user_being_followed_id=id_, user_following_id=user_id)
+        for id_ in new_ids
+    ]))
+    counters.adjust(user_id, following_count=len(new_ids))
+    counters.adjust(new_ids, followers_count=1)
+
+    if timelines.enabled:
+        for id_ in new_ids:
+            timelines.store.merge_author(user_id, id_)
+
+    return new_ids
+
+
+def unfollow(user_id, ids):
+    """Stop following the users in `ids`; returns the ids unfollowed."""
+
+    gone_ids = [id_ for (id_,) in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id,
+                Follows.user_being_followed_id.in_(ids)))]
+
+    if not gone_ids:
+        return []
+
+    (Follows
+     .query
+     .filter(Follows.user_following_id == user_id,
+             Follows.user_being_followed_id.in_(gone_ids))
+     .delete(synchronize_session=False))
+    counters.adjust(user_id, following_count=-len(gone_ids))
+    counters.adjust(gone_ids, followers_count=-1)
+
+    if timelines.enabled:
+        for id_ in gone_ids:
+            timelines.store.remove_author(user_id, id_)
+
+    return gone_ids
+
+
+def like(user_id, ids):
+    """Like the messages in `ids`, except the user's own; returns the ids
+    newly liked."""
+
+    # the user's buffered toggles go first, so this batch has the last say
+    like_buffer.flush(user_id)
+
+    new_ids = [id_ for (id_,) in (
+        db.session
+        .query(Message.id)
+        .filter(Message.id.in_(ids), Message.user_id != user_id)
+        .filter(~exists().where(and_(Likes.message_id == Message.id,
+                                     Likes.user_id == user_id))))]
+
+    if not new_ids:
+        return []
+
+    db.session.execute(Likes.__table__.insert().values([
+        dict(user_id=user_id, message_id=id_) for id_ in new_ids
+    ]))
+    counters.adjust(user_id, likes_count=len(new_ids))
+
+    return new_ids
+
+
+def unlike(user_id, ids):
+    """Unlike the messages in `ids`; returns the ids unliked."""
+
+    like_buffer.flush(user_id)
+
+    gone_ids = [id_ for (id_,) in (
+        db.session
+        .query(Likes.message_id)
+        .filter(Likes.user_id == user_id, Likes.message_id.in_(ids)))]
+
+    if not gone_ids:
+        return []
+
+    (Likes
+     .query
+     .filter(Likes.user_id == user_id, Likes.message_id.in_(gone_ids))
+     .delete(synchronize_session=False))
+    counters.adjust(user_id, likes_count=-len(gone_ids))
+
+    return gone_ids
+
+
+def commit_batch(write, name, committed=None):
+    """Run a batch write on the body's `name` ids as the current user and
+    commit it; then `committed(user_id, changed ids)`, if given.
+
+    A concurrent request writing the same rows fails the commit; that's
+    a 409, and the client may retry.
+    """
+
+    require_login()
+    user_id = g.user.id
+    ids = body_ids(name)
+
+    try:
+        changed = write(user_id, ids)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(409, "Changed by another request; try again.")
+
+    if committed:
+        committed(user_id, changed)
+
+    return changed
+
+
+##############################################################################
+# Routes
+
+@api.route('/users')
+def fetch_users():
+    """The users with ?ids=, in that order, skipping any that don't exist."""
+
+    ids = query_ids('ids')
+
+    if not ids:
+        return jsonify(users=[])
+
+    users = (User.query
+             .options(load_only(*User.CARD_COLUMNS))
+             .filter(User.id.in_(ids))
+             .all())
+    by_id = {user.id: user for user in users}
+
+    state = g.user.follow_state(users) if g.user else None
+    following = state.following if state else ()
+    followed_by = state.followed_by if state else ()
+
+    return jsonify(users=[user_card(by_id[id_], following, followed_by)
+                          for id_ in ids if id_ in by_id])
+
+
+@api.route('/follows', methods=['POST'])
+def add_follows():
+    return jsonify(followed=commit_batch(follow, 'user_ids',
+                                         recommendations.followed))
+
+
+@api.route('/follows', methods=['DELETE'])
+def remove_follows():
+    return jsonify(unfollowed=commit_batch(unfollow, 'user_ids',
+                                           recommendations.unfollowed))
+
+
+@api.route('/likes', methods=['POST'])
+def add_likes():
+    return jsonify(liked=commit_batch(
+        like, 'message_ids',
+        lambda user_id, message_ids: trending.liked(message_ids)))
+
+
+@api.route('/likes', methods=['DELETE'])
+def remove_likes():
+    return jsonify(unliked=commit_batch(
+        unlike, 'message_ids',
+        lambda user_id, message_ids: trending.unliked(message_ids)))
+
+
+@api.route('/timeline')
+def home_timeline():
+    require_login()
+
+    return message_page(timelines.home_page(g.user, page_limit()))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    return message_page(paginate_messages(Message
+                                          .timeline()
+                                          .filter(Message.user_id == user_id),
+                                          page_limit()))
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    require_login()
+
+    if user_id == g.user.id:
+        like_buffer.flush(user_id)
+
+    return message_page(paginate_messages(Message
+                                          .timeline()
+                                          .join(Likes,
+                                                Likes.message_id == Message.id)
+                                          .filter(Likes.user_id == user_id),
+                                          page_limit()))
@@ -2,12 +2,33 @@
 
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.exc import ObjectDeletedError
 
+import counters
+from api import api
+from caching import caching
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message, Likes
+from fragments import fragments
+from likebuffer import like_buffer
+from loader import seed_cli
+from metrics import metrics
+from migrations import migrate_cli
+from models import db, connect_db, User, Message, Follows, Likes
+from passwords import passwords, PasswordHasherBusy
+from recommendations import recommendations
+from replicas import replicas
+from pagination import paginate_messages, paginate_follows
+from search import (search_users, search_messages, search_cli, UserCursor,
+                    MessageCursor)
+from timelines import timelines
+from trending import trending
+from usercache import user_cache
 
 CURR_USER_KEY = "curr_user"
 
@@ -19,12 +40,46 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Read-only pages read from these replicas, if any (see replicas.py).
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if uri]
+
+# Serve the homepage from fan-out timelines (see timelines.py) rather than
+# querying every followed user's messages on each page load.
+app.config['TIMELINE_FANOUT'] = os.environ.get('TIMELINE_FANOUT') == '1'
+app.config['TIMELINE_BACKEND'] = os.environ.get('TIMELINE_BACKEND', 'sql')
+
+# Query logging, the debug toolbar and turning off HTTP caching are for
+# development only (FLASK_ENV=development); /metrics has the numbers in
+# production.
+if app.env == 'development':
+    app.config['SQLALCHEMY_ECHO'] = True
+    app.config['HTTP_CACHE'] = False
+    toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+caching.init_app(app)
+fragments.init_app(app)
+like_buffer.init_app(app)
+metrics.init_app(app)
+passwords.init_app(app)
+recommendations.init_app(app)
+replicas.init_app(app)
+metrics.add_source(passwords.samples)
+metrics.add_source(replicas.samples)
+timelines.init_app(app)
+trending.init_app(app)
+user_cache.init_app(app)
+app.register_blueprint(api)
+app.cli.add_command(counters.counters_cli)
+app.cli.add_command(migrate_cli)
+app.cli.add_command(search_cli)
+app.cli.add_command(seed_cli)
 
 
 ##############################################################################
@@ -39,12 +94,44 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.load(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.errorhandler(ObjectDeletedError)
+def curr_user_deleted(e):
+    """If another process deleted the logged-in user while this one had
+    them cached, their rebuilt g.user fails on first load: log them out and
+    handle the request again, as anonymous."""
+
+    user_id = session.get(CURR_USER_KEY)
+    db.session.rollback()
+
+    if (user_id is None
+            or db.session.query(User.query.filter_by(id=user_id).exists())
+                         .scalar()):
+        raise e
+
+    if g.user is not None and g.user in db.session:
+        db.session.expunge(g.user)
+
+    user_cache.invalidate(user_id)
+    do_logout()
+
+    return app.preprocess_request() or app.dispatch_request()
+
+
+def liked_by_curr_user(messages):
+    """Ids of the listed messages the logged-in user has liked."""
+
+    if not g.user:
+        return set()
+
+    return like_buffer.liked_ids(g.user.id, [msg.id for msg in messages])
+
+
 def do_login(user):
     """Log in user."""
 
@@ -86,6 +173,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordHasherBusy:
+            flash("We're very busy right now, please try again.", 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -101,10 +192,16 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordHasherBusy:
+            flash("We're very busy right now, please try again.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # saves the password hash if authenticate() upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -126,23 +223,45 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@replicas.read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and an
+    'after' cursor for the next page of results.
     """
 
-    search = request.args.get('q')
+    search = request.args.get('q', '')
+    after = request.args.get('after')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users, next_after = search_users(search,
+                                     UserCursor.decode(after) if after else None)
 
-    return render_template('users/index.html', users=users)
+    following = g.user.follow_state(users).following if g.user else set()
+
+    return render_template('users/index.html', users=users,
+                           following=following,
+                           search=search, next_after=next_after)
+
+
+def last_changed(user_ids):
+    """When any of these users, or what pages show about them, changed."""
+
+    return (db.session
+            .query(func.max(User.updated_at))
+            .filter(User.id.in_(user_ids))
+            .scalar())
+
+
+def profile_changed(user_id):
+    """When the profile last changed, as the current user sees it."""
+
+    return last_changed([user_id, g.user.id] if g.user else [user_id])
 
 
 @app.route('/users/<int:user_id>')
+@replicas.read_only
+@caching.conditional(profile_changed)
 def users_show(user_id):
     """Show user profile."""
 
@@ -150,16 +269,17 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = paginate_messages(Message
+                             .timeline()
+                             .filter(Message.user_id == user_id))
+
+    return render_template('users/show.html', user=user,
+                           messages=page.items, page=page,
+                           likes=liked_by_curr_user(page.items))
 
 
 @app.route('/users/<int:user_id>/following')
+@replicas.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -168,10 +288,16 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    page = paginate_follows(Follows.user_being_followed_id,
+                            Follows.user_following_id, user_id)
+
+    return render_template('users/following.html', user=user,
+                           users=page.items, page=page,
+                           state=g.user.follow_state(page.items))
 
 
 @app.route('/users/<int:user_id>/followers')
+@replicas.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -180,7 +306,12 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    page = paginate_follows(Follows.user_following_id,
+                            Follows.user_being_followed_id, user_id)
+
+    return render_template('users/followers.html', user=user,
+                           users=page.items, page=page,
+                           state=g.user.follow_state(page.items))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -193,7 +324,14 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    counters.adjust(g.user.id, following_count=1)
+    counters.adjust(followed_user.id, followers_count=1)
+
+    if timelines.enabled and followed_user.id != g.user.id:
+        timelines.store.merge_author(g.user.id, followed_user.id)
+
     db.session.commit()
+    recommendations.followed(g.user.id, [follow_id])
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -208,7 +346,14 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    counters.adjust(g.user.id, following_count=-1)
+    counters.adjust(followed_user.id, followers_count=-1)
+
+    if timelines.enabled and followed_user.id != g.user.id:
+        timelines.store.remove_author(g.user.id, followed_user.id)
+
     db.session.commit()
+    recommendations.unfollowed(g.user.id, [follow_id])
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -221,12 +366,17 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(g.user.id)
+    user = g.user
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        user = User.authenticate(user.username,
-                                 form.password.data)
+        try:
+            user = User.authenticate(user.username,
+                                     form.password.data)
+        except PasswordHasherBusy:
+            flash("We're very busy right now, please try again.", 'danger')
+            return render_template('users/edit.html', user=user,
+                                   form=form), 503
 
         if user:
             data = {
@@ -236,10 +386,13 @@ def profile():
                 'header_image_url': form.header_image_url.data or User.header_image_url.default.arg,
                 'bio': form.bio.data
                 }
-            db.session.query(User).filter_by(id=user.id).update(data)
+            user_id = user.id
+            db.session.query(User).filter_by(id=user_id).update(data)
             db.session.commit()
+            user_cache.invalidate(user_id)
+            fragments.forget_author(user_id)
             flash("Profile Successfully Updated! ", "success")
-            return redirect(f"/users/{user.id}")
+            return redirect(f"/users/{user_id}")
 
         flash("Invalid password. Access unauthorized.", 'danger')
         return redirect('/')
@@ -256,8 +409,14 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # one DELETE; the database cascades it to the user's messages,
+    # follows, likes and timeline entries
+    user_id = g.user.id
+    counters.forget_user(user_id)
+    User.query.filter_by(id=user_id).delete()
     db.session.commit()
+    user_cache.invalidate(user_id)
+    fragments.forget_author(user_id)
 
     return redirect("/signup")
 
@@ -281,6 +440,12 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        counters.adjust(g.user.id, messages_count=1)
+
+        if timelines.enabled:
+            db.session.flush()
+            timelines.store.push(msg)
+
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -288,12 +453,47 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param of words to find, an optional 'author' username to
+    search only their messages, and an 'after' cursor for the next page.
+    """
+
+    search = request.args.get('q', '').strip()
+    author = request.args.get('author', '').strip()
+    after = request.args.get('after')
+
+    author_id = None
+
+    if author:
+        author_id = (User.query
+                     .options(load_only(User.id))
+                     .filter_by(username=author)
+                     .first_or_404()
+                     .id)
+
+    messages, next_after = [], None
+
+    if search:
+        messages, next_after = search_messages(
+            search, author_id, MessageCursor.decode(after) if after else None)
+
+    return render_template('messages/search.html', messages=messages,
+                           search=search, author=author,
+                           next_after=next_after,
+                           likes=liked_by_curr_user(messages))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@replicas.read_only
 def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    return render_template('messages/show.html', message=msg,
+                           likes=liked_by_curr_user([msg]))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -305,8 +505,16 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+
+    if timelines.enabled:
+        timelines.store.retract(msg)
+
+    counters.adjust(msg.user_id, messages_count=-1)
+    counters.drop_likes_of([msg.id])
     db.session.delete(msg)
     db.session.commit()
+    fragments.forget_message(message_id)
+    trending.forget([message_id])
 
     return redirect(f"/users/{g.user.id}")
 
@@ -317,31 +525,43 @@ def messages_destroy(message_id):
 
 @app.route('/users/likes/<int:message_id>', methods=["POST"])
 def add_like(message_id):
-    """Like a message."""
+    """Like a message, or unlike it if it's already liked."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    
-    message = Message.query.filter_by(id=message_id).first_or_404()
-    
-    if g.user.id != message.user.id:
-        has_liked_message = Likes.query.filter(Likes.user_id == g.user.id, 
-                                           Likes.message_id == message.id).count() > 0
-            
-        if has_liked_message:
-            Likes.query.filter_by(user_id=g.user.id, 
-                                  message_id=message.id).delete()
-        else:
-            new_like = Likes(user_id=g.user.id, message_id=message.id)
-            db.session.add(new_like)
-            
+
+    if like_buffer.enabled:
+        toggled = like_buffer.toggle(g.user.id, message_id)
+    else:
+        toggled = Likes.toggle(g.user.id, message_id)
         db.session.commit()
 
+    if toggled is None:
+        abort(404)
+
+    # liking your own message changes nothing, and mustn't count as an
+    # unlike
+    if toggled.changed and toggled.liked:
+        trending.liked([message_id])
+    elif toggled.changed:
+        trending.unliked([message_id])
+
     return redirect(request.referrer)
 
 
+@app.route('/trending')
+def show_trending():
+    """Show the messages with the most recent likes."""
+
+    messages = trending.messages()
+
+    return render_template('messages/trending.html', messages=messages,
+                           likes=liked_by_curr_user(messages))
+
+
 @app.route('/users/<int:user_id>/likes')
+@replicas.read_only
 def show_likes(user_id):
     """Show list of likes from this user."""
 
@@ -349,58 +569,54 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    # your own likes include the ones still buffered
+    if user_id == g.user.id:
+        like_buffer.flush(user_id)
+
     user = User.query.get_or_404(user_id)
-    curr_likes_ids = [like.id for like in user.likes]
-    messages = (Message
-                .query
-                .filter(Message.id.in_(curr_likes_ids))
-                .order_by(Message.timestamp.desc())
-                .all())
-    
-    return render_template('users/likes.html', user=user, messages=messages)
+    page = paginate_messages(Message
+                             .timeline()
+                             .join(Likes, Likes.message_id == Message.id)
+                             .filter(Likes.user_id == user_id))
+
+    return render_template('users/likes.html', user=user,
+                           messages=page.items, page=page,
+                           likes=liked_by_curr_user(page.items))
 
 
 ##############################################################################
 # Homepage and error pages
 
 
+def home_changed():
+    """When the current user's home timeline, or its authors, changed."""
+
+    if not g.user:
+        return None
+
+    return last_changed([g.user.id, *g.user.following_ids])
+
+
 @app.route('/')
+@replicas.read_only
+@caching.conditional(home_changed)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: a page of the most recent messages of followed_users,
+      paged with ?before= / ?after= cursors
     """
 
     if g.user:
-        user = User.query.get_or_404(g.user.id)
-        following_ids = [u.id for u in user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_([user.id, *following_ids]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page = timelines.home_page(g.user)
 
-        return render_template('home.html', messages=messages)
+        suggestions = (recommendations.suggested_users(g.user)
+                       if recommendations.enabled else [])
+
+        return render_template('home.html', messages=page.items, page=page,
+                               likes=liked_by_curr_user(page.items),
+                               suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
-
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
@@ -0,0 +1,330 @@
+"""Route benchmarks for Warbler.
+
+Seeds a database with a generated data set, then drives the hot routes
+through the Flask test client, one request at a time and then from several
+threads at once, recording latency percentiles, requests per second and SQL
+statements per request. Run it like:
+
+    BENCH_DATABASE_URL=postgresql:///warbler-bench python bench.py \\
+        --users 10000 --messages 100000 --follows 200000 \\
+        --out bench.json --baseline baseline.json
+
+Results are written as JSON; given a baseline from an earlier run, any
+route that got slower (or runs more SQL) by more than --tolerance is
+reported and the exit status is 1.
+
+Seeding drops and recreates every table, so the benchmark only ever uses
+BENCH_DATABASE_URL (default postgresql:///warbler-bench); DATABASE_URL is
+ignored, lest a shell pointed at a real database get wiped.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from random import Random
+
+import click
+from sqlalchemy import event, func
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL',
+                                            "postgresql:///warbler-bench")
+
+from app import app, CURR_USER_KEY
+from loader import load
+from models import db, User, Message
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+# sample of ids and usernames that requests are made with
+Dataset = namedtuple('Dataset', 'user_ids usernames message_ids')
+
+# `request` takes (dataset, rng) and returns (method, url, form data)
+Route = namedtuple('Route', 'name request')
+
+
+def get(url):
+    return 'GET', url, None
+
+
+ROUTES = (
+    Route('homepage', lambda d, rng: get('/')),
+    Route('users_show',
+          lambda d, rng: get(f"/users/{rng.choice(d.user_ids)}")),
+    Route('list_users',
+          lambda d, rng: get(f"/users?q={rng.choice(d.usernames)[:3]}")),
+    Route('show_following',
+          lambda d, rng: get(f"/users/{rng.choice(d.user_ids)}/following")),
+    Route('users_followers',
+          lambda d, rng: get(f"/users/{rng.choice(d.user_ids)}/followers")),
+    Route('show_likes',
+          lambda d, rng: get(f"/users/{rng.choice(d.user_ids)}/likes")),
+    Route('add_like',
+          lambda d, rng: ('POST', f"/users/likes/{rng.choice(d.message_ids)}",
+                          None)),
+    Route('messages_add',
+          lambda d, rng: ('POST', '/messages/new',
+                          {'text': f"Benchmark warble {rng.random()}"})),
+)
+
+ROUTE_NAMES = [route.name for route in ROUTES]
+
+
+##############################################################################
+# Data
+
+def seed(users, messages, follows, random_seed, data=None):
+    """Load the CSVs in `data`, or generate a data set of the given size."""
+
+    # progress goes to stderr, leaving stdout for the results
+    echo = partial(click.echo, err=True)
+
+    if data:
+        return load(data, echo=echo)
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run([sys.executable, GENERATOR, '--users', str(users),
+                        '--messages', str(messages), '--follows', str(follows),
+                        '--seed', str(random_seed), '--out', out],
+                       stdout=sys.stderr, check=True)
+        return load(out, echo=echo)
+
+
+def sample_ids(rng, column, size):
+    """Up to `size` random existing values of the integer id `column`."""
+
+    top = db.session.query(func.max(column)).scalar() or 0
+    ids = rng.sample(range(1, top + 1), min(size, top))
+
+    return sorted(value for (value,) in
+                  db.session.query(column).filter(column.in_(ids)))
+
+
+def sample_dataset(rng, size=1000):
+    """A random sample of users and messages to make requests about."""
+
+    users = (db.session.query(User.id, User.username)
+             .filter(User.id.in_(sample_ids(rng, User.id, size)))
+             .order_by(User.id)
+             .all())
+
+    return Dataset([user_id for user_id, _ in users],
+                   [username for _, username in users],
+                   sample_ids(rng, Message.id, size))
+
+
+##############################################################################
+# Measuring
+
+class StatementCounter:
+    """Counts SQL statements run by each thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.statements = self.statements + 1
+
+    @property
+    def statements(self):
+        return getattr(self.local, 'statements', 0)
+
+
+def percentile(ordered, percent):
+    """Nearest-rank percentile of an already sorted list."""
+
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(latencies, statements, errors, elapsed):
+    """Stats for one route: latencies in ms, rps, SQL per request."""
+
+    ordered = sorted(latencies)
+
+    return dict(
+        requests=len(ordered),
+        errors=errors,
+        rps=round(len(ordered) / elapsed, 1),
+        mean=round(statistics.mean(ordered) * 1000, 2),
+        p50=round(percentile(ordered, 50) * 1000, 2),
+        p95=round(percentile(ordered, 95) * 1000, 2),
+        p99=round(percentile(ordered, 99) * 1000, 2),
+        sql=round(sum(statements) / len(statements), 2),
+    )
+
+
+def drive(route, dataset, requests, random_seed, counter):
+    """Make `requests` requests to `route` as a random logged-in user.
+
+    Returns (latencies, statements per request, errors).
+    """
+
+    rng = Random(random_seed)
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = rng.choice(dataset.user_ids)
+
+    latencies = []
+    statements = []
+    errors = 0
+
+    for i in range(requests):
+        method, url, data = route.request(dataset, rng)
+        before = counter.statements
+        start = time.perf_counter()
+
+        resp = client.open(url, method=method, data=data,
+                           headers={'Referer': '/'})
+
+        latencies.append(time.perf_counter() - start)
+        statements.append(counter.statements - before)
+        errors += resp.status_code >= 400
+
+    return latencies, statements, errors
+
+
+def bench_route(route, dataset, requests, concurrency, random_seed, counter):
+    """Stats for `route`, split over `concurrency` threads."""
+
+    # the first `requests % concurrency` threads make one request more
+    share, extra = divmod(requests, concurrency)
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        runs = list(executor.map(
+            lambda thread: drive(route, dataset, share + (thread < extra),
+                                 f"{random_seed}:{route.name}:{thread}",
+                                 counter),
+            range(concurrency)))
+
+    elapsed = time.perf_counter() - start
+
+    return summarize([latency for run in runs for latency in run[0]],
+                     [count for run in runs for count in run[1]],
+                     sum(run[2] for run in runs),
+                     elapsed)
+
+
+def run(routes, requests, concurrency, random_seed=0):
+    """Benchmark `routes` single-threaded, then with `concurrency` threads.
+
+    Returns {route name: {'single': stats, 'concurrent': stats}}.
+    """
+
+    dataset = sample_dataset(Random(random_seed))
+    results = {}
+
+    with StatementCounter() as counter:
+        for route in routes:
+            results[route.name] = {
+                'single': bench_route(route, dataset, requests, 1,
+                                      random_seed, counter),
+                'concurrent': bench_route(route, dataset, requests,
+                                          concurrency, random_seed, counter),
+            }
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Yield (route, mode, metric, old, new) for each regression.
+
+    Latency and SQL regress by growing, rps by shrinking, by more than
+    `tolerance` (a fraction) of the baseline.
+    """
+
+    for name, modes in results.items():
+        for mode, stats in modes.items():
+            old = baseline.get(name, {}).get(mode)
+
+            if not old:
+                continue
+
+            for metric in ('p50', 'p95', 'p99', 'sql'):
+                if stats[metric] > old[metric] * (1 + tolerance):
+                    yield name, mode, metric, old[metric], stats[metric]
+
+            if stats['rps'] < old['rps'] * (1 - tolerance):
+                yield name, mode, 'rps', old['rps'], stats['rps']
+
+
+##############################################################################
+# CLI
+
+@click.command()
+@click.option('--users', default=300, show_default=True)
+@click.option('--messages', default=1000, show_default=True)
+@click.option('--follows', default=5000, show_default=True)
+@click.option('--seed', 'random_seed', default=0, show_default=True)
+@click.option('--data', type=click.Path(exists=True, file_okay=False),
+              help="Load these CSVs instead of generating a data set.")
+@click.option('--reuse', is_flag=True,
+              help="Benchmark the database as it is, without seeding.")
+@click.option('--requests', default=200, show_default=True,
+              type=click.IntRange(min=1),
+              help="Requests per route, per mode.")
+@click.option('--concurrency', default=8, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--route', 'route_names', multiple=True,
+              type=click.Choice(ROUTE_NAMES),
+              help="Only benchmark these routes. [default: all]")
+@click.option('--out', type=click.File('w'), default='-',
+              help="Write JSON results here. [default: stdout]")
+@click.option('--baseline', type=click.File(),
+              help="Compare with results from an earlier run.")
+@click.option('--tolerance', default=0.2, show_default=True)
+def main(users, messages, follows, random_seed, data, reuse, requests,
+         concurrency, route_names, out, baseline, tolerance):
+    """Benchmark Warbler's routes and write the results as JSON."""
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        db.engine.echo = False
+
+        if not reuse:
+            seed(users, messages, follows, random_seed, data)
+
+        routes = [route for route in ROUTES
+                  if not route_names or route.name in route_names]
+        results = run(routes, requests, concurrency, random_seed)
+
+    json.dump(dict(
+        dataset=dict(users=users, messages=messages, follows=follows,
+                     seed=random_seed, data=data, reused=reuse),
+        requests=requests,
+        concurrency=concurrency,
+        routes=results,
+    ), out, indent=2)
+    out.write('\n')
+
+    if baseline:
+        regressions = list(compare(results, json.load(baseline)['routes'],
+                                   tolerance))
+
+        for name, mode, metric, old, new in regressions:
+            click.echo(f"{name} ({mode}): {metric} {old} -> {new}", err=True)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""SQL statement budgets for Warbler's routes.
+
+QUERY_BUDGETS declares the most SQL statements each endpoint may run for one
+request. The numbers don't depend on how much data there is: a route whose
+statement count grows with its rows is an N+1 bug. test_budgets.py requests
+every endpoint listed here against data sets of several sizes, so raise a
+budget only along with a reason.
+
+query_budget() checks one block of code against a budget, e.g. in a test:
+
+    with query_budget(QUERY_BUDGETS['homepage']):
+        client.get('/')
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+QUERY_BUDGETS = {
+    'signup': 1,
+    'login': 2,
+    'logout': 0,
+    'list_users': 2,
+    'users_show': 4,  # one is the conditional GET validator
+    'show_following': 3,
+    'users_followers': 3,
+    'add_follow': 6,
+    'stop_following': 6,
+    'profile': 1,
+    'delete_user': 5,  # the account's rows go in one cascading DELETE
+    'messages_add': 4,
+    'messages_search': 2,
+    'messages_show': 4,
+    'messages_destroy': 6,
+    'add_like': 1,  # the toggle and its counter are one statement
+    'show_likes': 3,
+    'homepage': 5,  # one is the conditional GET validator
+    'show_trending': 3,  # one builds the scores on a cold start
+    'api_v1.fetch_users': 2,
+    'api_v1.home_timeline': 3,
+    'api_v1.user_messages': 2,
+    'api_v1.user_likes': 2,
+    'api_v1.add_follows': 4,
+    'api_v1.remove_follows': 4,
+    'api_v1.add_likes': 3,
+    'api_v1.remove_likes': 3,
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block runs more statements than its budget."""
+
+
+class QueryCounter:
+    """Collects the SQL statements run on an engine inside a with block."""
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        self.engine = self.engine or db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def __len__(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+
+@contextmanager
+def query_budget(limit, engine=None):
+    """Fail with QueryBudgetExceeded if the block runs over `limit`
+    statements."""
+
+    with QueryCounter(engine) as counter:
+        yield counter
+
+    if len(counter) > limit:
+        raise QueryBudgetExceeded(
+            f"{len(counter)} SQL statements, over the budget of {limit}:\n\n"
+            + "\n\n".join(counter.statements))
@@ -0,0 +1,156 @@
+"""HTTP caching for Warbler.
+
+Timelines and profiles answer conditional GETs. A view wrapped in
+caching.conditional() names a validator: a cheap query for when anything on
+the page last changed. Its strong ETag hashes that time with the URL, the
+viewer, the viewer's buffered likes and the release, and a request that
+still matches gets a 304 before the view runs at all. There's no
+Last-Modified: the date alone doesn't say whose page it was.
+
+Static files linked through static_url() carry a content hash in their URL,
+so they're cached for a year as immutable; others are revalidated.
+
+Setting HTTP_CACHE to False, as development does, marks every response as
+uncacheable instead.
+"""
+
+import hashlib
+import os
+from functools import wraps
+
+from flask import current_app, make_response, request, session, url_for
+from werkzeug.http import is_resource_modified
+
+from likebuffer import like_buffer
+
+IMMUTABLE = 365 * 24 * 60 * 60
+
+
+def file_digest(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+class Caching:
+    """Adds cache headers to responses and validators to pages.
+
+    Config:
+        HTTP_CACHE: cache responses; False sends no-store (default True)
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.release = ''
+        self._static_folder = None
+        self._static_versions = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.setdefault('HTTP_CACHE', True)
+        self.release = self.templates_digest(app)
+        self._static_folder = app.static_folder
+
+        app.after_request(self._add_headers)
+        app.add_template_global(self.static_url, 'static_url')
+        app.extensions['caching'] = self
+
+    @staticmethod
+    def templates_digest(app):
+        """Hash of every template, so a release with new markup changes
+        every ETag."""
+
+        digest = hashlib.sha1()
+        folder = os.path.join(app.root_path, app.template_folder)
+
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                digest.update(file_digest(os.path.join(root, name)).encode())
+
+        return digest.hexdigest()
+
+    def static_url(self, filename):
+        """URL of a static file that changes whenever its content does."""
+
+        if not self.enabled:
+            return url_for('static', filename=filename)
+
+        version = self._static_versions.get(filename)
+
+        if version is None:
+            path = os.path.join(self._static_folder, filename)
+            version = self._static_versions[filename] = file_digest(path)[:12]
+
+        return url_for('static', filename=filename, v=version)
+
+    def etag(self, last_modified):
+        """Strong ETag of the requested page for the current viewer."""
+
+        user_id = session.get('curr_user')
+
+        # the viewer's likes not yet written show on the page, but haven't
+        # changed last_modified
+        parts = [self.release, request.full_path, str(user_id),
+                 str(last_modified), str(like_buffer.version(user_id))]
+
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def conditional(self, validator):
+        """Decorate a view to answer conditional GETs before it runs.
+
+        `validator` takes the view's arguments and returns when anything the
+        page shows last changed, or None if nothing stored affects it.
+        Pages with flashed messages are always rendered.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(**kwargs):
+                if (not self.enabled or request.method != 'GET'
+                        or session.get('_flashes')):
+                    return view(**kwargs)
+
+                last_modified = validator(**kwargs)
+                etag = self.etag(last_modified)
+
+                # only the ETag names the viewer, so If-Modified-Since
+                # alone could hand one user's page to another
+                if not is_resource_modified(request.environ, etag=etag):
+                    response = current_app.response_class(status=304)
+                else:
+                    response = make_response(view(**kwargs))
+
+                    if response.status_code != 200:
+                        return response
+
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def _add_headers(self, response):
+        if not self.enabled:
+            response.headers['Cache-Control'] = ('no-cache, no-store, '
+                                                 'must-revalidate')
+            response.headers['Pragma'] = 'no-cache'
+            response.headers['Expires'] = '0'
+
+        elif request.endpoint == 'static':
+            if request.args.get('v'):
+                response.headers['Cache-Control'] = (f"public, "
+                                                     f"max-age={IMMUTABLE}, "
+                                                     "immutable")
+            else:
+                response.headers['Cache-Control'] = 'public, no-cache'
+
+        elif 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = 'private, no-cache'
+
+        return response
+
+
+caching = Caching()
@@ -0,0 +1,177 @@
+"""Denormalized per-user counters for Warbler.
+
+User.messages_count, following_count, followers_count and likes_count are
+kept in step with the messages, follows and likes tables by the views that
+change them, inside the same transaction, so profile pages don't need to
+load whole relationships just to count them. `flask counters reconcile`
+recomputes them in bulk and reports any drift.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, or_
+
+from models import db, User, Message, Follows, Likes
+
+COUNTERS = ('messages_count', 'following_count', 'followers_count',
+            'likes_count')
+
+
+def adjust(users, **deltas):
+    """Add `deltas` to counters, e.g. adjust(user_id, followers_count=1).
+
+    `users` is a user id, or a select() of user ids to adjust together.
+    Updates run as a single UPDATE in the caller's transaction.
+    """
+
+    if isinstance(users, int):
+        criterion = User.id == users
+    else:
+        criterion = User.id.in_(users)
+
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items()}
+
+    User.query.filter(criterion).update(values, synchronize_session=False)
+
+
+def drop_likes_of(message_ids):
+    """Decrement likers' likes_count for messages about to be deleted.
+
+    `message_ids` is a list or select() of message ids.
+    """
+
+    liked = (db.select([func.count()])
+             .where(Likes.user_id == User.id)
+             .where(Likes.message_id.in_(message_ids))
+             .as_scalar())
+
+    likers = db.select([Likes.user_id]).where(Likes.message_id.in_(message_ids))
+
+    (User
+     .query
+     .filter(User.id.in_(likers))
+     .update({User.likes_count: User.likes_count - liked},
+             synchronize_session=False))
+
+
+def forget_user(user_id):
+    """Adjust everyone else's counters for a user about to be deleted."""
+
+    followed = (db.select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user_id))
+    followers = (db.select([Follows.user_following_id])
+                 .where(Follows.user_being_followed_id == user_id))
+
+    adjust(followed, followers_count=-1)
+    adjust(followers, following_count=-1)
+    drop_likes_of(db.select([Message.id]).where(Message.user_id == user_id))
+
+
+def actual_counts():
+    """Query of (user, true counts...) computed from the source tables."""
+
+    def grouped(column):
+        return (db.session
+                .query(column.label('user_id'), func.count().label('n'))
+                .group_by(column)
+                .subquery())
+
+    sources = [grouped(Message.user_id),
+               grouped(Follows.user_following_id),
+               grouped(Follows.user_being_followed_id),
+               grouped(Likes.user_id)]
+
+    query = db.session.query(User, *(func.coalesce(source.c.n, 0)
+                                     for source in sources))
+
+    for source in sources:
+        query = query.outerjoin(source, source.c.user_id == User.id)
+
+    return query, sources
+
+
+def drifted():
+    """Yield (user, {counter: (stored, actual)}) for each user with drift."""
+
+    query, sources = actual_counts()
+    stored = [getattr(User, name) for name in COUNTERS]
+
+    query = query.filter(or_(*(
+        column != func.coalesce(source.c.n, 0)
+        for column, source in zip(stored, sources))))
+
+    for user, *actual in query.order_by(User.id):
+        drift = {name: (getattr(user, name), count)
+                 for name, count in zip(COUNTERS, actual)
+                 if getattr(user, name) != count}
+        yield user, drift
+
+
+def reconcile(fix=True):
+    """Find (and by default fix) counter drift; returns the drifted users."""
+
+    report = list(drifted())
+
+    if fix and report:
+        db.session.bulk_update_mappings(User, [
+            dict(id=user.id, **{name: actual
+                                for name, (_, actual) in drift.items()})
+            for user, drift in report
+        ])
+        db.session.commit()
+
+    return report
+
+
+def recount(connection=None):
+    """Set counters from the source tables without loading any users.
+
+    For freshly bulk-loaded tables, where every counter starts at 0: on
+    PostgreSQL each counter is set by one UPDATE joined to grouped counts,
+    and users with nothing to count are left untouched. Other databases
+    fall back to reconcile().
+
+    Runs on `connection`, in its transaction, if given; otherwise in the
+    session, and commits.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        reconcile()
+        return
+
+    users = User.__table__
+    _, sources = actual_counts()
+
+    execute = (connection or db.session).execute
+
+    for name, source in zip(COUNTERS, sources):
+        execute(users
+                .update()
+                .values({name: source.c.n})
+                .where(users.c.id == source.c.user_id))
+
+    if connection is None:
+        db.session.commit()
+
+
+##############################################################################
+# CLI: flask counters reconcile
+
+counters_cli = AppGroup('counters', help="Maintain denormalized user counters.")
+
+
+@counters_cli.command('reconcile')
+@click.option('--dry-run', is_flag=True, help="Report drift without fixing it.")
+def reconcile_command(dry_run):
+    """Recompute every user's counters and report any drift."""
+
+    report = reconcile(fix=not dry_run)
+
+    for user, drift in report:
+        changes = ', '.join(f"{name} {stored} -> {actual}"
+                            for name, (stored, actual) in drift.items())
+        click.echo(f"User #{user.id}: {changes}")
+
+    verb = "Found" if dry_run else "Fixed"
+    click.echo(f"{verb} drift for {len(report)} users.")
@@ -0,0 +1,120 @@
+"""Rendered message fragment cache.
+
+Every timeline, profile and likes page renders the same markup for a
+message: its link, the author's avatar and name, the date and the text.
+None of that depends on who is looking, so it's rendered once per message
+and kept here; only the like button, which does, is rendered per request.
+A page that puts the button inside the message's text area passes it as
+the body of a call block:
+
+    {% call message_fragment(message) %}<form>...</form>{% endcall %}
+
+An entry is keyed on the message id and stamped with the author fields it
+shows, so a fragment rendered before a profile edit is never served after
+it. profile() and messages_destroy() also drop entries they've made stale,
+to free the room early.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+from models import Message
+
+TEMPLATE = 'messages/fragment.html'
+
+# where a call block's body goes in the rendered fragment
+SLOT = '<!-- slot -->'
+
+
+def author_version(message):
+    """The author fields `message`'s fragment shows."""
+
+    return tuple(getattr(message.user, column)
+                 for column in Message.AUTHOR_COLUMNS)
+
+
+class FragmentCache:
+    """Bounded LRU of message id -> rendered markup, split at the slot.
+
+    Config:
+        MESSAGE_FRAGMENT_CACHE_SIZE: most fragments kept (default 10000)
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = 10000
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config.setdefault('MESSAGE_FRAGMENT_CACHE_SIZE',
+                                             10000)
+        app.add_template_global(self.render, 'message_fragment')
+        app.extensions['fragments'] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def render(self, message, caller=None):
+        """The static markup of `message`, from the cache if it's current,
+        with the body of the call block, if any, in its slot."""
+
+        version = author_version(message)
+
+        with self._lock:
+            entry = self._entries.get(message.id)
+
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(message.id)
+                parts = entry[2]
+            else:
+                parts = None
+
+        if parts is None:
+            parts = self._render(message)
+
+            with self._lock:
+                self._entries[message.id] = (version, message.user_id, parts)
+                self._entries.move_to_end(message.id)
+
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+        head, tail = parts
+
+        return head + (caller() if caller is not None else '') + tail
+
+    @staticmethod
+    def _render(message):
+        template = current_app.jinja_env.get_template(TEMPLATE)
+        head, tail = template.render(message=message,
+                                     slot=Markup(SLOT)).split(SLOT)
+
+        return Markup(head), Markup(tail)
+
+    def forget_message(self, message_id):
+        with self._lock:
+            self._entries.pop(message_id, None)
+
+    def forget_author(self, user_id):
+        """Drop every fragment of `user_id`'s messages."""
+
+        with self._lock:
+            stale = [message_id
+                     for message_id, (version, author_id, markup)
+                     in self._entries.items() if author_id == user_id]
+
+            for message_id in stale:
+                del self._entries[message_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fragments = FragmentCache()
@@ -2,19 +2,36 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load tests:
+
+    python generator/create_csvs.py --users 100000 --messages 10000000 \\
+        --follows 5000000 --seed 7
+
+Rows are generated in shards of --shard-size rows, written in parallel by
+--workers processes and then joined into one file per table. Each shard has
+its own random seed derived from --seed, so the output is the same however
+many workers there are. No network access is needed.
+
+Followers are drawn from a power-law distribution, so a few users have most
+of the followers, without ever listing every pair of users.
 """
 
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time
+from random import Random
+
+import click
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import HEADER_IMAGE_URLS, get_random_datetime, power_law_ids
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
@@ -22,7 +39,14 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+SHARD_SIZE = 100000
+
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# fake values made per shard and then picked from at random; calling Faker
+# for every row is far too slow at millions of rows
+POOL_SIZE = 2000
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +56,191 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def shard_random(seed, table, shard):
+    """Random number generator and Faker for one shard of a table."""
+
+    rng = Random(f"{seed}:{table}:{shard}")
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    return rng, fake
+
+
+def write_users(path, seed, shard, first_id, last_id):
+    """Write users with ids from first_id to last_id."""
+
+    rng, fake = shard_random(seed, 'users', shard)
+    names = [fake.user_name() for i in range(POOL_SIZE)]
+    domains = [fake.free_email_domain() for i in range(POOL_SIZE)]
+    bios = [fake.sentence() for i in range(POOL_SIZE)]
+    cities = [fake.city() for i in range(POOL_SIZE)]
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.writer(users_csv)
+
+        for user_id in range(first_id, last_id + 1):
+            # the id suffix keeps usernames and emails unique at any size
+            username = f"{rng.choice(names)}{user_id}"
+
+            users_writer.writerow([
+                user_id,
+                f"{username}@{rng.choice(domains)}",
+                username,
+                rng.choice(image_urls),
+                PASSWORD,
+                rng.choice(bios),
+                rng.choice(HEADER_IMAGE_URLS),
+                rng.choice(cities),
+            ])
+
+
+def write_messages(path, seed, shard, count, num_users, now):
+    """Write `count` messages by random users."""
+
+    rng, fake = shard_random(seed, 'messages', shard)
+    sentences = [fake.sentence() for i in range(POOL_SIZE)]
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.writer(messages_csv)
+
+        for i in range(count):
+            text = ' '.join(rng.sample(sentences, rng.randint(1, 4)))
+
+            messages_writer.writerow([
+                text[:MAX_WARBLER_LENGTH],
+                get_random_datetime(rng=rng, now=now),
+                rng.randint(1, num_users),
+            ])
+
+
+def write_follows(path, seed, shard, first_id, last_id, count, num_users,
+                  skew):
+    """Write `count` follows by users first_id to last_id.
+
+    Each follower's follows are spread evenly over the range; who they
+    follow is drawn from the power-law distribution, skipping themselves
+    and repeats.
+    """
+
+    rng, _ = shard_random(seed, 'follows', shard)
+    popular = power_law_ids(rng, num_users, skew)
+    followers = last_id - first_id + 1
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+
+        for i, follower in enumerate(range(first_id, last_id + 1)):
+            wanted = count // followers + (i < count % followers)
+            followed = set()
+
+            # in dense graphs the popular users run out; fill in uniformly
+            for attempt in range(4 * wanted + 100):
+                if len(followed) == wanted:
+                    break
+
+                user_id = next(popular)
+
+                if user_id != follower:
+                    followed.add(user_id)
+
+            else:
+                others = [user_id for user_id in range(1, num_users + 1)
+                          if user_id != follower and user_id not in followed]
+                followed.update(rng.sample(others, wanted - len(followed)))
+
+            follows_writer.writerows([user_id, follower]
+                                     for user_id in sorted(followed))
+
+
+def split(total, parts):
+    """Split range(total) into `parts` (start, size) runs of nearly equal size."""
+
+    for part in range(parts):
+        start = total * part // parts
+        yield start, total * (part + 1) // parts - start
+
+
+def shards(num_users, num_messages, num_follows, seed, shard_size, skew,
+           now):
+    """Yield (table, function, args) for every shard to write."""
+
+    def count(rows):
+        return max(1, -(-rows // shard_size))
+
+    for shard, (start, size) in enumerate(split(num_users, count(num_users))):
+        yield 'users', write_users, (seed, shard, start + 1, start + size)
+
+    for shard, (_, size) in enumerate(split(num_messages,
+                                            count(num_messages))):
+        yield 'messages', write_messages, (seed, shard, size, num_users, now)
+
+    # split follows by follower, so no two shards can write the same pair
+    parts = min(count(num_follows), num_users)
+
+    for shard, ((start, size), (_, follows)) in enumerate(zip(
+            split(num_users, parts), split(num_follows, parts))):
+        yield 'follows', write_follows, (seed, shard, start + 1, start + size,
+                                         follows, num_users, skew)
+
+
+def join_shards(out, table, headers, paths):
+    """Write `table`.csv in `out` from its shard files, in order."""
+
+    with open(os.path.join(out, f"{table}.csv"), 'w', newline='') as table_csv:
+        csv.writer(table_csv).writerow(headers)
+
+        for path in paths:
+            with open(path, newline='') as shard_csv:
+                shutil.copyfileobj(shard_csv, table_csv)
+
+
+@click.command()
+@click.option('--users', default=NUM_USERS, show_default=True)
+@click.option('--messages', default=NUM_MESSAGES, show_default=True)
+@click.option('--follows', default=NUM_FOLLWERS, show_default=True)
+@click.option('--seed', default=0, show_default=True,
+              help="Same seed, sizes, --shard-size and --until give the same files.")
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']),
+              help="Date messages end at. [default: today]")
+@click.option('--skew', default=1.0, show_default=True,
+              help="Power-law exponent of followers per user.")
+@click.option('--shard-size', default=SHARD_SIZE, show_default=True)
+@click.option('--workers', default=os.cpu_count(), show_default=True)
+@click.option('--out', default='generator', show_default=True,
+              type=click.Path(file_okay=False))
+def main(users, messages, follows, seed, until, skew, shard_size, workers,
+         out):
+    """Generate users.csv, messages.csv and follows.csv."""
+
+    if follows > users * (users - 1):
+        raise click.BadParameter(f"{users} users can't have {follows} "
+                                 "follows.", param_hint='--follows')
+
+    now = until or datetime.combine(date.today(), time())
+    os.makedirs(out, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=out) as tmp, \
+            ProcessPoolExecutor(workers) as executor:
+        paths = {'users': [], 'messages': [], 'follows': []}
+        futures = []
+
+        for table, write, args in shards(users, messages, follows, seed,
+                                         shard_size, skew, now):
+            path = os.path.join(tmp, f"{table}.{len(paths[table]):05d}.csv")
+            paths[table].append(path)
+            futures.append(executor.submit(write, path, *args))
+
+        for future in futures:
+            future.result()
+
+        join_shards(out, 'users', USERS_CSV_HEADERS, paths['users'])
+        join_shards(out, 'messages', MESSAGES_CSV_HEADERS, paths['messages'])
+        join_shards(out, 'follows', FOLLOWS_CSV_HEADERS, paths['follows'])
+
+    click.echo(f"Wrote {users} users, {messages} messages and {follows} "
+               f"follows in {len(futures)} shards to {out}/.")
+
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""Write-behind buffering for the like button.
+
+With LIKE_WRITE_BEHIND on, add_like() doesn't write or commit: it reads
+whether the user likes the message (one indexed SELECT), records the new
+state in this process's buffer and answers straight away. A background
+thread writes the buffer every LIKE_FLUSH_INTERVAL seconds, or sooner once
+LIKE_FLUSH_BATCH toggles are waiting, as one transaction: one multi-row
+INSERT, one multi-row DELETE and the likes_count updates.
+
+The buffer keeps one entry per (user, message): clicking like and unlike
+over and over between flushes writes at most one row, and clicking back to
+the stored state writes nothing. At most LIKE_BUFFER_SIZE entries wait;
+toggles past that are written through, as with the mode off. Pending
+toggles are flushed when the process exits.
+
+Readers see their own pending likes: liked_ids() overlays the buffer on
+the likes table, a user's own likes pages flush their pending toggles
+first, and version() goes into their pages' ETags, so a page revalidated
+after a toggle is rendered again rather than answered with a 304. Other
+users, other processes and the likes_count on profile pages catch up with
+the next flush.
+"""
+
+import atexit
+import itertools
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, exists, tuple_
+
+import counters
+from models import db, User, Message, Likes, Toggle
+from replicas import primary
+
+
+class LikeBuffer:
+    """Pending like states, keyed by (user_id, message_id).
+
+    Config:
+        LIKE_WRITE_BEHIND: buffer like toggles (default off)
+        LIKE_BUFFER_SIZE: most toggles waiting to be written (default 10000)
+        LIKE_FLUSH_INTERVAL: seconds between flushes (default 1)
+        LIKE_FLUSH_BATCH: waiting toggles that start a flush early
+            (default 500)
+    """
+
+    def __init__(self, app=None):
+        self.maxsize = 10000
+        self.batch = 500
+        self.interval = 1
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopping = False
+        # key: (liked as stored, liked as wanted); `_flushing` is the
+        # batch being written
+        self._pending = {}
+        self._flushing = {}
+        # user_id: a number no other pending state of theirs has had
+        self._versions = {}
+        self._version_numbers = itertools.count(1)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIKE_WRITE_BEHIND', False)
+        self.maxsize = app.config.setdefault('LIKE_BUFFER_SIZE', 10000)
+        self.interval = app.config.setdefault('LIKE_FLUSH_INTERVAL', 1)
+        self.batch = app.config.setdefault('LIKE_FLUSH_BATCH', 500)
+        app.extensions['like_buffer'] = self
+
+    @property
+    def enabled(self):
+        return current_app.config['LIKE_WRITE_BEHIND']
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _stored_state(self, key):
+        """What the likes table will hold for `key` once the batch being
+        flushed is written, or None if it isn't in that batch."""
+
+        entry = self._flushing.get(key)
+        return None if entry is None else entry[1]
+
+    def version(self, user_id):
+        """Changes with every buffered toggle of `user_id`'s, until they're
+        written; None if they haven't any."""
+
+        return self._versions.get(user_id)
+
+    def _flip(self, key, stored):
+        _, wanted = self._pending.get(key, (stored, stored))
+        wanted = not wanted
+        self._versions[key[0]] = next(self._version_numbers)
+
+        if wanted == stored:
+            self._pending.pop(key, None)
+        else:
+            self._pending[key] = (stored, wanted)
+
+        if len(self._pending) >= self.batch:
+            self._wake.set()
+
+        return Toggle(changed=True, liked=wanted)
+
+    def toggle(self, user_id, message_id):
+        """Like the message if this user hasn't, otherwise unlike it.
+
+        Same results as Likes.toggle(). The toggle is buffered unless the
+        buffer is full; then it's written and committed here.
+        """
+
+        key = (user_id, message_id)
+
+        with self._lock:
+            entry = self._pending.get(key)
+
+            if entry is not None:
+                return self._flip(key, entry[0])
+
+        author_id, liked = (db.session
+                            .query(Message.user_id,
+                                   exists().where(and_(
+                                       Likes.user_id == user_id,
+                                       Likes.message_id == Message.id)))
+                            .filter(Message.id == message_id)
+                            .first()) or (None, False)
+
+        if author_id is None:
+            return None
+
+        if author_id == user_id:
+            return Toggle(changed=False, liked=False)
+
+        with self._lock:
+            stored = self._stored_state(key)
+
+            if key in self._pending or len(self._pending) < self.maxsize:
+                self._start()
+                return self._flip(key, liked if stored is None else stored)
+
+        toggled = Likes.toggle(user_id, message_id)
+        db.session.commit()
+
+        return toggled
+
+    def liked_ids(self, user_id, message_ids):
+        """Likes.liked_ids(), with this process's pending toggles."""
+
+        liked = Likes.liked_ids(user_id, message_ids)
+
+        with self._lock:
+            for source in (self._flushing, self._pending):
+                if not source:
+                    continue
+
+                for message_id in message_ids:
+                    entry = source.get((user_id, message_id))
+
+                    if entry is None:
+                        continue
+                    elif entry[1]:
+                        liked.add(message_id)
+                    else:
+                        liked.discard(message_id)
+
+        return liked
+
+    def flush(self, user_id=None):
+        """Write the pending toggles, or just `user_id`'s, and commit.
+
+        Returns how many toggles were written. On failure the toggles go
+        back in the buffer, behind any made since, and the error is raised.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                if user_id is None:
+                    batch, self._pending = self._pending, {}
+                    versions = dict(self._versions)
+                else:
+                    versions = {user_id: self._versions.get(user_id)}
+
+                    batch = {key: entry
+                             for key, entry in self._pending.items()
+                             if key[0] == user_id}
+
+                    for key in batch:
+                        del self._pending[key]
+
+                self._flushing = batch
+
+            if not batch:
+                self._written(versions)
+                return 0
+
+            try:
+                # a user's likes page flushes from a view that reads from
+                # a replica, but what's stored must be read from the primary
+                with primary():
+                    write(batch)
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+                with self._lock:
+                    self._requeue(batch)
+                    self._flushing = {}
+                raise
+
+            with self._lock:
+                self._flushing = {}
+
+            self._written(versions)
+            return len(batch)
+
+    def _written(self, versions):
+        """Drop the versions of users with nothing left pending; the
+        updated_at the write bumped, if any, validates their pages now."""
+
+        with self._lock:
+            for user_id, version in versions.items():
+                if self._versions.get(user_id) == version:
+                    self._versions.pop(user_id, None)
+
+    def _requeue(self, batch):
+        for key, (stored, wanted) in batch.items():
+            # toggles made since took the batch as written
+            newer = self._pending.get(key)
+            wanted = wanted if newer is None else newer[1]
+
+            if wanted == stored:
+                self._pending.pop(key, None)
+            else:
+                self._pending[key] = (stored, wanted)
+
+    def _start(self):
+        """Start the flusher, if it isn't running; call with the lock
+        held."""
+
+        if self._thread is not None:
+            return
+
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, args=(current_app._get_current_object(),),
+            daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self, app):
+        with app.app_context():
+            while True:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+                # read first, so a stop always gets one more flush
+                stopping = self._stopping
+
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception("Flushing buffered likes failed.")
+                finally:
+                    db.session.remove()
+
+                if stopping:
+                    return
+
+    def stop(self):
+        """Flush what's pending and stop the flusher."""
+
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+
+        if thread is None:
+            return
+
+        self._stopping = True
+        self._wake.set()
+        thread.join()
+        atexit.unregister(self.stop)
+
+
+def write(batch):
+    """Bring the likes table and likes_count in line with a batch of
+    {(user_id, message_id): (stored, wanted)}, in the caller's transaction.
+
+    The table is read again rather than trusting `stored`, since other
+    processes write likes too. Likes of messages or by users deleted since
+    the toggle are dropped.
+    """
+
+    keys = list(batch)
+    key_columns = tuple_(Likes.user_id, Likes.message_id)
+
+    existing = set(db.session
+                   .query(Likes.user_id, Likes.message_id)
+                   .filter(key_columns.in_(keys)))
+
+    wanted = [key for key in keys if batch[key][1] and key not in existing]
+    deletes = [key for key in keys if not batch[key][1] and key in existing]
+    inserts = []
+
+    if wanted:
+        message_ids = {message_id for _, message_id in wanted}
+        user_ids = {user_id for user_id, _ in wanted}
+
+        messages = {message_id for (message_id,) in (
+            db.session.query(Message.id).filter(Message.id.in_(message_ids)))}
+        users = {user_id for (user_id,) in (
+            db.session.query(User.id).filter(User.id.in_(user_ids)))}
+
+        inserts = [key for key in wanted
+                   if key[0] in users and key[1] in messages]
+
+    now = datetime.utcnow()
+
+    if inserts:
+        db.session.execute(Likes.__table__.insert().values([
+            dict(user_id=user_id, message_id=message_id, created_at=now)
+            for user_id, message_id in inserts
+        ]))
+
+    if deletes:
+        db.session.execute(Likes.__table__
+                           .delete()
+                           .where(key_columns.in_(deletes)))
+
+    deltas = Counter(user_id for user_id, _ in inserts)
+    deltas.subtract(user_id for user_id, _ in deletes)
+
+    # one UPDATE per distinct change, usually just +1
+    by_delta = defaultdict(list)
+
+    for user_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(user_id)
+
+    for delta, user_ids in by_delta.items():
+        counters.adjust(user_ids, likes_count=delta)
+
+
+like_buffer = LikeBuffer()
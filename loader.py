@@ -0,0 +1,239 @@
+"""Streaming bulk loader for seed data.
+
+Loads the CSV files in generator/ a chunk at a time, so memory use doesn't
+grow with the size of the data set. On PostgreSQL each chunk is streamed
+through COPY FROM STDIN, with secondary indexes and foreign keys dropped for
+the load and rebuilt once at the end, all in one transaction. Other
+databases insert each chunk with executemany. Either way sequences are moved
+past the loaded ids and user counters are recomputed afterwards.
+"""
+
+import csv
+import io
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DateTime, Integer, text
+
+import counters
+from models import db
+
+# tables in foreign key order; each is loaded from <name>.csv if it exists
+LOAD_ORDER = ('users', 'messages', 'follows', 'likes')
+
+CHUNK_SIZE = 10000
+
+SECONDARY_INDEXES = text("""
+    SELECT CAST(indexrelid AS regclass), pg_get_indexdef(indexrelid)
+    FROM pg_index
+    WHERE indrelid = CAST(:table AS regclass)
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+""")
+
+FOREIGN_KEYS = text("""
+    SELECT conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'
+""")
+
+
+def chunks(rows, size):
+    """Split an iterable of rows into lists of up to `size` rows."""
+
+    rows = iter(rows)
+
+    while True:
+        chunk = list(islice(rows, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def copy_chunk(connection, table, columns, chunk):
+    """Stream one chunk of CSV rows into `table` with COPY."""
+
+    quote = connection.dialect.identifier_preparer.quote
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {quote(table.name)} "
+                           f"({', '.join(map(quote, columns))}) "
+                           "FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def parser_for(column):
+    """Function converting CSV text to a value for `column`.
+
+    Empty fields become NULL, as they do with COPY.
+    """
+
+    if isinstance(column.type, DateTime):
+        convert = datetime.fromisoformat
+    elif isinstance(column.type, Integer):
+        convert = int
+    else:
+        convert = str
+
+    return lambda value: convert(value) if value != '' else None
+
+
+def insert_chunk(connection, table, columns, chunk):
+    """Insert one chunk of CSV rows into `table` with executemany."""
+
+    parsers = [parser_for(table.c[name]) for name in columns]
+
+    connection.execute(table.insert(), [
+        {name: parse(value)
+         for name, parse, value in zip(columns, parsers, row)}
+        for row in chunk
+    ])
+
+
+def load_table(connection, table, path, chunk_size=CHUNK_SIZE):
+    """Load the CSV file at `path` into `table`; returns the rows loaded.
+
+    The file's header row names the columns, so it may or may not include
+    ids.
+    """
+
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        columns = next(reader)
+
+        if connection.dialect.name == 'postgresql':
+            write = partial(copy_chunk, connection, table, columns)
+        else:
+            write = partial(insert_chunk, connection, table, columns)
+
+        rows = 0
+
+        for chunk in chunks(reader, chunk_size):
+            write(chunk)
+            rows += len(chunk)
+
+    return rows
+
+
+@contextmanager
+def deferred_constraints(connection, tables):
+    """Drop secondary indexes and foreign keys of `tables` until exit.
+
+    Rebuilding each index once over the loaded rows is much faster than
+    updating it row by row. Only PostgreSQL has anything deferred.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        yield
+        return
+
+    quote = connection.dialect.identifier_preparer.quote
+    indexes = []
+    foreign_keys = []
+
+    for table in tables:
+        for name, definition in connection.execute(FOREIGN_KEYS,
+                                                   table=table.name):
+            connection.execute(f"ALTER TABLE {quote(table.name)} "
+                               f"DROP CONSTRAINT {quote(name)}")
+            foreign_keys.append(f"ALTER TABLE {quote(table.name)} "
+                                f"ADD CONSTRAINT {quote(name)} {definition}")
+
+        for name, definition in connection.execute(SECONDARY_INDEXES,
+                                                   table=table.name):
+            connection.execute(f"DROP INDEX {name}")
+            indexes.append(definition)
+
+    yield
+
+    for statement in indexes + foreign_keys:
+        connection.execute(statement)
+
+
+def reset_sequences(connection, tables):
+    """Move id sequences past the largest loaded id."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    quote = connection.dialect.identifier_preparer.quote
+
+    for table in tables:
+        if 'id' in table.c:
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                "coalesce(max(id), 0) + 1, false) "
+                f"FROM {quote(table.name)}"), table=table.name)
+
+
+def load(directory, chunk_size=CHUNK_SIZE, echo=click.echo):
+    """Recreate the tables and load every <table>.csv found in `directory`.
+
+    Returns {table name: rows loaded}.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    paths = {name: os.path.join(directory, f"{name}.csv")
+             for name in LOAD_ORDER}
+    tables = [db.metadata.tables[name] for name, path in paths.items()
+              if os.path.exists(path)]
+    loaded = {}
+
+    with db.engine.begin() as connection:
+        with deferred_constraints(connection, tables):
+            for table in tables:
+                start = time.perf_counter()
+                rows = load_table(connection, table, paths[table.name],
+                                  chunk_size)
+                elapsed = time.perf_counter() - start
+
+                loaded[table.name] = rows
+                echo(f"{table.name}: {rows} rows in {elapsed:.2f}s "
+                     f"({rows / elapsed:,.0f} rows/sec)")
+
+            start = time.perf_counter()
+
+        echo(f"Rebuilt indexes and foreign keys in "
+             f"{time.perf_counter() - start:.2f}s.")
+
+        reset_sequences(connection, tables)
+
+    # bulk loads bypass the views, so fill in the denormalized counters
+    counters.recount()
+
+    return loaded
+
+
+##############################################################################
+# CLI: flask seed load
+
+seed_cli = AppGroup('seed', help="Load sample data.")
+
+
+@seed_cli.command('load')
+@click.argument('directory', default='generator',
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True,
+              help="Rows sent to the database per statement.")
+def load_command(directory, chunk_size):
+    """Recreate the tables and load the CSV files in DIRECTORY."""
+
+    start = time.perf_counter()
+    loaded = load(directory, chunk_size)
+    elapsed = time.perf_counter() - start
+    rows = sum(loaded.values())
+
+    click.echo(f"Loaded {rows} rows in {elapsed:.2f}s "
+               f"({rows / elapsed:,.0f} rows/sec).")
@@ -0,0 +1,241 @@
+"""Per-request performance metrics for Warbler.
+
+Every request records, by endpoint, its wall time, the time spent in and
+number of SQL statements, the rows they returned and the time spent
+rendering templates. They're kept in process as histograms and served from
+/metrics in the Prometheus text format, for a scraper to aggregate. Other
+parts of the app can add their own counters and gauges with add_source().
+
+Statements are timed with engine events and requests with before/teardown
+hooks, so nothing is logged per query.
+"""
+
+import bisect
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SECONDS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNTS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+# name: (help, buckets)
+REQUEST_METRICS = {
+    'warbler_request_seconds': ("Wall time of requests.", SECONDS),
+    'warbler_db_seconds': ("Time spent running SQL, per request.", SECONDS),
+    'warbler_db_queries': ("SQL statements run, per request.", COUNTS),
+    'warbler_db_rows': ("Rows returned by SQL statements, per request.",
+                        COUNTS),
+    'warbler_template_seconds': ("Time spent rendering templates, "
+                                 "per request.", SECONDS),
+}
+
+
+class Histogram:
+    """Counts of observed values by bucket upper bound, plus their sum."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """(cumulative counts by bucket ending with +Inf, sum)."""
+
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+
+        cumulative = []
+        running = 0
+
+        for count in counts:
+            running += count
+            cumulative.append(running)
+
+        return cumulative, total
+
+
+class RequestStats:
+    """What the current request has done so far."""
+
+    __slots__ = ('start', 'db_seconds', 'queries', 'rows',
+                 'template_seconds', 'template_starts', 'query_starts')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_seconds = 0
+        self.queries = 0
+        self.rows = 0
+        self.template_seconds = 0
+        self.template_starts = []
+        self.query_starts = []
+
+
+def current_stats():
+    """Stats of the request being handled, or None outside of one."""
+
+    if has_request_context():
+        return g.get('_request_stats')
+
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+
+    if stats is not None:
+        stats.query_starts.append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+
+    if stats is not None and stats.query_starts:
+        stats.db_seconds += time.perf_counter() - stats.query_starts.pop()
+        stats.queries += 1
+        # drivers report -1 when they can't tell, e.g. SQLite for SELECTs
+        stats.rows += max(cursor.rowcount, 0)
+
+
+def escape(value):
+    return (value
+            .replace('\\', '\\\\')
+            .replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+class Metrics:
+    """Records request metrics and serves them at /metrics.
+
+    Config:
+        METRICS_ENABLED: record and serve metrics (default True)
+    """
+
+    def __init__(self, app=None):
+        self._histograms = {}
+        self._sources = []
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.setdefault('METRICS_ENABLED', True):
+            return
+
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._end_render, app)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+        app.extensions['metrics'] = self
+
+    def histogram(self, name, endpoint):
+        """The histogram of metric `name` for `endpoint`, made if need be."""
+
+        key = (name, endpoint)
+
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(REQUEST_METRICS[name][1])
+
+            return self._histograms[key]
+
+    def add_source(self, source):
+        """Serve the samples `source()` returns along with the histograms.
+
+        A source returns (name, type, help, value) tuples, where type is
+        'counter' or 'gauge'.
+        """
+
+        self._sources.append(source)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def _start(self):
+        g._request_stats = RequestStats()
+
+    def _start_render(self, sender, template, context, **extra):
+        stats = current_stats()
+
+        if stats is not None:
+            stats.template_starts.append(time.perf_counter())
+
+    def _end_render(self, sender, template, context, **extra):
+        stats = current_stats()
+
+        if stats is not None and stats.template_starts:
+            stats.template_seconds += (time.perf_counter()
+                                       - stats.template_starts.pop())
+
+    def _finish(self, exc):
+        stats = g.pop('_request_stats', None)
+        endpoint = request.endpoint
+
+        if stats is None or endpoint == 'metrics':
+            return
+
+        endpoint = endpoint or 'unmatched'
+
+        for name, value in [
+            ('warbler_request_seconds', time.perf_counter() - stats.start),
+            ('warbler_db_seconds', stats.db_seconds),
+            ('warbler_db_queries', stats.queries),
+            ('warbler_db_rows', stats.rows),
+            ('warbler_template_seconds', stats.template_seconds),
+        ]:
+            self.histogram(name, endpoint).observe(value)
+
+    def exposition(self):
+        """Every histogram in the Prometheus text format."""
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+
+        lines = []
+
+        for name, (help_text, buckets) in REQUEST_METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+
+            for (metric, endpoint), histogram in histograms:
+                if metric != name:
+                    continue
+
+                label = f'endpoint="{escape(endpoint)}"'
+                cumulative, total = histogram.snapshot()
+
+                for bound, count in zip([*buckets, '+Inf'], cumulative):
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} '
+                                 f'{count}')
+
+                lines.append(f"{name}_sum{{{label}}} {total}")
+                lines.append(f"{name}_count{{{label}}} {cumulative[-1]}")
+
+        for source in self._sources:
+            for name, kind, help_text, value in source():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+
+        return '\n'.join(lines) + '\n'
+
+    def render(self):
+        return Response(self.exposition(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
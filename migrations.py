@@ -0,0 +1,179 @@
+"""Schema migrations for existing Warbler databases.
+
+db.create_all() builds a new database with the current schema, but leaves
+existing tables as they are. Each migration here brings a PostgreSQL
+database created by an older release up to date. Every migration checks
+what it changes first, so running it again, or on a new database, does
+nothing.
+
+    flask migrate list
+    flask migrate run [NAME...]
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+import counters
+from models import db
+from search import USERNAME_TRIGRAM_DDL
+
+# the app stores naive UTC timestamps; now() is in the server's time zone
+UTC_NOW = "timezone('utc', now())"
+
+# name: (description, steps), in the order they run; a step is SQL, or a
+# function called with the migration's connection
+MIGRATIONS = {
+    'users-updated-at': (
+        "Add users.updated_at, which conditional GETs validate against.",
+        [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at "
+            f"TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT {UTC_NOW}",
+            # columns added by older releases defaulted to local time
+            f"ALTER TABLE users ALTER COLUMN updated_at SET DEFAULT {UTC_NOW}",
+        ],
+    ),
+    'users-counters': (
+        "Add the denormalized user counters and count existing rows.",
+        [lambda connection: add_counters(connection)],
+    ),
+    'likes-composite-key': (
+        "Key likes on (user_id, message_id), so many users can like a "
+        "message.",
+        [
+            """
+            DO $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_name = 'likes'
+                             AND column_name = 'id') THEN
+                    DELETE FROM likes
+                    WHERE user_id IS NULL OR message_id IS NULL;
+
+                    DELETE FROM likes AS duplicate
+                    USING likes AS kept
+                    WHERE duplicate.user_id = kept.user_id
+                      AND duplicate.message_id = kept.message_id
+                      AND duplicate.id > kept.id;
+
+                    ALTER TABLE likes
+                        DROP CONSTRAINT IF EXISTS likes_message_id_key;
+                    ALTER TABLE likes DROP COLUMN id;
+                    ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id);
+                END IF;
+            END
+            $$
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_likes_message_id "
+            "ON likes (message_id)",
+        ],
+    ),
+    'follows-created-at': (
+        "Add follows.created_at, which follow lists are ordered by.",
+        [
+            # existing follows all get the migration's time; the listed
+            # user's id orders them among themselves
+            "ALTER TABLE follows ADD COLUMN IF NOT EXISTS created_at "
+            f"TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT {UTC_NOW}",
+            "ALTER TABLE follows ALTER COLUMN created_at "
+            f"SET DEFAULT {UTC_NOW}",
+            "CREATE INDEX IF NOT EXISTS ix_follows_following_recent "
+            "ON follows (user_following_id, created_at, "
+            "user_being_followed_id)",
+            "CREATE INDEX IF NOT EXISTS ix_follows_followed_recent "
+            "ON follows (user_being_followed_id, created_at, "
+            "user_following_id)",
+        ],
+    ),
+    'likes-created-at': (
+        "Add likes.created_at, which trending scores are rebuilt from.",
+        [
+            "ALTER TABLE likes ADD COLUMN IF NOT EXISTS created_at "
+            f"TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT {UTC_NOW}",
+            f"ALTER TABLE likes ALTER COLUMN created_at SET DEFAULT {UTC_NOW}",
+            "CREATE INDEX IF NOT EXISTS ix_likes_created_at "
+            "ON likes (created_at)",
+        ],
+    ),
+    'messages-recent-indexes': (
+        "Index messages by (timestamp, id), which timelines page by.",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_messages_recent "
+            "ON messages (timestamp, id)",
+            "CREATE INDEX IF NOT EXISTS ix_messages_user_recent "
+            "ON messages (user_id, timestamp, id)",
+        ],
+    ),
+    'users-username-trgm': (
+        "Add the pg_trgm index username search is served by, where the "
+        "extension is available.",
+        [USERNAME_TRIGRAM_DDL],
+    ),
+}
+
+
+def add_counters(connection):
+    """Add the user counter columns, if they're missing, and count them."""
+
+    missing = connection.execute(text(
+        "SELECT NOT EXISTS (SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'users' AND column_name = 'messages_count')"
+    )).scalar()
+
+    if not missing:
+        return
+
+    connection.execute(text("ALTER TABLE users " + ", ".join(
+        f"ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0"
+        for name in counters.COUNTERS)))
+
+    counters.recount(connection)
+
+
+def migrate(names=None, echo=click.echo):
+    """Run the named migrations, or all of them, in one transaction.
+
+    Migrations always run in the order of MIGRATIONS, since later ones may
+    rely on the columns earlier ones add.
+    """
+
+    names = set(names or MIGRATIONS)
+    unknown = names - set(MIGRATIONS)
+
+    if unknown:
+        raise click.BadParameter(f"no such migration: {', '.join(unknown)}")
+
+    with db.engine.begin() as connection:
+        for name in (name for name in MIGRATIONS if name in names):
+            description, steps = MIGRATIONS[name]
+
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(text(step))
+
+            echo(f"Migrated {name}.")
+
+
+##############################################################################
+# CLI: flask migrate list / run
+
+migrate_cli = AppGroup('migrate', help="Bring an existing database's schema "
+                                       "up to date.")
+
+
+@migrate_cli.command('list')
+def list_command():
+    """List the migrations, in the order they run."""
+
+    for name, (description, steps) in MIGRATIONS.items():
+        click.echo(f"{name}: {description}")
+
+
+@migrate_cli.command('run')
+@click.argument('names', nargs=-1)
+def run_command(names):
+    """Run migrations NAMES, or every migration."""
+
+    migrate(names)
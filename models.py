@@ -1,12 +1,67 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
+from functools import cached_property
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import and_, event, func, literal, or_, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import FunctionElement
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import passwords
+
+
+class utcnow(FunctionElement):
+    """The database's current time in UTC, for server defaults of the naive
+    UTC timestamps the app writes with datetime.utcnow()."""
+
+    name = 'utcnow'
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    # now() is in the server's time zone
+    return "timezone('utc', now())"
+
+
+class RoutingSession(SignallingSession):
+    """Sends reads to the replica engine a view was routed to, if any (see
+    replicas.py). Flushes and INSERT/UPDATE/DELETE statements always go to
+    the primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('db_replica') if has_app_context() else None
+
+        if (replica is None or self._flushing
+                or isinstance(clause, UpdateBase)):
+            return super().get_bind(mapper, clause)
+
+        return replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+FollowState = namedtuple('FollowState', 'following followed_by')
+
+# what a like toggle did: whether the like was added or removed, and whether
+# the message is liked now
+Toggle = namedtuple('Toggle', 'changed liked')
 
 
 class Follows(db.Model):
@@ -26,28 +81,173 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    # follow lists page by (created_at, the other user's id); see
+    # pagination.py
+    __table_args__ = (
+        db.Index('ix_follows_following_recent', 'user_following_id',
+                 'created_at', 'user_being_followed_id'),
+        db.Index('ix_follows_followed_recent', 'user_being_followed_id',
+                 'created_at', 'user_following_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
-
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
+    __tablename__ = 'likes'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+        index=True,
     )
 
+    # trending scores are rebuilt from recent likes; see trending.py
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+        index=True,
+    )
+
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set."""
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.message_id)
+                .filter(cls.user_id == user_id,
+                        cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message if this user hasn't, otherwise unlike it.
+
+        Users can't like their own messages. The liker's likes_count moves
+        with the like, in the caller's transaction. Returns a Toggle, or
+        None if there's no such message.
+
+        On PostgreSQL this is one statement: the delete, the insert if
+        nothing was deleted, and the counter update are CTEs of a single
+        SELECT, so concurrent toggles can't both insert.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            return cls._toggle_in_one_statement(user_id, message_id)
+
+        author_id = (db.session
+                     .query(Message.user_id)
+                     .filter(Message.id == message_id)
+                     .scalar())
+
+        if author_id is None:
+            return None
+
+        likes = cls.__table__
+
+        deleted = db.session.execute(
+            likes.delete()
+            .where(likes.c.user_id == user_id)
+            .where(likes.c.message_id == message_id)).rowcount
+
+        if deleted:
+            delta = -1
+        elif author_id != user_id:
+            db.session.execute(likes.insert().values(user_id=user_id,
+                                                     message_id=message_id))
+            delta = 1
+        else:
+            return Toggle(changed=False, liked=False)
+
+        (User
+         .query
+         .filter(User.id == user_id)
+         .update({User.likes_count: User.likes_count + delta},
+                 synchronize_session=False))
+
+        return Toggle(changed=True, liked=delta > 0)
+
+    @classmethod
+    def _toggle_in_one_statement(cls, user_id, message_id):
+        likes = cls.__table__
+        users = User.__table__
+        messages = Message.__table__
+
+        deleted = (likes
+                   .delete()
+                   .where(likes.c.user_id == user_id)
+                   .where(likes.c.message_id == message_id)
+                   .returning(likes.c.message_id)
+                   .cte('deleted'))
+
+        inserted = (postgresql
+                    .insert(likes)
+                    .from_select(['user_id', 'message_id', 'created_at'],
+                                 db.select([literal(user_id),
+                                            messages.c.id,
+                                            literal(datetime.utcnow(),
+                                                    db.DateTime)])
+                                 .where(messages.c.id == message_id)
+                                 .where(messages.c.user_id != user_id)
+                                 .where(~db.exists(deleted.select())))
+                    .on_conflict_do_nothing()
+                    .returning(likes.c.message_id)
+                    .cte('inserted'))
+
+        def count(cte):
+            return db.select([func.count()]).select_from(cte).as_scalar()
+
+        counted = (users
+                   .update()
+                   .where(users.c.id == user_id)
+                   .where(or_(db.exists(deleted.select()),
+                              db.exists(inserted.select())))
+                   .values(likes_count=(users.c.likes_count
+                                        + count(inserted) - count(deleted)))
+                   .returning(users.c.id)
+                   .cte('counted'))
+
+        author_id = (db.select([messages.c.user_id])
+                     .where(messages.c.id == message_id)
+                     .as_scalar())
+
+        author_id, inserted, deleted, _ = db.session.execute(db.select([
+            author_id,
+            db.exists(inserted.select()),
+            db.exists(deleted.select()),
+            count(counted),
+        ])).first()
+
+        if author_id is None:
+            return None
+
+        if inserted or deleted:
+            return Toggle(changed=True, liked=inserted)
+
+        # nothing to delete and nothing inserted: it's the user's own
+        # message, or a concurrent toggle inserted the like first
+        return Toggle(changed=False, liked=author_id != user_id)
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,41 +294,146 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # denormalized counts, maintained by the views; see counters.py
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped by every UPDATE of the row, counters included, so pages about
+    # the user can be validated against it; see caching.py
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    # a user's messages, follows and likes are removed by the database's
+    # ON DELETE CASCADE, not loaded to be deleted one by one
+    messages = db.relationship(
+        'Message',
+        cascade="save-update, merge, delete",
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
 
+    # the columns a user card shows
+    CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                    'location', 'messages_count', 'following_count',
+                    'followers_count', 'likes_count')
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @cached_property
+    def following_ids(self):
+        """Set of ids of the users this user follows.
+
+        Loaded with one query on first use and dropped whenever the
+        instance is expired (e.g. on commit) or `following` changes.
+        """
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id))
+
+        return {user_id for (user_id,) in rows}
+
+    @cached_property
+    def follower_ids(self):
+        """Set of ids of the users following this user (cached likewise)."""
+
+        rows = (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == self.id))
+
+        return {user_id for (user_id,) in rows}
+
+    def follow_state(self, users):
+        """Follow state between this user and each of `users`, in one query.
+
+        Returns FollowState(following, followed_by): the ids among `users`
+        that this user follows, and that follow this user.
+        """
+
+        user_ids = [user.id for user in users]
+        state = FollowState(set(), set())
+
+        if not user_ids:
+            return state
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id,
+                       Follows.user_following_id)
+                .filter(or_(
+                    and_(Follows.user_following_id == self.id,
+                         Follows.user_being_followed_id.in_(user_ids)),
+                    and_(Follows.user_being_followed_id == self.id,
+                         Follows.user_following_id.in_(user_ids)))))
+
+        for followed_id, follower_id in rows:
+            if follower_id == self.id:
+                state.following.add(followed_id)
+            if followed_id == self.id:
+                state.followed_by.add(follower_id)
+
+        return state
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follower_ids
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +442,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -158,14 +463,22 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made with an outdated work factor is replaced on success;
+        the caller's commit saves it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if not user:
+            passwords.reject()
+            return False
+
+        if passwords.verify(user.password, password):
+            if passwords.needs_rehash(user.password):
+                user.password = passwords.rehash(password)
+
+            return user
 
         return False
 
@@ -188,7 +501,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -201,9 +514,85 @@ class Message(db.Model):
 
     likes = db.relationship(
         'User',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
+    )
+
+    # timelines page by (timestamp, id); see pagination.py
+    __table_args__ = (
+        db.Index('ix_messages_recent', 'timestamp', 'id'),
+        db.Index('ix_messages_user_recent', 'user_id', 'timestamp', 'id'),
     )
 
+    # the only author columns a rendered timeline touches
+    AUTHOR_COLUMNS = ('username', 'image_url')
+
+    @classmethod
+    def timeline(cls):
+        """Query for messages as rendered in timelines.
+
+        Authors are joined in with the message rows, loading just the
+        columns the templates show, so a page costs one query no matter
+        how many authors it has.
+        """
+
+        return cls.query.options(
+            joinedload(cls.user, innerjoin=True).load_only(*cls.AUTHOR_COLUMNS))
+
+
+class TimelineEntry(db.Model):
+    """A message fanned out into one user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_owner_recent',
+                 'owner_id', 'timestamp', 'message_id'),
+    )
+
+
+@event.listens_for(User, 'expire')
+@event.listens_for(User, 'refresh')
+def forget_follow_ids(user, *args):
+    """Drop cached follow id sets along with the rest of the instance."""
+
+    # a rollback can expire state whose object was already collected
+    if user is None:
+        return
+
+    user.__dict__.pop('following_ids', None)
+    user.__dict__.pop('follower_ids', None)
+
+
+@event.listens_for(User.following, 'append')
+@event.listens_for(User.following, 'remove')
+def forget_following_ids(user, *args):
+    user.__dict__.pop('following_ids', None)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,144 @@
+"""Keyset (cursor) pagination for message timelines and follow lists.
+
+Pages are keyed on (Message.timestamp, Message.id) rather than an OFFSET,
+so fetching a deep page costs the same as the first one. Views take
+`?before=<cursor>` for older messages and `?after=<cursor>` for newer ones.
+Follow lists are keyed the same way on (Follows.created_at, the listed
+user's id).
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import abort, current_app, request
+from sqlalchemy import asc, desc, literal, tuple_
+from sqlalchemy.orm import Load
+
+from models import db, User, Message, Follows
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class Cursor(namedtuple('Cursor', 'timestamp id')):
+    """Position of a message in a timeline, or of a follow in a list.
+
+    Encoded for URLs as "<microseconds since epoch>-<message id>".
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, message):
+        return cls(message.timestamp, message.id)
+
+    @classmethod
+    def decode(cls, token):
+        """Parse a cursor token, or abort with 400 if it's malformed."""
+
+        try:
+            micros, message_id = token.split('-')
+            return cls(EPOCH + int(micros) * MICROSECOND, int(message_id))
+        except (ValueError, OverflowError):
+            abort(400)
+
+    def encode(self):
+        return f"{(self.timestamp - EPOCH) // MICROSECOND}-{self.id}"
+
+
+Page = namedtuple('Page', 'items older newer')
+Page.__doc__ = """One page of a timeline, newest first.
+
+`older`/`newer` are cursor tokens for the neighbouring pages, or None at the
+ends.
+"""
+
+
+def per_page():
+    return current_app.config.get('MESSAGES_PER_PAGE', 100)
+
+
+def paginate(fetch, limit=None, key=Cursor.of):
+    """Build a Page from the request's `before`/`after` cursor.
+
+    `fetch(cursor, newer, limit)` returns up to `limit` items past `cursor`
+    (or from the newest when `cursor` is None): newer items oldest-first
+    when `newer` is true, older items newest-first otherwise. `key(item)`
+    is the item's Cursor.
+    """
+
+    limit = limit or per_page()
+    before = request.args.get('before')
+    after = request.args.get('after')
+
+    if after:
+        rows = fetch(Cursor.decode(after), True, limit + 1)
+        has_newer, has_older = len(rows) > limit, True
+        items = rows[:limit][::-1]
+
+    else:
+        cursor = Cursor.decode(before) if before else None
+        rows = fetch(cursor, False, limit + 1)
+        has_newer, has_older = cursor is not None, len(rows) > limit
+        items = rows[:limit]
+
+    if not items:
+        return Page(items, None, None)
+
+    return Page(items,
+                older=key(items[-1]).encode() if has_older else None,
+                newer=key(items[0]).encode() if has_newer else None)
+
+
+def keyset(query, cursor, newer, limit,
+           columns=(Message.timestamp, Message.id)):
+    """Apply one keyset page to a query.
+
+    `columns` are the (timestamp, id) columns the cursor is compared with.
+    """
+
+    timestamp, id_ = columns
+    direction = asc if newer else desc
+
+    if cursor is not None:
+        key = tuple_(timestamp, id_)
+        bound = tuple_(literal(cursor.timestamp, db.DateTime),
+                       literal(cursor.id))
+        query = query.filter(key > bound if newer else key < bound)
+
+    return (query
+            .order_by(direction(timestamp), direction(id_))
+            .limit(limit)
+            .all())
+
+
+def paginate_messages(query, limit=None):
+    """Paginate a Message query by the request's cursor."""
+
+    return paginate(lambda cursor, newer, n: keyset(query, cursor, newer, n),
+                    limit)
+
+
+def paginate_follows(listed, owner, owner_id, limit=None):
+    """Page of a follow list, most recent follow first.
+
+    The list is the users in Follows column `listed` of the rows whose
+    `owner` column is `owner_id`, e.g. listed=user_being_followed_id,
+    owner=user_following_id for the users `owner_id` follows. Only the
+    card columns are loaded. Returns a Page of users.
+    """
+
+    query = (db.session
+             .query(User, Follows.created_at)
+             .options(Load(User).load_only(*User.CARD_COLUMNS))
+             .join(Follows, listed == User.id)
+             .filter(owner == owner_id))
+
+    def fetch(cursor, newer, n):
+        return keyset(query, cursor, newer, n,
+                      columns=(Follows.created_at, listed))
+
+    page = paginate(fetch, limit,
+                    key=lambda row: Cursor(row.created_at, row.User.id))
+
+    return page._replace(items=[user for user, _ in page.items])
@@ -0,0 +1,174 @@
+"""Password hashing for Warbler, on a bounded bcrypt executor.
+
+bcrypt is deliberately slow, so hashing runs on a small pool of worker
+threads (bcrypt releases the GIL while it works). At most
+PASSWORD_HASH_WORKERS hashes run at once, and at most PASSWORD_HASH_QUEUE
+more may wait. Past that, PasswordHasherBusy is raised straight away, so a
+burst of logins is shed rather than tying up every request thread.
+
+The work factor comes from BCRYPT_LOG_ROUNDS. Hashes made with a different
+factor are upgraded the next time their owner logs in.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+# metrics key: (name, type, help), served at /metrics
+EXPORTED_METRICS = {
+    'hashed': ('warbler_password_hashes_total', 'counter',
+               "Passwords hashed."),
+    'verified': ('warbler_password_verifications_total', 'counter',
+                 "Passwords checked against their hash."),
+    'rehashed': ('warbler_password_rehashes_total', 'counter',
+                 "Outdated hashes upgraded at login."),
+    'busy': ('warbler_password_busy_total', 'counter',
+             "Hashes refused because the queue was full."),
+    'unknown_user': ('warbler_password_unknown_users_total', 'counter',
+                     "Logins rejected for unknown usernames."),
+    'in_flight': ('warbler_password_in_flight', 'gauge',
+                  "Hashes running or waiting for a worker."),
+    'seconds': ('warbler_password_seconds_total', 'counter',
+                "Time spent hashing and waiting to hash."),
+}
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full."""
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded executor and keeps metrics about it.
+
+    Config:
+        BCRYPT_LOG_ROUNDS: bcrypt work factor (default 12)
+        PASSWORD_HASH_WORKERS: concurrent hashes (default 4)
+        PASSWORD_HASH_QUEUE: hashes allowed to wait for a worker (default 16)
+    """
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._verify_seconds = None
+        self.metrics = dict(hashed=0, verified=0, rehashed=0, busy=0,
+                            unknown_user=0, in_flight=0, seconds=0.0)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        workers = app.config.setdefault('PASSWORD_HASH_WORKERS', 4)
+        queue = app.config.setdefault('PASSWORD_HASH_QUEUE', 16)
+
+        bcrypt.init_app(app)
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        app.extensions['passwords'] = self
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.metrics[name] += amount
+
+    def _run(self, fn, *args):
+        """Run `fn` on the executor and wait for it, if there's room."""
+
+        if self._executor is None:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            self._count('busy')
+            raise PasswordHasherBusy()
+
+        self._count('in_flight')
+        start = time.perf_counter()
+
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+            self._count('in_flight', -1)
+            self._count('seconds', time.perf_counter() - start)
+
+    def hash(self, password):
+        """Hash `password` at the configured work factor."""
+
+        hashed = self._run(bcrypt.generate_password_hash, password,
+                           self.rounds)
+        self._count('hashed')
+        return hashed.decode('UTF-8')
+
+    def verify(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        start = time.perf_counter()
+        is_match = self._run(bcrypt.check_password_hash, hashed, password)
+        self._count('verified')
+
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            if self._verify_seconds is None:
+                self._verify_seconds = elapsed
+            else:
+                self._verify_seconds += (elapsed - self._verify_seconds) / 8
+
+        return is_match
+
+    def rehash(self, password):
+        """Hash `password` again to upgrade an outdated hash."""
+
+        hashed = self.hash(password)
+        self._count('rehashed')
+        return hashed
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<rounds>$<salt and checksum>
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def reject(self):
+        """Fail a login for an unknown user in about the time a check takes.
+
+        Sleeps for the average measured verification time instead of hashing,
+        so unknown usernames cost no bcrypt work and aren't revealed by a
+        faster response. Only the first call, with nothing measured yet,
+        verifies a throwaway hash to take the measurement.
+        """
+
+        self._count('unknown_user')
+
+        if self._verify_seconds is None:
+            self.verify(self.hash('calibration'), 'not the password')
+        else:
+            time.sleep(self._verify_seconds)
+
+    def stats(self):
+        """A snapshot of the hashing metrics."""
+
+        with self._lock:
+            return dict(self.metrics)
+
+    def samples(self):
+        """The hashing metrics, as a source for metrics.add_source()."""
+
+        stats = self.stats()
+
+        return [(name, kind, help_text, stats[key])
+                for key, (name, kind, help_text) in EXPORTED_METRICS.items()]
+
+
+passwords = PasswordHasher()
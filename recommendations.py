@@ -0,0 +1,374 @@
+"""Who-to-follow suggestions from an in-memory copy of the follow graph.
+
+Suggesting friends of friends by joining `follows` to itself reads every
+followed user's follows on each page load. Instead each process keeps the
+graph in compressed sparse row (CSR) form: one array of followed ids,
+grouped by follower, and an array of offsets indexed by follower id, so a
+user's follows are targets[offsets[id]:offsets[id + 1]]. A million follows
+take about 4MB, with no object per follow.
+
+A candidate's score is how many of the people a user follows follow them.
+At most RECOMMENDATIONS_FANOUT follows are visited per user on each hop, so
+a suggestion costs the same for someone following thousands.
+
+Follows and unfollows made through the views are applied on top of the
+arrays straight away. The arrays are rebuilt from the database in a
+background thread once they're RECOMMENDATIONS_MAX_AGE seconds old, or
+once RECOMMENDATIONS_MAX_CHANGES changes have piled up on top of them;
+that's also how other processes' follows arrive.
+
+    flask recommendations bench [--users N] [--edges N]
+"""
+
+import heapq
+import statistics
+import threading
+import time
+from array import array
+from collections import Counter
+from random import Random
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.orm import load_only
+
+from models import db, User, Follows
+
+# rows fetched from the database at a time while building
+LOAD_BATCH_SIZE = 10000
+
+
+class FollowGraph:
+    """Immutable CSR adjacency: follower id -> followed ids."""
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Build from (follower_id, followed_id) pairs sorted by follower."""
+
+        offsets = array('q')
+        targets = array('i')
+
+        for follower_id, followed_id in edges:
+            if follower_id < len(offsets) - 1:
+                raise ValueError("edges must be sorted by follower id")
+
+            # the followers in between follow no one
+            if follower_id >= len(offsets):
+                offsets.extend([len(targets)] * (follower_id + 1
+                                                 - len(offsets)))
+
+            targets.append(followed_id)
+
+        offsets.append(len(targets))
+        return cls(offsets, targets)
+
+    @classmethod
+    def load(cls):
+        """Build from the follows table."""
+
+        rows = (db.session
+                .query(Follows.user_following_id,
+                       Follows.user_being_followed_id)
+                .order_by(Follows.user_following_id)
+                .yield_per(LOAD_BATCH_SIZE))
+
+        return cls.from_edges(rows)
+
+    def __len__(self):
+        return len(self.targets)
+
+    @property
+    def nbytes(self):
+        return (len(self.offsets) * self.offsets.itemsize
+                + len(self.targets) * self.targets.itemsize)
+
+    def follows(self, user_id, limit=None):
+        """Ids `user_id` follows; at most `limit`, evenly spread over them."""
+
+        if user_id + 1 >= len(self.offsets):
+            return array('i')
+
+        start, end = self.offsets[user_id], self.offsets[user_id + 1]
+        step = -(-(end - start) // limit) if limit else 1
+
+        return self.targets[start:end:max(step, 1)]
+
+
+def suggest(follows, user_id, count, fanout):
+    """Top `count` users for `user_id` to follow, as (user_id, mutuals).
+
+    `follows(user_id, limit)` returns the ids a user follows, sampled down
+    to `limit` when given. Mutuals are how many of the sampled users
+    `user_id` follows follow the candidate; ties go to the lower id.
+    """
+
+    following = set(follows(user_id, None))
+    scores = Counter()
+
+    for followed_id in follows(user_id, fanout):
+        scores.update(follows(followed_id, fanout))
+
+    for followed_id in following | {user_id}:
+        scores.pop(followed_id, None)
+
+    return heapq.nlargest(count, scores.items(),
+                          key=lambda item: (item[1], -item[0]))
+
+
+class Recommendations:
+    """Keeps each process's follow graph and serves suggestions from it.
+
+    Config:
+        RECOMMENDATIONS: show who-to-follow on the homepage (default off,
+            since every process holds the whole graph)
+        RECOMMENDATIONS_COUNT: suggestions shown (default 5)
+        RECOMMENDATIONS_FANOUT: follows visited per user per hop
+            (default 100)
+        RECOMMENDATIONS_MAX_AGE: seconds before the graph is rebuilt
+            (default 600)
+        RECOMMENDATIONS_MAX_CHANGES: follow changes kept on top of the
+            graph before it's rebuilt (default 10000)
+    """
+
+    def __init__(self, app=None, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        # held while the graph loads, so only one load runs at a time
+        self._build_lock = threading.Lock()
+        self.clear()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RECOMMENDATIONS', False)
+        app.config.setdefault('RECOMMENDATIONS_COUNT', 5)
+        app.config.setdefault('RECOMMENDATIONS_FANOUT', 100)
+        app.config.setdefault('RECOMMENDATIONS_MAX_AGE', 600)
+        app.config.setdefault('RECOMMENDATIONS_MAX_CHANGES', 10000)
+        app.extensions['recommendations'] = self
+        app.cli.add_command(recommendations_cli)
+
+    @property
+    def enabled(self):
+        return current_app.config['RECOMMENDATIONS']
+
+    def clear(self):
+        """Forget the graph; the next suggestion reloads it."""
+
+        with self._lock:
+            self._graph = None
+            self._built = None
+            self._rebuilding = False
+            self._loading = False
+            # (follower_id, followed_id, following) applied since the
+            # graph's rows were read, and the same by follower
+            self._changes = []
+            self._overlay = {}
+
+    def rebuild(self):
+        """Reload the graph from the database, keeping the changes made
+        while it loads."""
+
+        with self._build_lock:
+            self._load()
+
+    def _load(self):
+        """Load the graph; call with the build lock held."""
+
+        with self._lock:
+            since = len(self._changes)
+            self._loading = True
+
+        try:
+            graph = FollowGraph.load()
+        except Exception:
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            self._graph = graph
+            self._loading = False
+            self._built = self.clock()
+            self._changes = self._changes[since:]
+            self._overlay = {}
+
+            for change in self._changes:
+                self._apply(*change)
+
+    def _apply(self, follower_id, followed_id, following):
+        self._overlay.setdefault(follower_id, {})[followed_id] = following
+
+    def _change(self, follower_id, followed_ids, following):
+        with self._lock:
+            # a graph that isn't loading yet will read these from the
+            # table; one that is may have read it already
+            if self._graph is None and not self._loading:
+                return
+
+            for followed_id in followed_ids:
+                self._changes.append((follower_id, followed_id, following))
+                self._apply(follower_id, followed_id, following)
+
+    def followed(self, follower_id, followed_ids):
+        """Record committed follows."""
+
+        self._change(follower_id, followed_ids, True)
+
+    def unfollowed(self, follower_id, followed_ids):
+        """Record committed unfollows."""
+
+        self._change(follower_id, followed_ids, False)
+
+    def _follows(self, user_id, limit):
+        ids = self._graph.follows(user_id, limit)
+        changes = self._overlay.get(user_id)
+
+        if not changes:
+            return ids
+
+        ids = set(ids)
+
+        for followed_id, following in changes.items():
+            if following:
+                ids.add(followed_id)
+            else:
+                ids.discard(followed_id)
+
+        return ids
+
+    def _refresh(self):
+        """Load the graph if there's none; start rebuilding it if it's
+        stale."""
+
+        config = current_app.config
+
+        if self._graph is None:
+            with self._build_lock:
+                # another request may have loaded it while this one waited
+                if self._graph is None:
+                    self._load()
+
+            return
+
+        with self._lock:
+            stale = (self.clock() - self._built
+                     >= config['RECOMMENDATIONS_MAX_AGE']
+                     or len(self._changes)
+                     >= config['RECOMMENDATIONS_MAX_CHANGES'])
+
+            if not stale or self._rebuilding:
+                return
+
+            self._rebuilding = True
+
+        app = current_app._get_current_object()
+        threading.Thread(target=self._rebuild_in_background, args=(app,),
+                         daemon=True).start()
+
+    def _rebuild_in_background(self, app):
+        with app.app_context():
+            try:
+                self.rebuild()
+            finally:
+                db.session.remove()
+
+                with self._lock:
+                    self._rebuilding = False
+
+    def suggest(self, user_id, count=None):
+        """Top users for `user_id` to follow, as (user_id, mutuals)."""
+
+        config = current_app.config
+        self._refresh()
+
+        with self._lock:
+            return suggest(self._follows, user_id,
+                           count or config['RECOMMENDATIONS_COUNT'],
+                           config['RECOMMENDATIONS_FANOUT'])
+
+    def suggested_users(self, user):
+        """Suggestions for `user`, as (User, mutuals) with card columns
+        loaded; one query, none if there are no suggestions."""
+
+        mutuals = dict(self.suggest(user.id))
+
+        if not mutuals:
+            return []
+
+        users = (User.query
+                 .options(load_only(*User.CARD_COLUMNS))
+                 .filter(User.id.in_(mutuals)))
+
+        return sorted(((user, mutuals[user.id]) for user in users),
+                      key=lambda pair: (-pair[1], pair[0].id))
+
+
+recommendations = Recommendations()
+
+
+##############################################################################
+# CLI: flask recommendations bench
+
+recommendations_cli = AppGroup('recommendations',
+                               help="Who-to-follow suggestions.")
+
+
+def random_edges(users, edges, rng):
+    """About `edges` distinct random follows among `users` users, sorted by
+    follower. Popularity is skewed, so a few users have many followers."""
+
+    per_user = edges // users
+
+    for follower_id in range(1, users + 1):
+        followed = {int(users * rng.random() ** 2) + 1
+                    for _ in range(per_user)}
+        followed.discard(follower_id)
+
+        for followed_id in sorted(followed):
+            yield follower_id, followed_id
+
+
+@recommendations_cli.command('bench')
+@click.option('--users', default=100000, show_default=True,
+              type=click.IntRange(min=2))
+@click.option('--edges', default=1000000, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--queries', default=1000, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--seed', 'random_seed', default=0, show_default=True)
+def bench_command(users, edges, queries, random_seed):
+    """Time building a random follow graph and suggesting from it.
+
+    Doesn't touch the database.
+    """
+
+    config = current_app.config
+    rng = Random(random_seed)
+
+    start = time.perf_counter()
+    graph = FollowGraph.from_edges(random_edges(users, edges, rng))
+    built = time.perf_counter() - start
+
+    click.echo(f"Built {len(graph)} follows among {users} users in "
+               f"{built:.2f}s, {graph.nbytes / 2**20:.1f}MB.")
+
+    latencies = []
+
+    for _ in range(queries):
+        user_id = rng.randint(1, users)
+        start = time.perf_counter()
+        suggest(graph.follows, user_id, config['RECOMMENDATIONS_COUNT'],
+                config['RECOMMENDATIONS_FANOUT'])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+
+    click.echo(f"Suggested for {queries} users: p50 {cuts[49]:.2f}ms, "
+               f"p99 {cuts[98]:.2f}ms, max {max(latencies):.2f}ms.")
@@ -0,0 +1,235 @@
+"""Read replicas for Warbler.
+
+Views wrapped in replicas.read_only run their queries on a read replica,
+when SQLALCHEMY_REPLICA_URIS lists any; every other view, and every write,
+uses SQLALCHEMY_DATABASE_URI as before. The session does the routing (see
+models.RoutingSession), so the views themselves don't change.
+
+A replica is read from only while its replication lag is within
+REPLICA_MAX_LAG seconds. Each process checks each replica's lag at most
+every REPLICA_LAG_CHECK_INTERVAL seconds; one that's behind, or can't be
+reached, is skipped until its next check, and with none left the view reads
+from the primary.
+
+Users always see their own writes: after a POST, PUT, PATCH or DELETE their
+session keeps them reading from the primary for REPLICA_MAX_LAG plus
+REPLICA_LAG_CHECK_INTERVAL seconds, by which time the replicas have caught
+up. Other users may see a write up to that late.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context, request, session
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+STICKY_KEY = 'primary_until'
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# seconds behind the primary; 0 on a database that isn't a standby, or a
+# standby that has replayed everything it received, and NULL on one that
+# hasn't replayed anything yet
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery()
+            OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+# key: (name, type, help)
+EXPORTED_METRICS = {
+    'replica': ('warbler_replica_reads_total', 'counter',
+                "Read-only views served from a replica."),
+    'sticky': ('warbler_replica_sticky_total', 'counter',
+               "Read-only views served from the primary after the user's "
+               "own write."),
+    'lagging': ('warbler_replica_lagging_total', 'counter',
+                "Read-only views served from the primary because no "
+                "replica was within REPLICA_MAX_LAG."),
+}
+
+
+class Replicas:
+    """Picks the database read-only views read from.
+
+    Config:
+        SQLALCHEMY_REPLICA_URIS: database URIs of the read replicas
+            (default none)
+        REPLICA_MAX_LAG: seconds a replica may be behind and still be read
+            from (default 5)
+        REPLICA_LAG_CHECK_INTERVAL: seconds between checks of a replica's
+            lag (default 10)
+    """
+
+    def __init__(self, app=None, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._engines = {}
+        # uri: (lag in seconds, when it was checked)
+        self._lags = {}
+        self._counts = dict.fromkeys(EXPORTED_METRICS, 0)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_MAX_LAG', 5)
+        app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 10)
+        app.after_request(self._stick)
+        app.extensions['replicas'] = self
+
+    def clear(self):
+        """Forget the checked lags and close the replicas' connections."""
+
+        with self._lock:
+            engines, self._engines = self._engines, {}
+            self._lags = {}
+
+        for engine in engines.values():
+            engine.dispose()
+
+    def engine(self, uri):
+        """The engine for the replica at `uri`, made on first use."""
+
+        with self._lock:
+            engine = self._engines.get(uri)
+
+            if engine is None:
+                engine = self._engines[uri] = create_engine(
+                    uri,
+                    **current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+        return engine
+
+    @staticmethod
+    def measure_lag(engine):
+        """Seconds the replica is behind its primary, or None if it can't
+        tell yet."""
+
+        # only PostgreSQL replicates; any other database is a copy made
+        # for testing
+        if engine.dialect.name != 'postgresql':
+            return 0
+
+        with engine.connect() as connection:
+            lag = connection.execute(text(LAG_SQL)).scalar()
+
+        return None if lag is None else float(lag)
+
+    def lag(self, uri):
+        """The replica's lag as last checked, checked again first if that
+        was REPLICA_LAG_CHECK_INTERVAL seconds ago. A replica that can't be
+        reached, or can't tell, is infinitely far behind."""
+
+        now = self.clock()
+
+        with self._lock:
+            lag, checked = self._lags.get(uri, (float('inf'), None))
+
+            if (checked is not None and now - checked
+                    < current_app.config['REPLICA_LAG_CHECK_INTERVAL']):
+                return lag
+
+            # other requests use the last lag while this one checks
+            self._lags[uri] = (lag, now)
+
+        try:
+            lag = self.measure_lag(self.engine(uri))
+        except SQLAlchemyError:
+            current_app.logger.warning("Checking a read replica's lag "
+                                       "failed.", exc_info=True)
+            lag = None
+
+        if lag is None:
+            lag = float('inf')
+
+        with self._lock:
+            self._lags[uri] = (lag, now)
+
+        return lag
+
+    def choose(self):
+        """The engine of a replica to read from, or None for the
+        primary."""
+
+        config = current_app.config
+        uris = config['SQLALCHEMY_REPLICA_URIS']
+
+        if not uris:
+            return None
+
+        if session.get(STICKY_KEY, 0) > self.clock():
+            self._count('sticky')
+            return None
+
+        fresh = [uri for uri in uris
+                 if self.lag(uri) <= config['REPLICA_MAX_LAG']]
+
+        if not fresh:
+            self._count('lagging')
+            return None
+
+        self._count('replica')
+        return self.engine(random.choice(fresh))
+
+    def read_only(self, view):
+        """Decorate a view that only reads to read from a replica."""
+
+        @wraps(view)
+        def wrapper(**kwargs):
+            if request.method in SAFE_METHODS:
+                g.db_replica = self.choose()
+
+            try:
+                return view(**kwargs)
+            finally:
+                g.pop('db_replica', None)
+
+        return wrapper
+
+    def _stick(self, response):
+        config = current_app.config
+
+        if (config['SQLALCHEMY_REPLICA_URIS']
+                and request.method not in SAFE_METHODS):
+            session[STICKY_KEY] = (self.clock() + config['REPLICA_MAX_LAG']
+                                   + config['REPLICA_LAG_CHECK_INTERVAL'])
+
+        return response
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def samples(self):
+        """The routing metrics, as a source for metrics.add_source()."""
+
+        with self._lock:
+            counts = dict(self._counts)
+
+        return [(name, kind, help_text, counts[key])
+                for key, (name, kind, help_text) in EXPORTED_METRICS.items()]
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block, as a write that depends on
+    what it reads must."""
+
+    replica = g.pop('db_replica', None) if has_app_context() else None
+
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+
+
+replicas = Replicas()
@@ -0,0 +1,410 @@
+"""Username search for the /users directory, and full-text message search.
+
+Username matches are case-insensitive substrings, ranked exact match first,
+then prefix matches, then the rest, and paged by keyset on (rank, username)
+so a large user table is never read in full. On PostgreSQL the match is
+served by a pg_trgm GIN index; on SQLite by an FTS5 trigram table that
+triggers keep in step with `users`.
+
+Message search matches words, ranked by relevance and paged by keyset on
+(rank, id). On PostgreSQL it's served by a generated tsvector column with a
+GIN index; other databases use an in-memory inverted index.
+"""
+
+import math
+import re
+import threading
+from collections import defaultdict, namedtuple
+
+import click
+from flask import abort, current_app
+from flask.cli import AppGroup
+from sqlalchemy import (DDL, REAL, case, cast, column, event, func, literal,
+                        literal_column, table, text, tuple_)
+from sqlalchemy.orm import load_only
+
+from models import db, User, Message
+
+EXACT, PREFIX, SUBSTRING = 0, 1, 2
+
+
+##############################################################################
+# Indexes
+
+# also run by the users-username-trgm migration, for existing databases
+USERNAME_TRIGRAM_DDL = """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions
+                   WHERE name = 'pg_trgm') THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+                ON users USING gin (username gin_trgm_ops);
+        END IF;
+    END $$
+"""
+
+event.listen(User.__table__, 'after_create',
+             DDL(USERNAME_TRIGRAM_DDL).execute_if(dialect='postgresql'))
+
+users_trgm = table('users_username_trgm', column('rowid'), column('username'))
+
+SQLITE_TRIGRAM_DDL = [
+    """CREATE VIRTUAL TABLE users_username_trgm USING fts5(
+           username, content='users', content_rowid='id', tokenize='trigram')""",
+    """CREATE TRIGGER users_username_trgm_ai AFTER INSERT ON users BEGIN
+           INSERT INTO users_username_trgm (rowid, username)
+           VALUES (new.id, new.username);
+       END""",
+    """CREATE TRIGGER users_username_trgm_ad AFTER DELETE ON users BEGIN
+           INSERT INTO users_username_trgm (users_username_trgm, rowid, username)
+           VALUES ('delete', old.id, old.username);
+       END""",
+    """CREATE TRIGGER users_username_trgm_au AFTER UPDATE OF username ON users
+       BEGIN
+           INSERT INTO users_username_trgm (users_username_trgm, rowid, username)
+           VALUES ('delete', old.id, old.username);
+           INSERT INTO users_username_trgm (rowid, username)
+           VALUES (new.id, new.username);
+       END""",
+]
+
+for statement in SQLITE_TRIGRAM_DDL:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+event.listen(User.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS users_username_trgm")
+             .execute_if(dialect='sqlite'))
+
+
+# kept up to date by PostgreSQL on every insert or edit of a message
+MESSAGE_SEARCH_DDL = [
+    """ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+           GENERATED ALWAYS AS (to_tsvector('english', text)) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_messages_search_vector
+           ON messages USING gin (search_vector)""",
+]
+
+for statement in MESSAGE_SEARCH_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+
+##############################################################################
+# Queries
+
+class UserCursor(namedtuple('UserCursor', 'rank username')):
+    """Position in a ranked listing, encoded as "<rank>:<username>"."""
+
+    __slots__ = ()
+
+    @classmethod
+    def decode(cls, token):
+        """Parse a cursor token, or abort with 400 if it's malformed."""
+
+        rank, sep, username = token.partition(':')
+
+        if not sep or not rank.isdigit():
+            abort(400)
+
+        return cls(int(rank), username)
+
+    def encode(self):
+        return f"{self.rank}:{self.username}"
+
+
+def escape_like(search):
+    """Escape LIKE wildcards so `search` matches literally."""
+
+    return (search
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def matching(search):
+    """Clause matching users whose username contains `search`."""
+
+    pattern = f"%{escape_like(search)}%"
+
+    if db.engine.dialect.name == 'sqlite':
+        matches = (db.select([users_trgm.c.rowid])
+                   .where(users_trgm.c.username.like(pattern, escape='\\')))
+        return User.id.in_(matches)
+
+    return User.username.ilike(pattern, escape='\\')
+
+
+def ranking(search):
+    """Exact matches first, then prefix matches, then substrings."""
+
+    return case([
+        (func.lower(User.username) == search.lower(), EXACT),
+        (User.username.ilike(f"{escape_like(search)}%", escape='\\'), PREFIX),
+    ], else_=SUBSTRING)
+
+
+def search_users(search, after=None, limit=None):
+    """A page of users whose username contains `search`.
+
+    With no `search`, pages through every user by username. Returns
+    (users, cursor token for the next page or None).
+    """
+
+    limit = limit or current_app.config.get('USERS_PER_PAGE', 30)
+    query = User.query.options(load_only(*User.CARD_COLUMNS))
+
+    if search:
+        rank = ranking(search)
+        query = query.filter(matching(search))
+
+        if after:
+            query = query.filter(tuple_(rank, User.username)
+                                 > tuple_(literal(after.rank),
+                                          literal(after.username)))
+
+        rows = (query
+                .add_columns(rank)
+                .order_by(rank, User.username)
+                .limit(limit + 1)
+                .all())
+
+    else:
+        if after:
+            query = query.filter(User.username > after.username)
+
+        rows = [(user, EXACT) for user
+                in query.order_by(User.username).limit(limit + 1)]
+
+    users = [user for user, _ in rows[:limit]]
+
+    if len(rows) <= limit:
+        return users, None
+
+    last_user, last_rank = rows[limit - 1]
+    return users, UserCursor(last_rank, last_user.username).encode()
+
+
+##############################################################################
+# Message search
+
+search_vector = literal_column('messages.search_vector')
+
+
+class MessageCursor(namedtuple('MessageCursor', 'rank id')):
+    """Position in ranked search results, encoded as "<rank>:<id>"."""
+
+    __slots__ = ()
+
+    @classmethod
+    def decode(cls, token):
+        """Parse a cursor token, or abort with 400 if it's malformed."""
+
+        rank, sep, message_id = token.partition(':')
+
+        try:
+            return cls(float(rank), int(message_id))
+        except ValueError:
+            abort(400)
+
+    def encode(self):
+        return f"{self.rank!r}:{self.id}"
+
+
+def words(text):
+    """The lowercased words of `text`, as the in-memory index sees them."""
+
+    return re.findall(r'\w+', text.lower())
+
+
+class MessageIndex:
+    """In-memory inverted index of message words, for databases without
+    full-text search.
+
+    It's built from the messages table on first use and kept in step by the
+    mapper events below, so rows written with bulk statements after that
+    aren't seen until the index is rebuilt. Words are matched exactly, with
+    no stemming or stop words, and ranked by tf-idf.
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._messages = {}
+        self._lock = threading.Lock()
+
+    def add(self, message_id, author_id, text):
+        counts = defaultdict(int)
+
+        for word in words(text):
+            counts[word] += 1
+
+        with self._lock:
+            self._discard(message_id)
+            self._messages[message_id] = (author_id, counts)
+
+            for word, count in counts.items():
+                self._postings[word][message_id] = count
+
+    def _discard(self, message_id):
+        author_id, counts = self._messages.pop(message_id, (None, {}))
+
+        for word in counts:
+            postings = self._postings[word]
+            postings.pop(message_id, None)
+
+            if not postings:
+                del self._postings[word]
+
+    def discard(self, message_id):
+        with self._lock:
+            self._discard(message_id)
+
+    def rebuild(self):
+        """Reload the index from the messages table."""
+
+        with self._lock:
+            self._postings.clear()
+            self._messages.clear()
+
+        rows = (db.session.query(Message.id, Message.user_id, Message.text)
+                .yield_per(1000))
+
+        for message_id, author_id, text in rows:
+            self.add(message_id, author_id, text)
+
+    def search(self, search, author_id=None, after=None, limit=None):
+        """Up to `limit` (rank, message id) matches for every word of
+        `search`, best first, past the `after` cursor."""
+
+        terms = set(words(search))
+
+        if not terms:
+            return []
+
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            total = len(self._messages)
+
+            ids = set.intersection(*(set(posting) for posting in postings))
+
+            if author_id is not None:
+                ids = {message_id for message_id in ids
+                       if self._messages[message_id][0] == author_id}
+
+            idfs = [math.log(1 + total / len(posting)) for posting in postings
+                    if posting]
+            ranked = [(sum(posting[message_id] * idf
+                           for posting, idf in zip(postings, idfs)),
+                       message_id)
+                      for message_id in ids]
+
+        if after:
+            ranked = [match for match in ranked if match < tuple(after)]
+
+        ranked.sort(reverse=True)
+        return ranked[:limit]
+
+
+# in-memory indexes, by engine, built on first search
+message_indexes = {}
+message_indexes_lock = threading.Lock()
+
+
+def message_index():
+    """The in-memory index for the current database, built if need be."""
+
+    engine = db.engine
+
+    with message_indexes_lock:
+        index = message_indexes.get(engine)
+
+        if index is None:
+            index = message_indexes[engine] = MessageIndex()
+            index.rebuild()
+
+    return index
+
+
+@event.listens_for(Message, 'after_insert')
+@event.listens_for(Message, 'after_update')
+def index_message(mapper, connection, message):
+    index = message_indexes.get(connection.engine)
+
+    if index is not None:
+        index.add(message.id, message.user_id, message.text)
+
+
+@event.listens_for(Message, 'after_delete')
+def unindex_message(mapper, connection, message):
+    index = message_indexes.get(connection.engine)
+
+    if index is not None:
+        index.discard(message.id)
+
+
+def search_messages(search, author_id=None, after=None, limit=None):
+    """A page of messages matching every word of `search`, best first.
+
+    Optionally only messages by `author_id`. Returns (messages, cursor token
+    for the next page or None).
+    """
+
+    limit = limit or current_app.config.get('MESSAGES_PER_PAGE', 100)
+
+    if db.engine.dialect.name == 'postgresql':
+        tsquery = func.websearch_to_tsquery('english', search)
+        rank = func.ts_rank(search_vector, tsquery)
+        query = Message.timeline().filter(search_vector.op('@@')(tsquery))
+
+        if author_id is not None:
+            query = query.filter(Message.user_id == author_id)
+
+        if after:
+            # ts_rank() is a real; compare as one so the cursor's rank
+            # round-trips exactly
+            query = query.filter(tuple_(rank, Message.id)
+                                 < tuple_(cast(literal(after.rank), REAL),
+                                          literal(after.id)))
+
+        rows = (query
+                .add_columns(rank)
+                .order_by(rank.desc(), Message.id.desc())
+                .limit(limit + 1)
+                .all())
+
+    else:
+        matches = message_index().search(search, author_id, after, limit + 1)
+        messages = {message.id: message for message in (
+            Message.timeline()
+            .filter(Message.id.in_([message_id for _, message_id in matches]))
+        )}
+        rows = [(messages[message_id], rank) for rank, message_id in matches
+                if message_id in messages]
+
+    messages = [message for message, _ in rows[:limit]]
+
+    if len(rows) <= limit:
+        return messages, None
+
+    last_message, last_rank = rows[limit - 1]
+    return messages, MessageCursor(last_rank, last_message.id).encode()
+
+
+search_cli = AppGroup('search', help="Manage full-text message search.")
+
+
+@search_cli.command('install')
+def install():
+    """Add the message search column and index to an existing database."""
+
+    if db.engine.dialect.name != 'postgresql':
+        click.echo("Only PostgreSQL stores a search index; "
+                   "others index messages in memory.")
+        return
+
+    for statement in MESSAGE_SEARCH_DDL:
+        db.session.execute(text(statement))
+
+    db.session.commit()
+    click.echo("Message search index installed.")
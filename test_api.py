@@ -0,0 +1,207 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import QueryCounter
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APITestCase(TestCase):
+    """Test the batch and timeline endpoints."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ('me', 'ann', 'bob', 'cat')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        messages = [Message(user_id=user.id, text=f"{user.username} says hi")
+                    for user in users[1:]]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.me_id, *self.other_ids = [user.id for user in users]
+        self.message_ids = [message.id for message in messages]
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.me_id
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+
+    def user(self, user_id):
+        db.session.expire_all()
+        return User.query.get(user_id)
+
+
+    def test_follow_batch(self):
+        """Are several users followed at once, with counters in step?"""
+
+        resp = self.client.post('/api/v1/follows',
+                                json={'user_ids': [*self.other_ids,
+                                                   self.me_id, 99999]})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sorted(resp.json['followed']), sorted(self.other_ids))
+        self.assertEqual(self.user(self.me_id).following_count, 3)
+        self.assertEqual(self.user(self.other_ids[0]).followers_count, 1)
+
+        # following again changes nothing
+        resp = self.client.post('/api/v1/follows',
+                                json={'user_ids': self.other_ids})
+        self.assertEqual(resp.json['followed'], [])
+
+        resp = self.client.delete('/api/v1/follows',
+                                  json={'user_ids': self.other_ids[:2]})
+
+        self.assertEqual(sorted(resp.json['unfollowed']),
+                         sorted(self.other_ids[:2]))
+        self.assertEqual(self.user(self.me_id).following_count, 1)
+        self.assertEqual(self.user(self.other_ids[0]).followers_count, 0)
+
+
+    def test_like_batch(self):
+        """Are several messages liked and unliked at once?"""
+
+        resp = self.client.post('/api/v1/likes',
+                                json={'message_ids': self.message_ids})
+
+        self.assertEqual(sorted(resp.json['liked']), sorted(self.message_ids))
+        self.assertEqual(self.user(self.me_id).likes_count, 3)
+
+        resp = self.client.delete('/api/v1/likes',
+                                  json={'message_ids': self.message_ids})
+
+        self.assertEqual(sorted(resp.json['unliked']), sorted(self.message_ids))
+        self.assertEqual(self.user(self.me_id).likes_count, 0)
+
+
+    def test_batch_statements(self):
+        """Does a batch run the same statements whatever its size?"""
+
+        # the first request caches the logged-in user
+        self.client.get('/api/v1/users')
+        counts = []
+
+        for ids in (self.other_ids[:1], self.other_ids[1:]):
+            with QueryCounter() as counter:
+                self.client.post('/api/v1/follows', json={'user_ids': ids})
+
+            counts.append(len(counter))
+
+        self.assertEqual(counts[0], counts[1])
+
+
+    def test_fetch_users(self):
+        """Are users returned in the order asked for, with follow state?"""
+
+        self.client.post('/api/v1/follows',
+                         json={'user_ids': [self.other_ids[1]]})
+
+        ids = [self.other_ids[1], self.other_ids[0]]
+        resp = self.client.get(f"/api/v1/users?ids={ids[0]},{ids[1]},99999")
+        users = resp.json['users']
+
+        self.assertEqual([user['id'] for user in users], ids)
+        self.assertEqual([user['following'] for user in users], [True, False])
+        self.assertNotIn('password', users[0])
+        self.assertNotIn('email', users[0])
+
+
+    def test_timeline(self):
+        """Is the home timeline paged by cursor, with authors listed once?"""
+
+        self.client.post('/api/v1/follows', json={'user_ids': self.other_ids})
+
+        resp = self.client.get('/api/v1/timeline?limit=2')
+        page = resp.json
+
+        self.assertEqual(len(page['messages']), 2)
+        self.assertEqual(len(page['users']), 2)
+        self.assertIsNone(page['newer'])
+        self.assertIsNotNone(page['older'])
+
+        page = self.client.get(f"/api/v1/timeline?limit=2"
+                               f"&before={page['older']}").json
+
+        self.assertEqual(len(page['messages']), 1)
+        self.assertIsNone(page['older'])
+
+
+    def test_user_messages(self):
+        """Are a user's messages marked with the viewer's likes?"""
+
+        self.client.post('/api/v1/likes',
+                         json={'message_ids': self.message_ids[:1]})
+
+        page = self.client.get(
+            f"/api/v1/users/{self.other_ids[0]}/messages").json
+
+        self.assertEqual([msg['liked'] for msg in page['messages']], [True])
+
+        page = self.client.get(f"/api/v1/users/{self.me_id}/likes").json
+        self.assertEqual([msg['id'] for msg in page['messages']],
+                         self.message_ids[:1])
+
+
+    def test_errors(self):
+        """Are bad requests answered in JSON?"""
+
+        resp = self.client.post('/api/v1/follows',
+                                data={'user_ids': self.other_ids})
+        self.assertEqual(resp.status_code, 415)
+
+        resp = self.client.post('/api/v1/follows', json={'user_ids': 'all'})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('error', resp.json)
+
+        app.config['API_BATCH_LIMIT'] = 2
+
+        try:
+            resp = self.client.post('/api/v1/follows',
+                                    json={'user_ids': self.other_ids})
+        finally:
+            app.config['API_BATCH_LIMIT'] = 100
+
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.get('/api/v1/timeline?before=nonsense')
+        self.assertEqual(resp.status_code, 400)
+
+
+    def test_logged_out(self):
+        """Do writes and the home timeline need a login?"""
+
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+
+        resp = self.client.post('/api/v1/likes',
+                                json={'message_ids': self.message_ids})
+        self.assertEqual(resp.status_code, 401)
+
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 401)
@@ -0,0 +1,95 @@
+"""Route benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bench.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from bench import ROUTES, run, compare, percentile
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BenchTestCase(TestCase):
+    """Test the benchmark harness on a tiny data set."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="HASHED_PASSWORD")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        db.session.add_all([Message(user_id=user.id, text="hello")
+                            for user in users])
+        db.session.commit()
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_percentile(self):
+        """Is the nearest-rank percentile used?"""
+
+        ordered = list(range(1, 101))
+
+        self.assertEqual(percentile(ordered, 50), 50)
+        self.assertEqual(percentile(ordered, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+
+    def test_run(self):
+        """Is every route measured, in both modes, without errors?"""
+
+        results = run(ROUTES, requests=4, concurrency=2)
+
+        self.assertEqual(list(results), [route.name for route in ROUTES])
+
+        for name, modes in results.items():
+            for mode in ('single', 'concurrent'):
+                stats = modes[mode]
+
+                self.assertEqual(stats['requests'], 4, name)
+                self.assertEqual(stats['errors'], 0, name)
+                self.assertGreater(stats['sql'], 0, name)
+                self.assertLessEqual(stats['p50'], stats['p99'], name)
+
+
+    def test_uneven_split(self):
+        """Are requests that don't divide evenly between threads all made?"""
+
+        results = run(ROUTES[:1], requests=3, concurrency=8)
+
+        self.assertEqual(results[ROUTES[0].name]['concurrent']['requests'], 3)
+
+
+    def test_compare(self):
+        """Are only changes past the tolerance reported?"""
+
+        old = dict(p50=10, p95=20, p99=30, sql=4, rps=100)
+        new = dict(p50=11, p95=30, p99=30, sql=5, rps=70)
+
+        regressions = list(compare({'homepage': {'single': new}},
+                                   {'homepage': {'single': old}}, 0.2))
+
+        self.assertEqual(regressions,
+                         [('homepage', 'single', 'p95', 20, 30),
+                          ('homepage', 'single', 'sql', 4, 5),
+                          ('homepage', 'single', 'rps', 100, 70)])
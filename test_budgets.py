@@ -0,0 +1,222 @@
+"""Query budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_budgets.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import (QUERY_BUDGETS, QueryBudgetExceeded, QueryCounter,
+                     query_budget)
+from passwords import passwords
+from trending import trending
+from usercache import user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# numbers of other users, each with two messages, in the data sets
+SIZES = (1, 5, 25)
+
+# endpoint: function of the data set's ids -> (method, url, form data);
+# requests are made in this order, each logged in as "me" unless listed in
+# LOGGED_IN_AS, against a fresh data set. API requests send the data as JSON;
+# their batches grow with the data set.
+REQUESTS = {
+    'signup': lambda ids: ('GET', '/signup', None),
+    'login': lambda ids: ('POST', '/login', {'username': 'me',
+                                             'password': 'password'}),
+    'list_users': lambda ids: ('GET', '/users?q=user', None),
+    'users_show': lambda ids: ('GET', f"/users/{ids['me']}", None),
+    'show_following': lambda ids: ('GET', f"/users/{ids['me']}/following",
+                                   None),
+    'users_followers': lambda ids: ('GET', f"/users/{ids['me']}/followers",
+                                    None),
+    'messages_search': lambda ids: ('GET', '/messages/search?q=hello', None),
+    'messages_show': lambda ids: ('GET', f"/messages/{ids['message']}", None),
+    'show_likes': lambda ids: ('GET', f"/users/{ids['me']}/likes", None),
+    'homepage': lambda ids: ('GET', '/', None),
+    'show_trending': lambda ids: ('GET', '/trending', None),
+    'api_v1.fetch_users': lambda ids: ('GET', '/api/v1/users?ids=' + ','.join(
+        str(id_) for id_ in ids['others']), None),
+    'api_v1.home_timeline': lambda ids: ('GET', '/api/v1/timeline', None),
+    'api_v1.user_messages': lambda ids: ('GET', f"/api/v1/users/{ids['other']}"
+                                                "/messages", None),
+    'api_v1.user_likes': lambda ids: ('GET', f"/api/v1/users/{ids['me']}/likes",
+                                      None),
+    'api_v1.remove_follows': lambda ids: ('DELETE', '/api/v1/follows',
+                                          {'user_ids': ids['others']}),
+    'api_v1.add_follows': lambda ids: ('POST', '/api/v1/follows',
+                                       {'user_ids': ids['others']}),
+    'api_v1.add_likes': lambda ids: ('POST', '/api/v1/likes',
+                                     {'message_ids': ids['unliked']}),
+    'api_v1.remove_likes': lambda ids: ('DELETE', '/api/v1/likes',
+                                        {'message_ids': ids['unliked']}),
+    'profile': lambda ids: ('GET', '/users/profile', None),
+    'add_follow': lambda ids: ('POST', f"/users/follow/{ids['stranger']}",
+                               None),
+    'stop_following': lambda ids: ('POST',
+                                   f"/users/stop-following/{ids['other']}",
+                                   None),
+    'add_like': lambda ids: ('POST', f"/users/likes/{ids['strangers_message']}",
+                             None),
+    'messages_add': lambda ids: ('POST', '/messages/new', {'text': 'hello'}),
+    'messages_destroy': lambda ids: ('POST',
+                                     f"/messages/{ids['my_message']}/delete",
+                                     None),
+    'logout': lambda ids: ('GET', '/logout', None),
+    'delete_user': lambda ids: ('POST', '/users/delete', None),
+}
+
+# the leaver has as many messages, likes and follows as "me"
+LOGGED_IN_AS = {'delete_user': 'leaver'}
+
+
+class QueryBudgetTestCase(TestCase):
+    """Test the budget context manager."""
+
+    def test_query_budget(self):
+        """Is running over the budget an assertion failure?"""
+
+        with query_budget(1) as counter:
+            db.session.execute('SELECT 1')
+
+        self.assertEqual(len(counter), 1)
+
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(1):
+                db.session.execute('SELECT 1')
+                db.session.execute('SELECT 2')
+
+
+class RouteBudgetTestCase(TestCase):
+    """Test every route against its budget as the data grows."""
+
+    def setUp(self):
+        self.rounds = passwords.rounds
+        passwords.rounds = 4
+
+
+    def tearDown(self):
+        passwords.rounds = self.rounds
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def build(self, size):
+        """A data set with `size` other users; returns the ids requests use.
+
+        "me" follows, is followed by and has liked a message of each other
+        user; so does "leaver", liking another message of each ("unliked"
+        by me), and each other user likes a message of the leaver's.
+        Nobody follows the stranger.
+        """
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        user_cache.clear()
+        trending.clear()
+
+        def add_user(username):
+            user = User.signup(username=username,
+                               email=f"{username}@test.com",
+                               password='password',
+                               image_url=None)
+            db.session.flush()
+            return user
+
+        def add_message(user):
+            message = Message(user_id=user.id, text=f"hello from {user.username}")
+            db.session.add(message)
+            db.session.flush()
+            return message
+
+        me = add_user('me')
+        leaver = add_user('leaver')
+        stranger = add_user('stranger')
+        others = [add_user(f"user{i}") for i in range(size)]
+        unliked = []
+
+        for other in others:
+            me.following.append(other)
+            other.following.append(me)
+            leaver.following.append(other)
+            other.following.append(leaver)
+            db.session.add(Likes(user_id=me.id, message_id=add_message(other).id))
+
+            message = add_message(other)
+            db.session.add(Likes(user_id=leaver.id, message_id=message.id))
+            unliked.append(message.id)
+
+            db.session.add(Likes(user_id=other.id,
+                                 message_id=add_message(leaver).id))
+
+        ids = dict(me=me.id, leaver=leaver.id, stranger=stranger.id,
+                   other=others[0].id,
+                   others=[other.id for other in others],
+                   unliked=unliked,
+                   message=add_message(others[0]).id,
+                   my_message=add_message(me).id,
+                   strangers_message=add_message(stranger).id)
+
+        db.session.commit()
+        db.session.close()
+
+        return ids
+
+
+    def count_statements(self, size):
+        """{endpoint: statements run} against a data set of `size`."""
+
+        ids = self.build(size)
+        counts = {}
+        client = app.test_client()
+
+        for endpoint, make_request in REQUESTS.items():
+            method, url, data = make_request(ids)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = ids[LOGGED_IN_AS.get(endpoint, 'me')]
+
+            body = ({'json': data} if endpoint.startswith('api_v1.')
+                    else {'data': data})
+
+            with QueryCounter() as counter:
+                resp = client.open(url, method=method, headers={'Referer': '/'},
+                                   **body)
+
+            self.assertLess(resp.status_code, 400, endpoint)
+            counts[endpoint] = len(counter)
+
+        return counts
+
+
+    def test_every_endpoint_requested(self):
+        """Does every budgeted endpoint have a request here, and vice versa?"""
+
+        self.assertEqual(set(REQUESTS), set(QUERY_BUDGETS))
+
+
+    def test_budgets(self):
+        """Does every route stay within budget, at any data set size?"""
+
+        counts = {size: self.count_statements(size) for size in SIZES}
+
+        for endpoint, budget in QUERY_BUDGETS.items():
+            by_size = {size: counts[size][endpoint] for size in SIZES}
+
+            self.assertLessEqual(max(by_size.values()), budget,
+                                 f"{endpoint}: {by_size}")
+            self.assertEqual(len(set(by_size.values())), 1,
+                             f"{endpoint} grows with the data: {by_size}")
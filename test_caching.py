@@ -0,0 +1,154 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from caching import caching
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CachingTestCase(TestCase):
+    """Test validators, 304s and cache headers."""
+
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        viewer = User.signup(username="viewer",
+                             email="viewer@test.com",
+                             password="HASHED_PASSWORD",
+                             image_url=None)
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="HASHED_PASSWORD",
+                             image_url=None)
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+
+    def tearDown(self):
+        caching.enabled = True
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def revalidate(self, url, resp):
+        return self.client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+
+
+    def test_homepage_not_modified(self):
+        """Is an unchanged timeline answered with a 304?"""
+
+        resp = self.client.get('/')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('Last-Modified', resp.headers)
+
+        resp = self.revalidate('/', resp)
+
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b'')
+
+
+    def test_homepage_modified(self):
+        """Does a followed user's new message change the timeline's ETag?"""
+
+        self.client.post(f"/users/follow/{self.author_id}")
+        first = self.client.get('/')
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        self.client.post('/messages/new', data={'text': 'fresh news'})
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+        resp = self.revalidate('/', first)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('fresh news', resp.get_data(as_text=True))
+
+
+    def test_profile_modified(self):
+        """Does following a user change their profile page's ETag?"""
+
+        url = f"/users/{self.author_id}"
+        first = self.client.get(url)
+
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+
+        self.client.post(f"/users/follow/{self.author_id}")
+        resp = self.revalidate(url, first)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Unfollow', resp.get_data(as_text=True))
+
+
+    def test_other_viewer(self):
+        """Is a page never revalidated by date, which could match another
+        viewer's copy?"""
+
+        url = f"/users/{self.author_id}"
+        self.client.get(url)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        resp = self.client.get(url, headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+
+        self.assertEqual(resp.status_code, 200)
+
+
+    def test_static_files(self):
+        """Are versioned static files immutable, and others revalidated?"""
+
+        with app.test_request_context():
+            url = caching.static_url('stylesheets/style.css')
+
+        self.assertIn('?v=', url)
+
+        resp = self.client.get(url)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
+
+        resp = self.client.get('/static/stylesheets/style.css')
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+        resp.close()
+
+
+    def test_disabled(self):
+        """With caching off, is every response marked no-store?"""
+
+        caching.enabled = False
+
+        first = self.client.get('/')
+        self.assertNotIn('ETag', first.headers)
+        self.assertIn('no-store', first.headers['Cache-Control'])
+
+        resp = self.client.get('/', headers={'If-None-Match': '"anything"'})
+        self.assertEqual(resp.status_code, 200)
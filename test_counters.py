@@ -0,0 +1,143 @@
+"""Denormalized counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_counters.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CounterTestCase(TestCase):
+    """Test that the views keep user counters in step."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User(email="test1@test.com", username="testuser1",
+                  password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2",
+                  password="HASHED_PASSWORD")
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def post_as(self, user_id, url, **kwargs):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            return c.post(url, headers={'Referer': '/'}, **kwargs)
+
+
+    def counts(self, user_id):
+        db.session.expire_all()
+        user = User.query.get(user_id)
+
+        return (user.messages_count, user.following_count,
+                user.followers_count, user.likes_count)
+
+
+    def test_follow_counters(self):
+        """Do follow and unfollow update both users' counters?"""
+
+        self.post_as(self.u1_id, f'/users/follow/{self.u2_id}')
+
+        self.assertEqual(self.counts(self.u1_id), (0, 1, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 1, 0))
+
+        self.post_as(self.u1_id, f'/users/stop-following/{self.u2_id}')
+
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 0, 0))
+
+
+    def test_message_and_like_counters(self):
+        """Do messages and likes update counters, including on delete?"""
+
+        self.post_as(self.u2_id, '/messages/new', data={'text': 'Hello'})
+        msg_id = Message.query.one().id
+
+        self.assertEqual(self.counts(self.u2_id), (1, 0, 0, 0))
+
+        self.post_as(self.u1_id, f'/users/likes/{msg_id}')
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 1))
+
+        self.post_as(self.u2_id, f'/messages/{msg_id}/delete')
+
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+
+
+    def test_delete_user_counters(self):
+        """Does deleting a user with messages remove them too, and fix up
+        everyone else's counters?"""
+
+        self.post_as(self.u1_id, f'/users/follow/{self.u2_id}')
+        self.post_as(self.u2_id, f'/users/follow/{self.u1_id}')
+        self.post_as(self.u2_id, '/messages/new', data={'text': 'Bye'})
+        msg_id = Message.query.one().id
+        self.post_as(self.u1_id, f'/users/likes/{msg_id}')
+
+        self.assertEqual(self.counts(self.u1_id), (0, 1, 1, 1))
+
+        resp = self.post_as(self.u2_id, '/users/delete')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.counts(self.u1_id), (0, 0, 0, 0))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertIsNone(User.query.get(self.u2_id))
+
+
+    def test_reconcile(self):
+        """Does reconcile report and repair drift?"""
+
+        db.session.add(Follows(user_being_followed_id=self.u2_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=['counters', 'reconcile', '--dry-run'])
+        self.assertIn(f"User #{self.u1_id}: following_count 0 -> 1",
+                      result.output)
+        self.assertIn("Found drift for 2 users.", result.output)
+
+        result = runner.invoke(args=['counters', 'reconcile'])
+        self.assertIn("Fixed drift for 2 users.", result.output)
+
+        self.assertEqual(self.counts(self.u1_id), (0, 1, 0, 0))
+        self.assertEqual(self.counts(self.u2_id), (0, 0, 1, 0))
+
+        result = runner.invoke(args=['counters', 'reconcile'])
+        self.assertIn("Fixed drift for 0 users.", result.output)
@@ -0,0 +1,170 @@
+"""Message fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from fragments import fragments
+from usercache import user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test cached message markup and its invalidation."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        user_cache.clear()
+        fragments.clear()
+
+        self.client = app.test_client()
+
+        viewer = User.signup(username="viewer",
+                             email="viewer@test.com",
+                             password="HASHED_PASSWORD",
+                             image_url=None)
+        author = User.signup(username="author",
+                             email="author@test.com",
+                             password="HASHED_PASSWORD",
+                             image_url=None)
+        db.session.flush()
+
+        viewer.following.append(author)
+        message = Message(user_id=author.id, text="cached words")
+        db.session.add(message)
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+        self.message_id = message.id
+
+        self.log_in(self.viewer_id)
+
+
+    def tearDown(self):
+        fragments.maxsize = app.config['MESSAGE_FRAGMENT_CACHE_SIZE']
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def log_in(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+
+    def test_cached(self):
+        """Is a message rendered once and then served from the cache?"""
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn('cached words', html)
+        self.assertIn('@author', html)
+        self.assertEqual(len(fragments), 1)
+
+        cached = fragments._entries[self.message_id][2]
+        self.client.get(f"/users/{self.author_id}")
+
+        self.assertIs(fragments._entries[self.message_id][2], cached)
+
+
+    def test_like_button_live(self):
+        """Does a cached fragment still show the viewer's own like state?"""
+
+        self.client.get('/')
+        self.client.post(f"/users/likes/{self.message_id}",
+                         headers={'Referer': '/'})
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn('btn-primary', html)
+        self.assertIn('fa fa-star', html)
+
+
+    def test_button_in_message_area(self):
+        """Does the likes page put its labelled like button inside the
+        cached fragment's message area?"""
+
+        self.client.post(f"/users/likes/{self.message_id}",
+                         headers={'Referer': '/'})
+
+        html = self.client.get(f"/users/{self.viewer_id}/likes").get_data(
+            as_text=True)
+        area = html[html.index('class="message-area"'):]
+
+        self.assertLess(area.index('cached words'), area.index('<form'))
+        self.assertLess(area.index('<form'), area.index('</div>'))
+        self.assertIn('aria-label="Unlike"', area)
+        self.assertEqual(len(fragments), 1)
+
+
+    def test_author_changed(self):
+        """Is a fragment re-rendered once its author's name changes,
+        even when another process made the change?"""
+
+        self.client.get('/')
+
+        User.query.filter_by(id=self.author_id).update({'username': 'renamed'})
+        db.session.commit()
+        user_cache.clear()
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn('@renamed', html)
+        self.assertNotIn('@author', html)
+
+
+    def test_profile_forgets_author(self):
+        """Does editing a profile drop that author's fragments?"""
+
+        self.client.get('/')
+        self.log_in(self.author_id)
+
+        self.client.post('/users/profile', data={'username': 'renamed',
+                                                 'email': 'author@test.com',
+                                                 'password': 'HASHED_PASSWORD'})
+
+        self.assertNotIn(self.message_id, fragments._entries)
+
+
+    def test_destroy_forgets_message(self):
+        """Does deleting a message drop its fragment?"""
+
+        self.client.get('/')
+        self.log_in(self.author_id)
+
+        self.client.post(f"/messages/{self.message_id}/delete")
+
+        self.assertNotIn(self.message_id, fragments._entries)
+
+
+    def test_bounded(self):
+        """Are the least recently rendered fragments evicted first?"""
+
+        fragments.maxsize = 1
+
+        message = Message(user_id=self.author_id, text="newer words")
+        db.session.add(message)
+        db.session.commit()
+        newer_id = message.id
+
+        self.client.get('/')
+
+        self.assertEqual(len(fragments), 1)
+        self.assertIn(self.message_id, fragments._entries)
+        self.assertNotIn(newer_id, fragments._entries)
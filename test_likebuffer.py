@@ -0,0 +1,258 @@
+"""Write-behind like buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likebuffer.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Message, Follows, Likes, TimelineEntry,
+                    Toggle)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import QueryCounter
+from likebuffer import like_buffer
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeBufferTestCase(TestCase):
+    """Test buffering, coalescing and flushing toggles."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        app.config['LIKE_WRITE_BEHIND'] = True
+
+        # flush only when the tests say so
+        self.interval = like_buffer.interval
+        like_buffer.interval = 60
+
+        self.client = app.test_client()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ('author', 'reader1', 'reader2')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        messages = [Message(user_id=users[0].id, text=f"Warble {i}")
+                    for i in range(2)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.author_id, self.reader1_id, self.reader2_id = (user.id
+                                                            for user in users)
+        self.message_ids = [message.id for message in messages]
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+
+    def tearDown(self):
+        like_buffer.stop()
+        like_buffer._pending.clear()
+        like_buffer._flushing = {}
+        like_buffer._versions.clear()
+        like_buffer.interval = self.interval
+        app.config['LIKE_WRITE_BEHIND'] = False
+
+        db.session.rollback()
+        db.session.close()
+        self.ctx.pop()
+
+
+    def likes_count(self, user_id):
+        db.session.expire_all()
+        return User.query.get(user_id).likes_count
+
+
+    def test_buffered(self):
+        """Is a toggle answered from one SELECT, and seen by its user
+        before it's written?"""
+
+        message_id = self.message_ids[0]
+
+        with QueryCounter() as counter:
+            self.assertEqual(like_buffer.toggle(self.reader1_id, message_id),
+                             Toggle(changed=True, liked=True))
+
+        self.assertEqual(len(counter), 1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(like_buffer.liked_ids(self.reader1_id, [message_id]),
+                         {message_id})
+        self.assertEqual(like_buffer.liked_ids(self.reader2_id, [message_id]),
+                         set())
+
+        self.assertEqual(like_buffer.flush(), 1)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(self.likes_count(self.reader1_id), 1)
+
+
+    def test_coalesced(self):
+        """Do repeated toggles make one write, or none?"""
+
+        first, second = self.message_ids
+
+        for _ in range(3):
+            like_buffer.toggle(self.reader1_id, first)
+
+        # toggled back to how it's stored
+        like_buffer.toggle(self.reader1_id, second)
+
+        with QueryCounter() as counter:
+            self.assertEqual(like_buffer.toggle(self.reader1_id, second),
+                             Toggle(changed=True, liked=False))
+
+        self.assertEqual(len(counter), 0)
+        self.assertEqual(len(like_buffer), 1)
+
+        like_buffer.flush()
+        self.assertEqual(Likes.liked_ids(self.reader1_id, self.message_ids),
+                         {first})
+
+
+    def test_batch(self):
+        """Are likes and unlikes of several users written together, with
+        their counters?"""
+
+        first, second = self.message_ids
+        db.session.add(Likes(user_id=self.reader2_id, message_id=first))
+        db.session.commit()
+
+        like_buffer.toggle(self.reader1_id, first)
+        like_buffer.toggle(self.reader1_id, second)
+        like_buffer.toggle(self.reader2_id, first)
+        like_buffer.toggle(self.reader2_id, second)
+
+        with QueryCounter() as counter:
+            like_buffer.flush()
+
+        inserts = [statement for statement in counter.statements
+                   if statement.startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(Likes.liked_ids(self.reader1_id, self.message_ids),
+                         {first, second})
+        self.assertEqual(Likes.liked_ids(self.reader2_id, self.message_ids),
+                         {second})
+        self.assertEqual(self.likes_count(self.reader1_id), 2)
+        self.assertEqual(self.likes_count(self.reader2_id), 0)
+
+
+    def test_toggle_while_flushing(self):
+        """Is a toggle of a like being written based on what's written?"""
+
+        message_id = self.message_ids[0]
+        like_buffer.toggle(self.reader1_id, message_id)
+
+        # as if the flusher had taken the batch but not yet committed
+        like_buffer._flushing, like_buffer._pending = like_buffer._pending, {}
+
+        self.assertEqual(like_buffer.toggle(self.reader1_id, message_id),
+                         Toggle(changed=True, liked=False))
+        self.assertEqual(like_buffer._pending[(self.reader1_id, message_id)],
+                         (True, False))
+
+
+    def test_deleted_message(self):
+        """Are likes of a message deleted before the flush dropped?"""
+
+        message_id = self.message_ids[0]
+        like_buffer.toggle(self.reader1_id, message_id)
+
+        Message.query.filter_by(id=message_id).delete()
+        db.session.commit()
+
+        like_buffer.flush()
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.likes_count(self.reader1_id), 0)
+
+
+    def test_bounded(self):
+        """Is a toggle past LIKE_BUFFER_SIZE written through?"""
+
+        maxsize = like_buffer.maxsize
+        like_buffer.maxsize = 1
+
+        try:
+            like_buffer.toggle(self.reader1_id, self.message_ids[0])
+            like_buffer.toggle(self.reader1_id, self.message_ids[1])
+        finally:
+            like_buffer.maxsize = maxsize
+
+        self.assertEqual(len(like_buffer), 1)
+        self.assertEqual(Likes.liked_ids(self.reader1_id, self.message_ids),
+                         {self.message_ids[1]})
+
+
+    def test_flush_on_stop(self):
+        """Is what's pending written when the flusher stops?"""
+
+        like_buffer.toggle(self.reader1_id, self.message_ids[0])
+        self.assertIsNotNone(like_buffer._thread)
+
+        like_buffer.stop()
+
+        self.assertIsNone(like_buffer._thread)
+        self.assertEqual(Likes.query.count(), 1)
+
+
+    def test_views(self):
+        """Does the like button buffer, and your likes page show it?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader1_id
+
+        resp = self.client.post(f"/users/likes/{self.message_ids[0]}",
+                                headers={'Referer': '/'})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(len(like_buffer), 1)
+
+        html = self.client.get(f"/users/{self.reader1_id}/likes").get_data(
+            as_text=True)
+
+        self.assertIn('Warble 0', html)
+        self.assertEqual(len(like_buffer), 0)
+
+
+    def test_revalidate(self):
+        """Is a page revalidated after a buffered toggle rendered again,
+        and answered with a 304 once the toggle is written?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader1_id
+
+        url = f"/users/{self.author_id}"
+        before = self.client.get(url)
+
+        self.client.post(f"/users/likes/{self.message_ids[0]}",
+                         headers={'Referer': url})
+        self.assertEqual(len(like_buffer), 1)
+
+        resp = self.client.get(
+            url, headers={'If-None-Match': before.headers['ETag']})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], before.headers['ETag'])
+
+        with app.app_context():
+            like_buffer.flush()
+
+        after = self.client.get(url)
+        resp = self.client.get(
+            url, headers={'If-None-Match': after.headers['ETag']})
+
+        self.assertIsNone(like_buffer.version(self.reader1_id))
+        self.assertEqual(resp.status_code, 304)
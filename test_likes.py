@@ -0,0 +1,191 @@
+"""Like toggle tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Toggle
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import QueryCounter
+from testing import sqlite_app
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeToggleTestCase(TestCase):
+    """Test Likes.toggle() on PostgreSQL."""
+
+    def setUp(self):
+        """Add an author with a message, and two readers."""
+
+        self.ctx = self.make_app().app_context()
+        self.ctx.push()
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ('author', 'reader1', 'reader2')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        message = Message(user_id=users[0].id, text="likeable")
+        db.session.add(message)
+        db.session.commit()
+
+        self.author_id, self.reader1_id, self.reader2_id = (user.id
+                                                            for user in users)
+        self.message_id = message.id
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        db.session.rollback()
+        db.session.close()
+        self.ctx.pop()
+
+
+    def make_app(self):
+        return app
+
+
+    def likes_count(self, user_id):
+        db.session.expire_all()
+        return User.query.get(user_id).likes_count
+
+
+    def test_toggle(self):
+        """Does toggling like, then unlike, keeping likes_count in step?"""
+
+        self.assertEqual(Likes.toggle(self.reader1_id, self.message_id),
+                         Toggle(changed=True, liked=True))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(self.likes_count(self.reader1_id), 1)
+
+        self.assertEqual(Likes.toggle(self.reader1_id, self.message_id),
+                         Toggle(changed=True, liked=False))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.likes_count(self.reader1_id), 0)
+
+
+    def test_many_likers(self):
+        """Can several users like the same message?"""
+
+        Likes.toggle(self.reader1_id, self.message_id)
+        Likes.toggle(self.reader2_id, self.message_id)
+        db.session.commit()
+
+        self.assertEqual(Likes.query.filter_by(message_id=self.message_id)
+                                    .count(), 2)
+
+
+    def test_own_message(self):
+        """Is liking your own message refused, changing nothing?"""
+
+        self.assertEqual(Likes.toggle(self.author_id, self.message_id),
+                         Toggle(changed=False, liked=False))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(self.likes_count(self.author_id), 0)
+
+
+    def test_missing_message(self):
+        """Is there no state for a message that doesn't exist?"""
+
+        self.assertIsNone(Likes.toggle(self.reader1_id, self.message_id + 1))
+
+
+class SQLiteLikeToggleTestCase(LikeToggleTestCase):
+    """Run the same tests on SQLite, which toggles in several statements."""
+
+    def make_app(self):
+        return sqlite_app()
+
+
+class LikeToggleOneStatementTestCase(LikeToggleTestCase):
+    """Test that PostgreSQL toggles in a single statement."""
+
+    def test_one_statement(self):
+        """Is a toggle, counter included, one statement?"""
+
+        for liked in (True, False):
+            with QueryCounter() as counter:
+                self.assertEqual(Likes.toggle(self.reader1_id,
+                                              self.message_id),
+                                 Toggle(changed=True, liked=liked))
+
+            self.assertEqual(len(counter), 1)
+
+
+class LikeViewTestCase(TestCase):
+    """Test the like button's view."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        author = User(username="author", email="author@test.com",
+                      password="HASHED_PASSWORD")
+        reader = User(username="reader", email="reader@test.com",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([author, reader])
+        db.session.flush()
+
+        message = Message(user_id=author.id, text="likeable")
+        db.session.add(message)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.message_id = message.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_like(self):
+        """Does the view like the message and go back where it came from?"""
+
+        resp = self.client.post(f"/users/likes/{self.message_id}",
+                                headers={'Referer': '/somewhere'})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(resp.location.endswith('/somewhere'))
+        self.assertEqual(Likes.liked_ids(self.reader_id, [self.message_id]),
+                         {self.message_id})
+
+
+    def test_missing_message(self):
+        """Is liking a message that doesn't exist the not found page?"""
+
+        resp = self.client.post(f"/users/likes/{self.message_id + 1}",
+                                headers={'Referer': '/'})
+
+        self.assertIn('Page Not Found', resp.get_data(as_text=True))
+        self.assertEqual(Likes.query.count(), 0)
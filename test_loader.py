@@ -0,0 +1,130 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from loader import load
+from testing import sqlite_app
+
+db.create_all()
+
+USERS = [['id', 'email', 'username', 'password'],
+         ['10', 'a@test.com', 'alice', 'HASHED_PASSWORD'],
+         ['11', 'b@test.com', 'bob', 'HASHED_PASSWORD'],
+         ['12', 'c@test.com', 'carol', 'HASHED_PASSWORD']]
+
+MESSAGES = [['text', 'timestamp', 'user_id'],
+            ['Hello, "world"', '2017-01-21 11:04:53.522807', '10'],
+            ['two\nlines', '2017-01-22 11:04:53', '10'],
+            ['third', '2017-01-23 11:04:53', '11']]
+
+FOLLOWS = [['user_being_followed_id', 'user_following_id'],
+           ['10', '11'],
+           ['10', '12'],
+           ['11', '12']]
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSV files on PostgreSQL."""
+
+    def setUp(self):
+        """Write sample CSV files and load them, two rows at a time."""
+
+        self.ctx = self.make_app().app_context()
+        self.ctx.push()
+
+        self.dir = tempfile.TemporaryDirectory()
+
+        for name, rows in [('users', USERS), ('messages', MESSAGES),
+                           ('follows', FOLLOWS)]:
+            with open(os.path.join(self.dir.name, f"{name}.csv"), 'w',
+                      newline='') as file:
+                csv.writer(file).writerows(rows)
+
+        self.report = []
+        self.loaded = load(self.dir.name, chunk_size=2,
+                           echo=self.report.append)
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        db.session.rollback()
+        db.session.close()
+        self.dir.cleanup()
+        self.ctx.pop()
+
+
+    def make_app(self):
+        return app
+
+
+    def test_load(self):
+        """Are all rows loaded intact and counted?"""
+
+        self.assertEqual(self.loaded,
+                         {'users': 3, 'messages': 3, 'follows': 3})
+        self.assertIn('messages: 3 rows in', self.report[1])
+
+        texts = [m.text for m in Message.query.order_by(Message.timestamp)]
+        self.assertEqual(texts, ['Hello, "world"', 'two\nlines', 'third'])
+
+        alice = User.query.get(10)
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 2)
+        self.assertIsNone(alice.bio)
+
+
+    def test_sequences_reset(self):
+        """Do new rows get ids after the loaded ones?"""
+
+        user = User(email='d@test.com', username='dave',
+                    password='HASHED_PASSWORD')
+        db.session.add(user)
+        db.session.commit()
+
+        self.assertEqual(user.id, 13)
+
+
+    def test_constraints_restored(self):
+        """Are deferred indexes and foreign keys back after the load?"""
+
+        indexes = {index['name'] for index
+                   in inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_recent', indexes)
+
+        db.session.add(Follows(user_being_followed_id=10,
+                               user_following_id=99))
+
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+
+class SQLiteLoaderTestCase(LoaderTestCase):
+    """Run the same tests on SQLite, inserting with executemany."""
+
+    def make_app(self):
+        return sqlite_app(create_tables=False)
+
+
+    def test_constraints_restored(self):
+        """Are indexes left in place? (SQLite doesn't enforce FKs.)"""
+
+        indexes = {index['name'] for index
+                   in inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_recent', indexes)
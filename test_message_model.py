@@ -97,3 +97,20 @@ class MessageModelTestCase(TestCase):
         db.session.commit()
 
         self.assertEqual(len(m.likes), 1)
+
+
+    def test_liked_ids(self):
+        """Does liked_ids return only the listed messages a user liked"""
+
+        m1 = Message(text="Hello", user_id=self.user_id)
+        m2 = Message(text="World", user_id=self.user_id)
+
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user_id, message_id=m1.id))
+        db.session.commit()
+
+        self.assertEqual(Likes.liked_ids(self.user_id, [m1.id, m2.id]), {m1.id})
+        self.assertEqual(Likes.liked_ids(self.user_id, [m2.id]), set())
+        self.assertEqual(Likes.liked_ids(self.user_id, []), set())
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from budgets import QueryCounter
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -151,3 +152,66 @@ class MessageViewTestCase(TestCase):
 
         self.assertEqual(resp.status_code, 200)
         self.assertIn('<a href="/signup" class="btn btn-primary">Sign up</a>', html)
+
+
+    def test_liked_message_shown(self):
+        """Are messages the user liked marked on their profile listing?"""
+
+        author = User(username="author", email="author@test.com",
+                      password="HASHED_PASSWORD")
+        db.session.add(author)
+        db.session.commit()
+        author_id = author.id
+        user_id = self.testuser.id
+
+        liked = Message(text='Liked', user_id=author_id)
+        unliked = Message(text='Unliked', user_id=author_id)
+        db.session.add_all([liked, unliked])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=user_id, message_id=liked.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f'/users/{author_id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count('<i class="fa fa-star"></i>'), 1)
+            self.assertEqual(html.count('<i class="far fa-star"></i>'), 1)
+
+
+    def test_timeline_query_count(self):
+        """Does a timeline cost the same number of queries for any number of authors?"""
+
+        user_id = self.testuser.id
+
+        def render_likes_page(num_authors):
+            for i in range(num_authors):
+                author = User(username=f"author{num_authors}-{i}",
+                              email=f"author{num_authors}-{i}@test.com",
+                              password="HASHED_PASSWORD")
+                db.session.add(author)
+                db.session.flush()
+
+                msg = Message(text='Hello', user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=user_id, message_id=msg.id))
+
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                with QueryCounter() as counter:
+                    resp = c.get(f'/users/{user_id}/likes')
+
+            self.assertEqual(resp.status_code, 200)
+            return len(counter)
+
+        self.assertEqual(render_likes_page(2), render_likes_page(10))
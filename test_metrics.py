@@ -0,0 +1,103 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from metrics import Histogram, metrics
+
+db.create_all()
+
+
+class HistogramTestCase(TestCase):
+    """Test the histogram itself."""
+
+    def test_buckets(self):
+        """Are values counted in the first bucket at or above them?"""
+
+        histogram = Histogram((1, 5))
+
+        for value in (0, 1, 3, 5, 9):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.snapshot(), ([2, 4, 5], 18))
+
+
+class MetricsViewTestCase(TestCase):
+    """Test metrics recorded from requests."""
+
+    def setUp(self):
+        User.query.delete()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="HASHED_PASSWORD",
+                           image_url=None)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.client = app.test_client()
+        metrics.clear()
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_request_recorded(self):
+        """Is a request's time, SQL and rendering recorded by endpoint?"""
+
+        self.client.get(f"/users/{self.user_id}")
+        self.client.get(f"/users/{self.user_id}")
+
+        cumulative, total = (metrics.histogram('warbler_db_queries',
+                                               'users_show').snapshot())
+        self.assertEqual(cumulative[-1], 2)
+        self.assertGreater(total, 0)
+
+        _, rows = metrics.histogram('warbler_db_rows', 'users_show').snapshot()
+        self.assertGreater(rows, 0)
+
+        _, seconds = (metrics.histogram('warbler_template_seconds',
+                                        'users_show').snapshot())
+        self.assertGreater(seconds, 0)
+
+
+    def test_exposition(self):
+        """Does /metrics serve histograms in the Prometheus text format?"""
+
+        self.client.get(f"/users/{self.user_id}")
+
+        resp = self.client.get('/metrics')
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE warbler_request_seconds histogram', text)
+        self.assertIn('warbler_request_seconds_bucket'
+                      '{endpoint="users_show",le="+Inf"} 1', text)
+        self.assertIn('warbler_db_queries_count{endpoint="users_show"} 1', text)
+
+        # scrapes aren't recorded themselves
+        self.assertNotIn('endpoint="metrics"', text)
+
+
+    def test_password_metrics(self):
+        """Are the password hasher's counters and gauges served too?"""
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+
+        self.assertIn('# TYPE warbler_password_busy_total counter', text)
+        self.assertIn('# TYPE warbler_password_in_flight gauge', text)
+        self.assertIn('\nwarbler_password_in_flight 0\n', text)
+        self.assertIn('\nwarbler_password_hashes_total ', text)
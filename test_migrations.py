@@ -0,0 +1,220 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from migrations import MIGRATIONS, migrate
+
+db.create_all()
+
+
+class MigrationTestCase(TestCase):
+    """Test migrating tables created by older releases."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ('author', 'reader1', 'reader2')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        message = Message(user_id=users[0].id, text="likeable")
+        db.session.add(message)
+        db.session.flush()
+
+        self.reader1_id = users[1].id
+        self.reader2_id = users[2].id
+        self.message_id = message.id
+
+        # nothing may hold a lock on the tables a migration alters
+        db.session.commit()
+        db.session.close()
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+        Likes.__table__.drop(db.engine)
+        Likes.__table__.create(db.engine)
+
+
+    def test_likes_composite_key(self):
+        """Are old likes kept under a (user_id, message_id) key?"""
+
+        Likes.__table__.drop(db.engine)
+        db.session.execute("""
+            CREATE TABLE likes (
+                id SERIAL PRIMARY KEY,
+                user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+                message_id INTEGER UNIQUE
+                    REFERENCES messages (id) ON DELETE CASCADE
+            )""")
+        db.session.execute("INSERT INTO likes (user_id, message_id) "
+                           "VALUES (:user_id, :message_id), (NULL, NULL)",
+                           dict(user_id=self.reader1_id,
+                                message_id=self.message_id))
+        db.session.commit()
+        db.session.close()
+
+        migrate(['likes-composite-key', 'likes-created-at'],
+                echo=lambda message: None)
+
+        key = inspect(db.engine).get_pk_constraint('likes')
+        self.assertEqual(key['constrained_columns'], ['user_id', 'message_id'])
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertIsNotNone(Likes.query.one().created_at)
+
+        Likes.toggle(self.reader2_id, self.message_id)
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 2)
+        db.session.close()
+
+
+    def test_users_columns(self):
+        """Are the counter and updated_at columns added and filled in?"""
+
+        db.session.add(Likes(user_id=self.reader1_id, message_id=self.message_id))
+        db.session.commit()
+        db.session.close()
+
+        db.session.execute("ALTER TABLE users DROP COLUMN updated_at, "
+                           "DROP COLUMN messages_count, "
+                           "DROP COLUMN following_count, "
+                           "DROP COLUMN followers_count, "
+                           "DROP COLUMN likes_count")
+        db.session.commit()
+        db.session.close()
+
+        migrate(echo=lambda message: None)
+
+        self.assertEqual(User.query.get(self.reader1_id).likes_count, 1)
+        self.assertIsNotNone(User.query.get(self.reader1_id).updated_at)
+        self.assertEqual(
+            db.session.query(db.func.sum(User.messages_count)).scalar(), 1)
+        db.session.close()
+
+
+    def test_follows_created_at(self):
+        """Do existing follows get a created_at, and its indexes?"""
+
+        db.session.add(Follows(user_being_followed_id=self.reader1_id,
+                               user_following_id=self.reader2_id))
+        db.session.commit()
+        db.session.close()
+
+        db.session.execute("DROP INDEX ix_follows_following_recent")
+        db.session.execute("DROP INDEX ix_follows_followed_recent")
+        db.session.execute("ALTER TABLE follows DROP COLUMN created_at")
+        db.session.commit()
+        db.session.close()
+
+        migrate(['follows-created-at'], echo=lambda message: None)
+
+        self.assertIsNotNone(Follows.query.one().created_at)
+        self.assertEqual(
+            {index['name'] for index in inspect(db.engine)
+                                        .get_indexes('follows')},
+            {'ix_follows_following_recent', 'ix_follows_followed_recent'})
+        db.session.close()
+
+
+    def test_messages_recent_indexes(self):
+        """Are the timeline indexes added to an existing messages table?"""
+
+        db.session.execute("DROP INDEX ix_messages_recent")
+        db.session.execute("DROP INDEX ix_messages_user_recent")
+        db.session.commit()
+        db.session.close()
+
+        migrate(['messages-recent-indexes'], echo=lambda message: None)
+
+        self.assertLessEqual(
+            {'ix_messages_recent', 'ix_messages_user_recent'},
+            {index['name'] for index in inspect(db.engine)
+                                        .get_indexes('messages')})
+
+
+    def test_users_username_trgm(self):
+        """Is the username search index added to an existing users
+        table?"""
+
+        available = db.session.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_available_extensions "
+            "WHERE name = 'pg_trgm')").scalar()
+
+        db.session.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
+        db.session.commit()
+        db.session.close()
+
+        migrate(['users-username-trgm'], echo=lambda message: None)
+
+        if not available:
+            self.skipTest("pg_trgm isn't installed on this server")
+
+        self.assertIn('ix_users_username_trgm',
+                      {index['name'] for index in inspect(db.engine)
+                                                  .get_indexes('users')})
+
+
+    def test_utc_defaults(self):
+        """Do the server defaults store UTC whatever the server's time
+        zone, on new and migrated tables alike?"""
+
+        db.session.execute("ALTER TABLE follows ALTER COLUMN created_at "
+                           "SET DEFAULT now()")
+        db.session.commit()
+        db.session.close()
+
+        migrate(['follows-created-at'], echo=lambda message: None)
+
+        with db.engine.begin() as connection:
+            connection.execute("SET LOCAL TIME ZONE 'Asia/Tokyo'")
+            connection.execute(
+                "INSERT INTO follows (user_being_followed_id, "
+                "user_following_id) VALUES (%s, %s)",
+                self.reader1_id, self.reader2_id)
+            connection.execute(
+                "INSERT INTO likes (user_id, message_id) VALUES (%s, %s)",
+                self.reader1_id, self.message_id)
+
+        now = datetime.utcnow()
+
+        for created_at in (Follows.query.one().created_at,
+                           Likes.query.one().created_at):
+            self.assertLess(abs(created_at - now), timedelta(minutes=1))
+
+        db.session.close()
+
+
+    def test_rerun(self):
+        """Does running every migration on a current database change nothing?"""
+
+        db.session.add(Likes(user_id=self.reader1_id, message_id=self.message_id))
+        db.session.commit()
+        db.session.close()
+
+        migrate(echo=lambda message: None)
+        migrate(list(MIGRATIONS), echo=lambda message: None)
+
+        self.assertEqual(Likes.query.count(), 1)
+        db.session.close()
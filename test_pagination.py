@@ -0,0 +1,245 @@
+"""Keyset pagination tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagination.py
+
+
+import os
+import re
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from pagination import Cursor
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CursorTestCase(TestCase):
+    """Test cursor tokens."""
+
+    def test_round_trip(self):
+        """Does a cursor survive encoding and decoding?"""
+
+        cursor = Cursor(datetime(2020, 5, 17, 8, 30, 1, 123456), 42)
+
+        with app.test_request_context():
+            self.assertEqual(Cursor.decode(cursor.encode()), cursor)
+
+
+class PaginationViewTestCase(TestCase):
+    """Test paging through timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        TimelineEntry.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        self.client = app.test_client()
+
+        user = User(email="test@test.com", username="testuser",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        # two messages share a timestamp, so the id breaks the tie
+        start = datetime(2020, 1, 1)
+        stamps = [start, start + timedelta(hours=1), start + timedelta(hours=1),
+                  start + timedelta(hours=2), start + timedelta(hours=3)]
+        messages = [Message(text=f"Warble {i}", timestamp=stamp,
+                            user_id=self.user_id)
+                    for i, stamp in enumerate(stamps)]
+
+        db.session.add_all(messages)
+        db.session.commit()
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        app.config.pop('MESSAGES_PER_PAGE')
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def read_page(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get(url).get_data(as_text=True)
+
+        texts = re.findall(r'<p>(Warble \d)</p>', html)
+        older = re.search(r'before=([\d-]+)', html)
+        newer = re.search(r'after=([\d-]+)', html)
+
+        return texts, older and older.group(1), newer and newer.group(1)
+
+
+    def test_users_show_pages(self):
+        """Can you page back through a profile and forward again?"""
+
+        url = f'/users/{self.user_id}'
+
+        texts, older, newer = self.read_page(url)
+        self.assertEqual(texts, ['Warble 4', 'Warble 3'])
+        self.assertIsNone(newer)
+
+        texts, older, newer = self.read_page(f'{url}?before={older}')
+        self.assertEqual(texts, ['Warble 2', 'Warble 1'])
+
+        texts, last, _ = self.read_page(f'{url}?before={older}')
+        self.assertEqual(texts, ['Warble 0'])
+        self.assertIsNone(last)
+
+        texts, _, _ = self.read_page(f'{url}?after={newer}')
+        self.assertEqual(texts, ['Warble 4', 'Warble 3'])
+
+
+    def test_malformed_cursor(self):
+        """Is a malformed cursor a 400?"""
+
+        resp = self.client.get(f'/users/{self.user_id}?before=not-a-cursor')
+
+        self.assertEqual(resp.status_code, 400)
+
+
+    def test_homepage_pages(self):
+        """Does the homepage take the same cursors?"""
+
+        texts, older, _ = self.read_page('/')
+        self.assertEqual(texts, ['Warble 4', 'Warble 3'])
+
+        texts, _, _ = self.read_page(f'/?before={older}')
+        self.assertEqual(texts, ['Warble 2', 'Warble 1'])
+
+
+    def test_homepage_fanout_pages(self):
+        """Do fan-out timelines page the same way?"""
+
+        app.config['TIMELINE_FANOUT'] = True
+        app.config['TIMELINE_BACKEND'] = 'memory'
+
+        try:
+            texts, older, _ = self.read_page('/')
+            self.assertEqual(texts, ['Warble 4', 'Warble 3'])
+
+            texts, _, _ = self.read_page(f'/?before={older}')
+            self.assertEqual(texts, ['Warble 2', 'Warble 1'])
+        finally:
+            app.config['TIMELINE_FANOUT'] = False
+            app.config['TIMELINE_BACKEND'] = 'sql'
+
+
+    def test_show_likes_pages(self):
+        """Does the likes page take the same cursors?"""
+
+        other = User(email="other@test.com", username="other",
+                     password="HASHED_PASSWORD")
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+
+        for message in Message.query.all():
+            db.session.add(Likes(user_id=other_id, message_id=message.id))
+        db.session.commit()
+
+        texts, older, _ = self.read_page(f'/users/{other_id}/likes')
+        self.assertEqual(texts, ['Warble 4', 'Warble 3'])
+
+        texts, _, _ = self.read_page(f'/users/{other_id}/likes?before={older}')
+        self.assertEqual(texts, ['Warble 2', 'Warble 1'])
+
+
+class FollowListTestCase(TestCase):
+    """Test paging through following and followers lists."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        self.client = app.test_client()
+
+        users = [User(email=f"{name}@test.com", username=name,
+                      password="HASHED_PASSWORD")
+                 for name in ('me', 'user0', 'user1', 'user2')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        self.me_id = users[0].id
+
+        # me follows user0..user2, in that order; user1 follows back
+        start = datetime(2020, 1, 1)
+        db.session.add_all(
+            [Follows(user_being_followed_id=user.id,
+                     user_following_id=self.me_id,
+                     created_at=start + timedelta(hours=i))
+             for i, user in enumerate(users[1:])]
+            + [Follows(user_being_followed_id=self.me_id,
+                       user_following_id=users[2].id)])
+        db.session.commit()
+
+
+    def tearDown(self):
+        app.config.pop('MESSAGES_PER_PAGE')
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def read_page(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.me_id
+
+            html = c.get(url).get_data(as_text=True)
+
+        names = re.findall(r'<p>@(user\d)</p>', html)
+        older = re.search(r'before=([\d-]+)', html)
+
+        return names, older and older.group(1), html
+
+
+    def test_following_pages(self):
+        """Are the most recent follows listed first, a page at a time?"""
+
+        url = f'/users/{self.me_id}/following'
+
+        names, older, html = self.read_page(url)
+        self.assertEqual(names, ['user2', 'user1'])
+        self.assertEqual(html.count('Unfollow'), 2)
+        self.assertEqual(html.count('Follows you'), 1)
+
+        names, older, _ = self.read_page(f'{url}?before={older}')
+        self.assertEqual(names, ['user0'])
+        self.assertIsNone(older)
+
+
+    def test_followers_page(self):
+        """Are followers listed with the viewer's follow state?"""
+
+        names, older, html = self.read_page(f'/users/{self.me_id}/followers')
+
+        self.assertEqual(names, ['user1'])
+        self.assertIn('Unfollow', html)
+        self.assertIsNone(older)
@@ -0,0 +1,172 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from passwords import PasswordHasher, PasswordHasherBusy, passwords
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test the bounded hasher itself."""
+
+    def make_hasher(self, **config):
+        hasher_app = Flask(__name__)
+        hasher_app.config.update(BCRYPT_LOG_ROUNDS=4, **config)
+        return PasswordHasher(hasher_app)
+
+
+    def test_hash_and_verify(self):
+        """Does a hash verify its own password and nothing else?"""
+
+        hasher = self.make_hasher()
+        hashed = hasher.hash('secret')
+
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertTrue(hasher.verify(hashed, 'secret'))
+        self.assertFalse(hasher.verify(hashed, 'wrong'))
+        self.assertEqual(hasher.stats()['verified'], 2)
+
+
+    def test_needs_rehash(self):
+        """Are hashes at another work factor flagged for an upgrade?"""
+
+        hasher = self.make_hasher()
+
+        self.assertFalse(hasher.needs_rehash(hasher.hash('secret')))
+        self.assertTrue(hasher.needs_rehash('$2b$12$' + 'x' * 53))
+        self.assertTrue(hasher.needs_rehash('not a bcrypt hash'))
+
+
+    def test_busy(self):
+        """Is work refused once every worker and queue slot is taken?"""
+
+        hasher = self.make_hasher(PASSWORD_HASH_WORKERS=1,
+                                  PASSWORD_HASH_QUEUE=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        worker = threading.Thread(target=hasher._run, args=(block,))
+        worker.start()
+        started.wait()
+
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.hash('secret')
+        finally:
+            release.set()
+            worker.join()
+
+        self.assertEqual(hasher.stats()['busy'], 1)
+        self.assertTrue(hasher.hash('secret'))
+
+
+    def test_reject(self):
+        """Does an unknown user cost no hashing once timing is measured?"""
+
+        hasher = self.make_hasher()
+        hasher.verify(hasher.hash('secret'), 'secret')
+
+        hasher.reject()
+
+        stats = hasher.stats()
+        self.assertEqual(stats['unknown_user'], 1)
+        self.assertEqual(stats['hashed'], 1)
+
+
+class RehashOnLoginTestCase(TestCase):
+    """Test that logging in upgrades outdated hashes."""
+
+    def setUp(self):
+        User.query.delete()
+
+        self.client = app.test_client()
+        self.rounds = passwords.rounds
+
+        passwords.rounds = 4
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="password",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+
+    def tearDown(self):
+        passwords.rounds = self.rounds
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_login_rehashes(self):
+        """Is a hash at an old work factor replaced when its owner logs in?"""
+
+        passwords.rounds = 5
+
+        resp = self.client.post('/login', data={'username': 'testuser',
+                                                'password': 'password'})
+        self.assertEqual(resp.status_code, 302)
+
+        hashed = User.query.get(self.user_id).password
+        self.assertTrue(hashed.startswith('$2b$05$'))
+        self.assertTrue(passwords.verify(hashed, 'password'))
+
+
+    def test_login_busy(self):
+        """Is a login shed with a 503 when the hasher is saturated?"""
+
+        slots = passwords._slots
+        passwords._slots = threading.BoundedSemaphore(1)
+        passwords._slots.acquire()
+
+        try:
+            resp = self.client.post('/login', data={'username': 'testuser',
+                                                    'password': 'password'})
+        finally:
+            passwords._slots = slots
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('very busy', resp.get_data(as_text=True))
+
+
+    def test_profile_busy(self):
+        """Is a profile edit shed with a 503 when the hasher is saturated?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        slots = passwords._slots
+        passwords._slots = threading.BoundedSemaphore(1)
+        passwords._slots.acquire()
+
+        try:
+            resp = self.client.post('/users/profile',
+                                    data={'username': 'testuser',
+                                          'email': 'test@test.com',
+                                          'password': 'password'})
+        finally:
+            passwords._slots = slots
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('very busy', resp.get_data(as_text=True))
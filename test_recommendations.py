@@ -0,0 +1,251 @@
+"""Who-to-follow tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import QueryCounter
+from recommendations import FollowGraph, recommendations, suggest
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the CSR arrays and scoring, without a database."""
+
+    def setUp(self):
+        # 1 follows 2 and 3; 2 and 3 both follow 4; 3 follows 5; 4 and 5
+        # follow no one; 7 follows 1
+        self.graph = FollowGraph.from_edges([
+            (1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (7, 1),
+        ])
+
+
+    def test_follows(self):
+        """Is each follower's slice right, gaps and the end included?"""
+
+        self.assertEqual(list(self.graph.follows(1)), [2, 3])
+        self.assertEqual(list(self.graph.follows(5)), [])
+        self.assertEqual(list(self.graph.follows(7)), [1])
+        self.assertEqual(list(self.graph.follows(99)), [])
+        self.assertEqual(len(self.graph), 6)
+
+
+    def test_sampled_follows(self):
+        """Is a limited slice spread over all of them?"""
+
+        graph = FollowGraph.from_edges((1, followed_id)
+                                       for followed_id in range(2, 12))
+
+        self.assertEqual(list(graph.follows(1, 5)), [2, 4, 6, 8, 10])
+
+
+    def test_unsorted(self):
+        """Are edges out of follower order refused?"""
+
+        with self.assertRaises(ValueError):
+            FollowGraph.from_edges([(2, 1), (1, 2)])
+
+
+    def test_suggest(self):
+        """Are friends of friends ranked by mutuals, excluding follows?"""
+
+        self.assertEqual(suggest(self.graph.follows, 1, 5, 100),
+                         [(4, 2), (5, 1)])
+        self.assertEqual(suggest(self.graph.follows, 1, 1, 100), [(4, 2)])
+
+        # 7 follows 1, who follows 2 and 3
+        self.assertEqual(suggest(self.graph.follows, 7, 5, 100),
+                         [(2, 1), (3, 1)])
+        self.assertEqual(suggest(self.graph.follows, 4, 5, 100), [])
+
+
+class RecommendationsTestCase(TestCase):
+    """Test suggestions served from the database's follows."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        app.config['RECOMMENDATIONS'] = True
+
+        self.client = app.test_client()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ('me', 'friend1', 'friend2', 'popular', 'niche')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        self.ids = {user.username: user.id for user in users}
+        ids = self.ids
+
+        db.session.add_all([
+            Follows(user_following_id=ids['me'],
+                    user_being_followed_id=ids['friend1']),
+            Follows(user_following_id=ids['me'],
+                    user_being_followed_id=ids['friend2']),
+            Follows(user_following_id=ids['friend1'],
+                    user_being_followed_id=ids['popular']),
+            Follows(user_following_id=ids['friend2'],
+                    user_being_followed_id=ids['popular']),
+            Follows(user_following_id=ids['friend2'],
+                    user_being_followed_id=ids['niche']),
+        ])
+        db.session.commit()
+
+        recommendations.clear()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = ids['me']
+
+
+    def tearDown(self):
+        app.config['RECOMMENDATIONS'] = False
+        recommendations.clear()
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def suggest(self):
+        with app.app_context():
+            return recommendations.suggest(self.ids['me'])
+
+
+    def test_sidebar(self):
+        """Does the homepage suggest friends of friends, best first?"""
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn('Who to follow', html)
+        self.assertLess(html.index('@popular'), html.index('@niche'))
+        self.assertIn('Followed by 2 people you follow', html)
+
+
+    def test_sidebar_off(self):
+        """Is there no sidebar, and no graph, when it's turned off?"""
+
+        app.config['RECOMMENDATIONS'] = False
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertNotIn('Who to follow', html)
+        self.assertIsNone(recommendations._graph)
+
+
+    def test_follow_applied(self):
+        """Do follows through the views change suggestions straight away,
+        without reloading the graph?"""
+
+        self.assertEqual(self.suggest(), [(self.ids['popular'], 2),
+                                          (self.ids['niche'], 1)])
+
+        self.client.post(f"/users/follow/{self.ids['popular']}")
+        self.client.delete('/api/v1/follows',
+                           json={'user_ids': [self.ids['friend2']]})
+
+        with QueryCounter() as counter:
+            self.assertEqual(self.suggest(), [])
+
+        self.assertEqual(len(counter), 0)
+
+
+    def test_rebuild(self):
+        """Does a rebuild pick up other processes' follows?"""
+
+        self.suggest()
+
+        # another process's follow, seen only once the graph is rebuilt
+        db.session.add(Follows(user_following_id=self.ids['friend1'],
+                               user_being_followed_id=self.ids['niche']))
+        db.session.commit()
+
+        self.assertIn((self.ids['niche'], 1), self.suggest())
+
+        with app.app_context():
+            recommendations.rebuild()
+
+        self.assertIn((self.ids['niche'], 2), self.suggest())
+
+
+    def test_first_load(self):
+        """Is the graph loaded once by concurrent first requests, keeping
+        the follows made while it loads?"""
+
+        original = FollowGraph.__dict__['load']
+        loads = []
+
+        def slow_load():
+            loads.append(1)
+            time.sleep(0.1)
+            graph = original.__func__(FollowGraph)
+
+            # committed after the follows were read
+            recommendations.followed(self.ids['me'], [self.ids['popular']])
+            return graph
+
+        FollowGraph.load = slow_load
+
+        try:
+            threads = [threading.Thread(target=self.suggest)
+                       for _ in range(2)]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            FollowGraph.load = original
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(self.suggest(), [(self.ids['niche'], 1)])
+
+
+    def test_stale_graph(self):
+        """Is a graph past RECOMMENDATIONS_MAX_CHANGES rebuilt?"""
+
+        self.suggest()
+        graph = recommendations._graph
+        app.config['RECOMMENDATIONS_MAX_CHANGES'] = 1
+
+        try:
+            recommendations.followed(self.ids['niche'], [self.ids['me']])
+            self.suggest()
+
+            for _ in range(100):
+                if not recommendations._rebuilding:
+                    break
+                time.sleep(0.01)
+        finally:
+            app.config['RECOMMENDATIONS_MAX_CHANGES'] = 10000
+
+        self.assertIsNot(recommendations._graph, graph)
+        self.assertEqual(recommendations._changes, [])
+
+
+    def test_bench(self):
+        """Does the benchmark run?"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['recommendations', 'bench', '--users',
+                                     '50', '--edges', '500', '--queries',
+                                     '20'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('p99', result.output)
@@ -0,0 +1,205 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import QueryCounter
+from fragments import fragments
+from likebuffer import like_buffer
+from replicas import replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# a second database standing in for a replica: it isn't replicating, so its
+# lag is 0 unless a test says otherwise
+REPLICA_URI = "postgresql:///warbler-test-replica"
+
+
+def setUpModule():
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute('DROP DATABASE IF EXISTS "warbler-test-replica"')
+        connection.execute('CREATE DATABASE "warbler-test-replica"')
+
+    engine = create_engine(REPLICA_URI)
+    db.Model.metadata.create_all(engine)
+    engine.dispose()
+
+
+class ReplicasTestCase(TestCase):
+    """Test which database views read from."""
+
+    def setUp(self):
+        for table in (TimelineEntry, Likes, Follows, Message, User):
+            table.query.delete()
+
+        self.client = app.test_client()
+
+        user = User(username="author", email="author@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.flush()
+
+        message = Message(user_id=user.id, text="Primary warble")
+        db.session.add(message)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.message_id = message.id
+
+        # the same rows on the replica, but for the message's text
+        users = [dict(row) for row in db.session.execute(
+            User.__table__.select())]
+        messages = [dict(row, text="Replica warble") for row
+                    in db.session.execute(Message.__table__.select())]
+        db.session.close()
+
+        self.replica = create_engine(REPLICA_URI)
+
+        with self.replica.begin() as connection:
+            for table in (Message, User):
+                connection.execute(table.__table__.delete())
+
+            connection.execute(User.__table__.insert(), users)
+            connection.execute(Message.__table__.insert(), messages)
+
+        self.now = 1000
+        self.clock = replicas.clock
+        replicas.clock = lambda: self.now
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [REPLICA_URI]
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        replicas.clock = self.clock
+        replicas.clear()
+        self.replica.dispose()
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def page(self, url='/users/{}'):
+        """Which database the page's message text came from."""
+
+        # the text is the same on both in real life, and so cached as one
+        fragments.clear()
+        html = self.client.get(url.format(self.user_id)).get_data(
+            as_text=True)
+
+        if 'Replica warble' in html:
+            return 'replica'
+        if 'Primary warble' in html:
+            return 'primary'
+
+
+    def test_routed(self):
+        """Do read-only views read from the replica, and others not?"""
+
+        self.assertEqual(self.page(), 'replica')
+        self.assertEqual(self.page('/'), 'replica')
+        self.assertEqual(self.page(f'/messages/{self.message_id}'),
+                         'replica')
+        self.assertEqual(self.page('/messages/search?q=warble'), 'primary')
+
+
+    def test_off(self):
+        """Does everything read from the primary without replicas?"""
+
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+
+        with app.app_context():
+            engine = replicas.engine(REPLICA_URI)
+
+        with QueryCounter(engine) as counter:
+            self.assertEqual(self.page(), 'primary')
+
+        self.assertEqual(len(counter), 0)
+
+
+    def test_writes_to_primary(self):
+        """Do writes go to the primary, and the writer read from it until
+        the replica has caught up?"""
+
+        resp = self.client.post('/messages/new',
+                                data={'text': "Another warble"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.count(), 2)
+
+        with self.replica.connect() as connection:
+            self.assertEqual(connection.execute(
+                Message.__table__.count()).scalar(), 1)
+
+        self.assertEqual(self.page(), 'primary')
+
+        # past REPLICA_MAX_LAG + REPLICA_LAG_CHECK_INTERVAL
+        self.now += 15
+        self.assertEqual(self.page(), 'replica')
+
+
+    def test_lagging(self):
+        """Is a replica that's too far behind skipped until it's caught
+        up?"""
+
+        self.assertEqual(self.page(), 'replica')
+        replicas._lags[REPLICA_URI] = (60, self.now)
+
+        self.assertEqual(self.page(), 'primary')
+
+        # checked again, and caught up
+        self.now += 10
+        self.assertEqual(self.page(), 'replica')
+
+
+    def test_unreachable(self):
+        """Is a replica that can't be reached skipped?"""
+
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [
+            "postgresql:///warbler-test-missing"]
+
+        self.assertEqual(self.page(), 'primary')
+
+
+    def test_flush_to_primary(self):
+        """Does a likes page flush pending likes against the primary?"""
+
+        app.config['LIKE_WRITE_BEHIND'] = True
+
+        try:
+            other = User(username="reader", email="reader@test.com",
+                         password="HASHED_PASSWORD")
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+
+            with app.app_context():
+                like_buffer.toggle(other_id, self.message_id)
+
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            resp = self.client.get(f'/users/{other_id}/likes')
+        finally:
+            app.config['LIKE_WRITE_BEHIND'] = False
+            like_buffer.stop()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Likes.query.count(), 1)
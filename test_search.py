@@ -0,0 +1,291 @@
+"""Username search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from search import (search_users, search_messages, UserCursor, MessageCursor,
+                    message_indexes)
+from testing import sqlite_app
+
+db.create_all()
+
+USERNAMES = ['bob', 'Bobby', 'abob', 'alice', 'robert', 'bob_the_builder',
+             'bobcat', 'zbob']
+
+MESSAGES = [('alice', "warbler warbler song"),
+            ('bob', "a warbler sings"),
+            ('bob', "song of the day"),
+            ('bob', "warbler song")]
+
+
+class SearchTestCase(TestCase):
+    """Test ranked, keyset-paged username search on PostgreSQL."""
+
+    def setUp(self):
+        """Add sample users."""
+
+        self.ctx = self.make_app().app_context()
+        self.ctx.push()
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        db.session.add_all([User(username=name, email=f"{name}@test.com",
+                                 password="HASHED_PASSWORD")
+                            for name in USERNAMES])
+        db.session.commit()
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        db.session.rollback()
+        db.session.close()
+        self.ctx.pop()
+
+
+    def make_app(self):
+        return app
+
+
+    def search_all(self, search, limit):
+        """Collect every page of results, following the cursors."""
+
+        pages = []
+        after = None
+
+        while True:
+            users, token = search_users(search, after, limit)
+            pages.append([user.username for user in users])
+
+            if token is None:
+                return pages
+
+            after = UserCursor.decode(token)
+
+
+    def test_ranking(self):
+        """Are exact then prefix matches listed before other substrings?"""
+
+        users, _ = search_users('BOB', limit=10)
+
+        self.assertEqual([user.username for user in users],
+                         ['bob', 'Bobby', 'bob_the_builder', 'bobcat',
+                          'abob', 'zbob'])
+
+
+    def test_wildcards_are_literal(self):
+        """Do LIKE wildcards in the search match literally?"""
+
+        users, _ = search_users('o_b', limit=10)
+        self.assertEqual([user.username for user in users], [])
+
+        users, _ = search_users('_the_', limit=10)
+        self.assertEqual([user.username for user in users], ['bob_the_builder'])
+
+
+    def test_search_pages(self):
+        """Do cursors walk a ranked result set without gaps or repeats?"""
+
+        self.assertEqual(self.search_all('bob', 4),
+                         [['bob', 'Bobby', 'bob_the_builder', 'bobcat'],
+                          ['abob', 'zbob']])
+
+
+    def test_browse_pages(self):
+        """With no search, are users paged by username?"""
+
+        pages = self.search_all('', 3)
+
+        self.assertEqual(sum(pages, []), sorted(USERNAMES))
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+
+
+class SQLiteSearchTestCase(SearchTestCase):
+    """Run the same tests on SQLite, searching the FTS5 trigram table."""
+
+    def make_app(self):
+        return sqlite_app()
+
+
+class MessageSearchTestCase(TestCase):
+    """Test ranked, keyset-paged message search on PostgreSQL."""
+
+    def setUp(self):
+        """Add sample users and messages."""
+
+        self.ctx = self.make_app().app_context()
+        self.ctx.push()
+
+        Message.query.delete()
+        User.query.delete()
+
+        users = {name: User(username=name, email=f"{name}@test.com",
+                            password="HASHED_PASSWORD")
+                 for name in ('alice', 'bob')}
+        db.session.add_all(users.values())
+        db.session.flush()
+
+        self.messages = [Message(user_id=users[name].id, text=text)
+                         for name, text in MESSAGES]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+        self.ids = [message.id for message in self.messages]
+        self.bob_id = users['bob'].id
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        db.session.rollback()
+        db.session.close()
+        self.ctx.pop()
+
+
+    def make_app(self):
+        return app
+
+
+    def search_ids(self, search, author_id=None, limit=10):
+        messages, _ = search_messages(search, author_id, limit=limit)
+        return [message.id for message in messages]
+
+
+    def test_ranking(self):
+        """Are messages using the words more often ranked first?"""
+
+        m1, m2, m3, m4 = self.ids
+
+        self.assertEqual(self.search_ids('Warbler'), [m1, m4, m2])
+        self.assertEqual(self.search_ids('warbler song'), [m1, m4])
+        self.assertEqual(self.search_ids('nightingale'), [])
+
+
+    def test_author_filter(self):
+        """Can results be limited to one author?"""
+
+        m1, m2, m3, m4 = self.ids
+
+        self.assertEqual(self.search_ids('warbler', self.bob_id), [m4, m2])
+
+
+    def test_pages(self):
+        """Do cursors walk results, ties included, without gaps or repeats?"""
+
+        m1, m2, m3, m4 = self.ids
+
+        pages = []
+        after = None
+
+        while True:
+            messages, token = search_messages('warbler', after=after, limit=1)
+            pages.append([message.id for message in messages])
+
+            if token is None:
+                break
+
+            after = MessageCursor.decode(token)
+
+        self.assertEqual(pages, [[m1], [m4], [m2]])
+
+
+    def test_index_follows_writes(self):
+        """Are new and deleted messages reflected in results?"""
+
+        m1, m2, m3, m4 = self.ids
+        self.search_ids('warbler')
+
+        message = Message(user_id=self.bob_id, text="warbler at dawn")
+        db.session.add(message)
+        db.session.delete(self.messages[0])
+        db.session.commit()
+
+        self.assertEqual(self.search_ids('warbler'), [message.id, m4, m2])
+
+
+class SQLiteMessageSearchTestCase(MessageSearchTestCase):
+    """Run the same tests on SQLite, searching the in-memory index."""
+
+    def make_app(self):
+        return sqlite_app()
+
+
+    def tearDown(self):
+        message_indexes.pop(db.engine, None)
+        super().tearDown()
+
+
+class SearchViewTestCase(TestCase):
+    """Test the /users listing."""
+
+    def setUp(self):
+        User.query.delete()
+
+        db.session.add_all([User(username=name, email=f"{name}@test.com",
+                                 password="HASHED_PASSWORD")
+                            for name in USERNAMES])
+        db.session.commit()
+
+        app.config['USERS_PER_PAGE'] = 2
+        self.client = app.test_client()
+
+
+    def tearDown(self):
+        app.config.pop('USERS_PER_PAGE')
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_list_users_more_link(self):
+        """Does the listing link to the next page of results?"""
+
+        resp = self.client.get('/users?q=bob')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('@bob<', html)
+        self.assertIn('@Bobby<', html)
+        self.assertNotIn('@bobcat<', html)
+        self.assertIn('/users?q=bob&amp;after=1%3ABobby', html)
+
+        resp = self.client.get('/users?q=bob&after=1%3ABobby')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn('@bob_the_builder<', html)
+        self.assertIn('@bobcat<', html)
+
+
+    def test_messages_search(self):
+        """Does message search list matches, filtered by author?"""
+
+        bob = User.query.filter_by(username='bob').one()
+        alice = User.query.filter_by(username='alice').one()
+
+        db.session.add_all([Message(user_id=bob.id, text="hello warblers"),
+                            Message(user_id=alice.id, text="warblers unite")])
+        db.session.commit()
+
+        html = self.client.get('/messages/search?q=warblers').get_data(as_text=True)
+        self.assertIn('hello warblers', html)
+        self.assertIn('warblers unite', html)
+
+        resp = self.client.get('/messages/search?q=warblers&author=alice')
+        html = resp.get_data(as_text=True)
+        self.assertNotIn('hello warblers', html)
+        self.assertIn('warblers unite', html)
+
+        resp = self.client.get('/messages/search?q=warblers&after=oops')
+        self.assertEqual(resp.status_code, 400)
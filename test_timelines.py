@@ -0,0 +1,214 @@
+"""Fan-out timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from timelines import timelines, STORE_BACKENDS, TimelineStore
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines with the SQL store."""
+
+    backend = 'sql'
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        TimelineEntry.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        app.config['TIMELINE_FANOUT'] = True
+        app.config['TIMELINE_BACKEND'] = self.backend
+
+        self.client = app.test_client()
+
+        self.author = User(email="author@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        self.reader = User(email="reader@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+
+        self.author_id = self.author.id
+        self.reader_id = self.reader.id
+
+        with app.app_context():
+            timelines.store.clear()
+        db.session.commit()
+
+
+    def tearDown(self):
+        """Clean up transactions"""
+
+        app.config['TIMELINE_FANOUT'] = False
+        app.config['TIMELINE_BACKEND'] = 'sql'
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+
+    def home_ids(self, owner_id):
+        with app.app_context():
+            return timelines.store.fetch(owner_id, 100)
+
+
+    def test_follow_merges_author(self):
+        """Does following someone merge their messages into the timeline?"""
+
+        msg = Message(text="Before follow", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f'/users/follow/{self.author_id}')
+
+        self.assertEqual(self.home_ids(self.reader_id), [msg_id])
+
+
+    def test_new_message_fans_out(self):
+        """Does a new message reach the author's and followers' timelines?"""
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f'/users/follow/{self.author_id}')
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post('/messages/new', data={'text': 'Hello followers'})
+
+        msg = Message.query.one()
+
+        self.assertEqual(self.home_ids(self.author_id), [msg.id])
+        self.assertEqual(self.home_ids(self.reader_id), [msg.id])
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            html = c.get('/').get_data(as_text=True)
+
+        self.assertIn('Hello followers', html)
+
+
+    def test_unfollow_removes_author(self):
+        """Does unfollowing remove the author's messages?"""
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f'/users/follow/{self.author_id}')
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post('/messages/new', data={'text': 'Hello followers'})
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f'/users/stop-following/{self.author_id}')
+
+        self.assertEqual(self.home_ids(self.reader_id), [])
+
+
+    def test_delete_message_retracts(self):
+        """Does deleting a message remove it from timelines?"""
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post('/messages/new', data={'text': 'Oops'})
+            msg = Message.query.one()
+            c.post(f'/messages/{msg.id}/delete')
+
+        self.assertEqual(self.home_ids(self.author_id), [])
+
+
+    def test_backfill_and_repair(self):
+        """Do the CLI commands rebuild drifted timelines?"""
+
+        f = Follows(user_being_followed_id=self.author_id,
+                    user_following_id=self.reader_id)
+        msg = Message(text="Written before fan-out", user_id=self.author_id)
+        db.session.add_all([f, msg])
+        db.session.commit()
+        msg_id = msg.id
+
+        runner = app.test_cli_runner()
+
+        result = runner.invoke(args=['timelines', 'repair'])
+        self.assertIn('Checked 2 timelines', result.output)
+
+        result = runner.invoke(args=['timelines', 'backfill'])
+        self.assertIn('Backfilled 2 timelines.', result.output)
+        self.assertEqual(self.home_ids(self.reader_id), [msg_id])
+
+        result = runner.invoke(args=['timelines', 'repair'])
+        self.assertIn('repaired 0', result.output)
+
+
+    def test_length_bound(self):
+        """Does a timeline keep only its newest `length` messages?"""
+
+        store = STORE_BACKENDS[self.backend](2)
+        store.fetch(self.author_id, 10)
+
+        ids = []
+
+        for i in range(5):
+            msg = Message(text=f"Message {i}", user_id=self.author_id)
+            db.session.add(msg)
+            db.session.flush()
+            store.push(msg)
+            ids.append(msg.id)
+
+        db.session.commit()
+
+        self.assertEqual(store.fetch(self.author_id, 10), ids[:-3:-1])
+
+
+    def test_abstract_store(self):
+        """Does a store missing a primitive fail when it's constructed?"""
+
+        class PushOnly(TimelineStore):
+            def push(self, message):
+                pass
+
+        with self.assertRaises(TypeError):
+            PushOnly(10)
+
+
+class MemoryTimelineTestCase(TimelineTestCase):
+    """Run the same tests against the in-memory store."""
+
+    backend = 'memory'
+
+    def test_backfill_and_repair(self):
+        """Does an unloaded timeline load itself from the database?"""
+
+        f = Follows(user_being_followed_id=self.author_id,
+                    user_following_id=self.reader_id)
+        msg = Message(text="Written before fan-out", user_id=self.author_id)
+        db.session.add_all([f, msg])
+        db.session.commit()
+        msg_id = msg.id
+
+        self.assertEqual(self.home_ids(self.reader_id), [msg_id])
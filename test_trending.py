@@ -0,0 +1,261 @@
+"""Trending message tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from budgets import QueryCounter
+from trending import TrendingScores, trending, timestamp
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+HOUR = 60 * 60
+
+
+class TrendingScoresTestCase(TestCase):
+    """Test decayed scores, without a database."""
+
+    def test_decay(self):
+        """Does a like count half as much a half life later?"""
+
+        scores = TrendingScores(HOUR, 10, now=0)
+        scores.add(1, at=0)
+        scores.add(2, at=HOUR, likes=2)
+
+        self.assertEqual(scores.top(5, now=HOUR), [(2, 2.0), (1, 0.5)])
+
+        # rebasing doesn't change the scores
+        scores.decay(HOUR)
+        self.assertEqual(scores.top(5, now=2 * HOUR), [(2, 1.0), (1, 0.25)])
+
+
+    def test_velocity(self):
+        """Do a few new likes beat more old ones?"""
+
+        scores = TrendingScores(HOUR, 10, now=0)
+
+        for _ in range(4):
+            scores.add(1, at=0)
+
+        scores.add(2, at=3 * HOUR, likes=2)
+
+        self.assertEqual([message_id for message_id, _
+                          in scores.top(5, now=3 * HOUR)], [2, 1])
+
+
+    def test_unlike_and_drop(self):
+        """Do unlikes and decay drop scores, and never go below zero?"""
+
+        scores = TrendingScores(HOUR, 10, now=0)
+        scores.add(1, at=0)
+        scores.add(1, at=HOUR, likes=-1)
+        scores.add(2, at=0)
+
+        self.assertEqual([message_id for message_id, _
+                          in scores.top(5, now=HOUR)], [2])
+
+        scores.decay(8 * HOUR)
+        self.assertEqual(len(scores), 0)
+
+
+    def test_bounded(self):
+        """Are the lowest scores evicted past the size limit?"""
+
+        scores = TrendingScores(HOUR, 10, now=0)
+
+        for message_id in range(1, 12):
+            scores.add(message_id, at=0, likes=message_id)
+
+        self.assertLessEqual(len(scores), 10)
+        self.assertEqual(scores.top(1, now=0), [(11, 11.0)])
+        self.assertNotIn(1, dict(scores.top(20, now=0)))
+
+
+class TrendingViewTestCase(TestCase):
+    """Test scores kept from likes, and the trending page."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ('author', 'reader1', 'reader2')]
+        db.session.add_all(users)
+        db.session.flush()
+
+        messages = [Message(user_id=users[0].id, text=f"Warble {i}")
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        self.author_id, self.reader1_id, self.reader2_id = (user.id
+                                                            for user in users)
+        self.message_ids = [message.id for message in messages]
+
+        # yesterday message 0 had both likes; a week ago message 1 had one
+        now = datetime.utcnow()
+        db.session.add_all([
+            Likes(user_id=self.reader1_id, message_id=self.message_ids[0],
+                  created_at=now - timedelta(days=1)),
+            Likes(user_id=self.reader2_id, message_id=self.message_ids[0],
+                  created_at=now - timedelta(days=1)),
+            Likes(user_id=self.reader1_id, message_id=self.message_ids[1],
+                  created_at=now - timedelta(days=7)),
+        ])
+        db.session.commit()
+
+        trending.clear()
+        self.login(self.reader1_id)
+
+
+    def tearDown(self):
+        trending.clear()
+
+        db.session.rollback()
+        db.session.close()
+
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+
+    def top(self):
+        with app.app_context():
+            return [message_id for message_id, _ in trending.top()]
+
+
+    def test_rebuild(self):
+        """Are scores rebuilt from recent likes only?"""
+
+        self.assertEqual(self.top(), self.message_ids[:1])
+
+
+    def test_rebuild_replay(self):
+        """Does a rebuild count the likes recorded while it reads the table
+        once each: from the table if committed before, from memory if
+        after?"""
+
+        before, after = self.message_ids[1:]
+        load = trending.load
+
+        def racing_load():
+            # committed and recorded after the rebuild began, but before
+            # the table is read
+            db.session.add(Likes(user_id=self.reader2_id, message_id=before))
+            db.session.commit()
+            trending.liked([before])
+
+            scores, snapshot = load()
+
+            # committed after the table was read
+            db.session.add(Likes(user_id=self.reader2_id, message_id=after))
+            db.session.commit()
+            trending.liked([after])
+
+            return scores, snapshot
+
+        trending.load = racing_load
+
+        try:
+            with app.app_context():
+                trending.rebuild()
+                top = dict(trending.top())
+        finally:
+            del trending.load
+
+        self.assertAlmostEqual(top[before], 1, places=2)
+        self.assertAlmostEqual(top[after], 1, places=2)
+
+
+    def test_likes_recorded(self):
+        """Do likes, unlikes and deletes update the scores without
+        reading the likes table?"""
+
+        self.top()
+
+        self.client.post(f"/users/likes/{self.message_ids[2]}",
+                         headers={'Referer': '/'})
+
+        with QueryCounter() as counter:
+            self.assertEqual(self.top(), [self.message_ids[2],
+                                          self.message_ids[0]])
+
+        self.assertEqual(len(counter), 0)
+
+        self.client.post(f"/users/likes/{self.message_ids[2]}",
+                         headers={'Referer': '/'})
+        self.assertEqual(self.top(), self.message_ids[:1])
+
+        self.login(self.author_id)
+        self.client.post(f"/messages/{self.message_ids[0]}/delete")
+        self.assertEqual(self.top(), [])
+
+
+    def test_own_like_ignored(self):
+        """Does an author clicking like on their own message leave its
+        score alone?"""
+
+        self.top()
+        self.login(self.author_id)
+
+        for _ in range(3):
+            self.client.post(f"/users/likes/{self.message_ids[0]}",
+                             headers={'Referer': '/'})
+
+        self.assertEqual(self.top(), self.message_ids[:1])
+
+
+    def test_api_likes_recorded(self):
+        """Do batch likes update the scores?"""
+
+        self.top()
+        self.login(self.reader2_id)
+        self.client.post('/api/v1/likes',
+                         json={'message_ids': self.message_ids[1:]})
+
+        self.assertEqual(set(self.top()[:2]), set(self.message_ids[1:]))
+
+
+    def test_page(self):
+        """Does the trending page list the top messages?"""
+
+        html = self.client.get('/trending').get_data(as_text=True)
+
+        self.assertIn('Warble 0', html)
+        self.assertNotIn('Warble 1', html)
+        self.assertIn('fa fa-star', html)
+
+
+    def test_rebuild_command(self):
+        """Does the command show the rebuilt scores?"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['trending', 'rebuild'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.split()[0], str(self.message_ids[0]))
+
+
+    def test_timestamp(self):
+        """Are like times read as UTC?"""
+
+        self.assertEqual(timestamp(datetime(1970, 1, 2)), 24 * HOUR)
@@ -155,6 +155,39 @@ class UserModelTestCase(TestCase):
         self.assertEqual(user1.is_following(user2), True)
 
 
+    def test_follow_state(self):
+        """
+        Does follow_state report both directions for a batch of users in one lookup?
+        Do the cached id sets pick up new follows after a commit?
+        """
+
+        users = [User(email=f"test{i}@test.com",
+                      username=f"testuser{i}",
+                      password="HASHED_PASSWORD") for i in range(4)]
+
+        db.session.add_all(users)
+        db.session.commit()
+
+        me, a, b, c = users
+
+        self.assertEqual(me.following_ids, set())
+
+        db.session.add_all([
+            Follows(user_being_followed_id=a.id, user_following_id=me.id),
+            Follows(user_being_followed_id=me.id, user_following_id=b.id),
+            Follows(user_being_followed_id=c.id, user_following_id=a.id),
+        ])
+        db.session.commit()
+
+        state = me.follow_state([a, b, c])
+
+        self.assertEqual(state.following, {a.id})
+        self.assertEqual(state.followed_by, {b.id})
+        self.assertEqual(me.following_ids, {a.id})
+        self.assertEqual(me.follower_ids, {b.id})
+        self.assertEqual(me.follow_state([]).following, set())
+
+
     def test_signup(self):
         """
         Does signup successfully create a new user given valid credentials?
@@ -105,6 +105,21 @@ class UserViewTestCase(TestCase):
             self.assertIn('<input name="q" class="form-control" placeholder="Search Warbler" id="search">', html)
 
 
+    def test_list_users_follow_state(self):
+        """Does the listing show Unfollow only for followed users?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id_1
+
+            resp = c.get('/users')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'action="/users/stop-following/{self.user_id_2}"', html)
+            self.assertIn(f'action="/users/follow/{self.user_id_1}"', html)
+
+
     def test_users_show(self):
         """Can logged in user view another user's profile?"""
 
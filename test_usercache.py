@@ -0,0 +1,166 @@
+"""Current-user cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_usercache.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from usercache import UserCache, user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class UserCacheTestCase(TestCase):
+    """Test the bounded TTL cache itself."""
+
+    def setUp(self):
+        User.query.delete()
+
+        self.user = User.signup(username="testuser",
+                                email="test@test.com",
+                                password="HASHED_PASSWORD",
+                                image_url=None)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.clock = FakeClock()
+        self.cache = UserCache(clock=self.clock)
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_ttl(self):
+        """Do entries expire after the TTL?"""
+
+        self.cache.put(self.user)
+        self.assertEqual(self.cache.get(self.user_id)['username'], 'testuser')
+
+        self.clock.now = self.cache.ttl
+        self.assertIsNone(self.cache.get(self.user_id))
+
+
+    def test_bounded(self):
+        """Is the least recently used entry evicted past maxsize?"""
+
+        self.cache.maxsize = 2
+
+        for user_id in (1, 2, 3):
+            self.cache.put(User(id=user_id, username=f"u{user_id}"))
+
+        self.assertIsNone(self.cache.get(1))
+        self.assertIsNotNone(self.cache.get(3))
+
+
+    def test_load_from_cache(self):
+        """Does a cache hit rebuild the user without querying?"""
+
+        self.cache.put(self.user)
+        db.session.close()
+
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            user = self.cache.load(self.user_id)
+            username = user.username
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(username, 'testuser')
+        self.assertEqual(statements, [])
+
+        # uncached columns still load on demand
+        self.assertEqual(user.messages_count, 0)
+
+
+class UserCacheViewTestCase(TestCase):
+    """Test that views keep the shared cache fresh."""
+
+    def setUp(self):
+        User.query.delete()
+        user_cache.clear()
+
+        self.client = app.test_client()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="HASHED_PASSWORD",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+
+
+    def test_profile_invalidates(self):
+        """Does editing the profile drop the stale cached username?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get('/')
+            self.assertIsNotNone(user_cache.get(self.user_id))
+
+            c.post('/users/profile', data={'username': 'renamed',
+                                           'email': 'test@test.com',
+                                           'password': 'HASHED_PASSWORD'})
+            self.assertIsNone(user_cache.get(self.user_id))
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+
+
+    def test_deleted_elsewhere(self):
+        """Is a cached user deleted by another process logged out, rather
+        than an error?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get('/')
+            self.assertIsNotNone(user_cache.get(self.user_id))
+
+            # another process's delete, which this one's cache doesn't hear
+            # about
+            db.session.execute(User.__table__.delete())
+            db.session.commit()
+
+            resp = c.get('/')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Sign up now', resp.get_data(as_text=True))
+            self.assertIsNone(user_cache.get(self.user_id))
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
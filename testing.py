@@ -0,0 +1,21 @@
+"""Helpers shared by the test files."""
+
+from flask import Flask
+
+from models import db
+
+
+def sqlite_app(create_tables=True):
+    """An app on an in-memory SQLite database, for running PostgreSQL tests
+    against the fallbacks other databases use."""
+
+    sqlite_app = Flask(__name__)
+    sqlite_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    sqlite_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(sqlite_app)
+
+    if create_tables:
+        with sqlite_app.app_context():
+            db.create_all()
+
+    return sqlite_app
@@ -0,0 +1,430 @@
+"""Fan-out-on-write home timelines for Warbler.
+
+With TIMELINE_FANOUT turned on, a new message is pushed into the stored
+timeline of its author and of every follower when it's written, so the
+homepage reads a ready-sorted slice instead of sorting every message from
+every followed user on each page load.
+"""
+
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from functools import partial
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, literal, or_, tuple_
+
+from models import db, User, Message, Follows, TimelineEntry
+from pagination import keyset, paginate, paginate_messages
+
+
+class TimelineStore(ABC):
+    """Storage for per-user home timelines.
+
+    A timeline is kept as (timestamp, message_id, author_id) entries and
+    holds at most `length` of the owner's newest messages. Subclasses
+    implement the abstract storage primitives; rebuilding from the messages
+    and follows tables is shared.
+    """
+
+    def __init__(self, length):
+        self.length = length
+
+    @abstractmethod
+    def push(self, message):
+        """Add `message` to its author's and followers' timelines."""
+
+    @abstractmethod
+    def fetch(self, owner_id, limit, cursor=None, newer=False):
+        """Return ids of up to `limit` messages past a pagination cursor.
+
+        Older messages come newest first; with `newer`, messages newer than
+        the cursor come oldest first (see pagination.paginate).
+        """
+
+    @abstractmethod
+    def replace(self, owner_id, entries):
+        """Replace the owner's timeline with `entries`."""
+
+    @abstractmethod
+    def merge_author(self, owner_id, author_id):
+        """Merge the author's recent messages into the owner's timeline."""
+
+    @abstractmethod
+    def remove_author(self, owner_id, author_id):
+        """Drop every message by `author_id` from the owner's timeline."""
+
+    @abstractmethod
+    def retract(self, message):
+        """Remove a deleted message from every timeline holding it."""
+
+    @abstractmethod
+    def clear(self):
+        """Forget every stored timeline."""
+
+    def recent_entries(self, owner_id):
+        """Compute the owner's timeline from the messages/follows tables."""
+
+        followed = (db.select([Follows.user_being_followed_id])
+                    .where(Follows.user_following_id == owner_id))
+
+        return (db.session
+                .query(Message.timestamp, Message.id, Message.user_id)
+                .filter(or_(Message.user_id == owner_id,
+                            Message.user_id.in_(followed)))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(self.length)
+                .all())
+
+    def author_entries(self, author_id):
+        """The author's newest messages, as timeline entries."""
+
+        return (db.session
+                .query(Message.timestamp, Message.id, Message.user_id)
+                .filter(Message.user_id == author_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(self.length)
+                .all())
+
+    def audience(self, author_id):
+        """Ids of the users whose timelines show `author_id`'s messages."""
+
+        followers = (db.session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == author_id))
+
+        return [author_id, *(follower_id for (follower_id,) in followers)]
+
+    def rebuild(self, owner_id):
+        """Recompute one owner's timeline from the source tables."""
+
+        self.replace(owner_id, self.recent_entries(owner_id))
+
+    def is_stale(self, owner_id):
+        """Does the stored timeline differ from the source tables?"""
+
+        expected = [message_id for _, message_id, _
+                    in self.recent_entries(owner_id)]
+        return self.fetch(owner_id, self.length) != expected
+
+
+class MemoryTimelineStore(TimelineStore):
+    """Process-local timelines, for development and tests.
+
+    Timelines are loaded from the database the first time they're read and
+    kept sorted oldest to newest, so the newest slice is the list's tail.
+    """
+
+    def __init__(self, length):
+        super().__init__(length)
+        self._timelines = {}
+        self._lock = threading.Lock()
+
+    def _insert(self, owner_id, entries):
+        timeline = self._timelines.get(owner_id)
+
+        # unloaded timelines pick the entries up when they're first read
+        if timeline is None:
+            return
+
+        for entry in entries:
+            bisect.insort(timeline, tuple(entry))
+        del timeline[:-self.length]
+
+    def push(self, message):
+        entry = (message.timestamp, message.id, message.user_id)
+
+        for owner_id in self.audience(message.user_id):
+            with self._lock:
+                self._insert(owner_id, [entry])
+
+    def fetch(self, owner_id, limit, cursor=None, newer=False):
+        if owner_id not in self._timelines:
+            self.rebuild(owner_id)
+
+        with self._lock:
+            timeline = self._timelines[owner_id]
+
+            if newer:
+                start = (0 if cursor is None else bisect.bisect_left(
+                    timeline, (cursor.timestamp, cursor.id + 1)))
+                entries = timeline[start:start + limit]
+            else:
+                end = (len(timeline) if cursor is None else bisect.bisect_left(
+                    timeline, (cursor.timestamp, cursor.id)))
+                entries = timeline[max(end - limit, 0):end][::-1]
+
+        return [message_id for _, message_id, _ in entries]
+
+    def replace(self, owner_id, entries):
+        timeline = sorted(tuple(entry) for entry in entries)
+
+        with self._lock:
+            self._timelines[owner_id] = timeline[-self.length:]
+
+    def merge_author(self, owner_id, author_id):
+        entries = self.author_entries(author_id)
+
+        with self._lock:
+            self._remove(owner_id, lambda entry: entry[2] == author_id)
+            self._insert(owner_id, entries)
+
+    def _remove(self, owner_id, predicate):
+        timeline = self._timelines.get(owner_id)
+
+        if timeline is not None:
+            timeline[:] = [entry for entry in timeline if not predicate(entry)]
+
+    def remove_author(self, owner_id, author_id):
+        with self._lock:
+            self._remove(owner_id, lambda entry: entry[2] == author_id)
+
+    def retract(self, message):
+        for owner_id in self.audience(message.user_id):
+            with self._lock:
+                self._remove(owner_id, lambda entry: entry[1] == message.id)
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+
+
+class SQLTimelineStore(TimelineStore):
+    """Timelines kept in the `timeline_entries` table.
+
+    Writes join the caller's transaction; the caller commits.
+    """
+
+    columns = ['owner_id', 'message_id', 'author_id', 'timestamp']
+
+    def push(self, message):
+        followers = (db.select([Follows.user_following_id])
+                     .where(Follows.user_being_followed_id == message.user_id))
+
+        audience = (db.select([User.id,
+                               literal(message.id),
+                               literal(message.user_id),
+                               literal(message.timestamp, db.DateTime)])
+                    .where(or_(User.id == message.user_id,
+                               User.id.in_(followers))))
+
+        db.session.execute(TimelineEntry.__table__
+                           .insert()
+                           .from_select(self.columns, audience))
+        self.trim(audience.with_only_columns([User.id]))
+
+    def fetch(self, owner_id, limit, cursor=None, newer=False):
+        entries = (db.session
+                   .query(TimelineEntry.message_id)
+                   .filter(TimelineEntry.owner_id == owner_id))
+
+        rows = keyset(entries, cursor, newer, limit,
+                      (TimelineEntry.timestamp, TimelineEntry.message_id))
+
+        return [message_id for (message_id,) in rows]
+
+    def replace(self, owner_id, entries):
+        TimelineEntry.query.filter_by(owner_id=owner_id).delete()
+        db.session.bulk_insert_mappings(TimelineEntry, [
+            dict(owner_id=owner_id, timestamp=timestamp,
+                 message_id=message_id, author_id=author_id)
+            for timestamp, message_id, author_id in entries
+        ])
+
+    def merge_author(self, owner_id, author_id):
+        self.remove_author(owner_id, author_id)
+
+        recent = (db.select([literal(owner_id),
+                             Message.id,
+                             Message.user_id,
+                             Message.timestamp])
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(self.length))
+
+        db.session.execute(TimelineEntry.__table__
+                           .insert()
+                           .from_select(self.columns, recent))
+        self.trim([owner_id])
+
+    def trim(self, owner_ids):
+        """Drop all but the newest `length` entries of these owners.
+
+        `owner_ids` is a list or select() of owner ids.
+        """
+
+        rank = (func.row_number()
+                .over(partition_by=TimelineEntry.owner_id,
+                      order_by=(TimelineEntry.timestamp.desc(),
+                                TimelineEntry.message_id.desc()))
+                .label('rank'))
+
+        ranked = (db.select([TimelineEntry.owner_id,
+                             TimelineEntry.message_id,
+                             rank])
+                  .where(TimelineEntry.owner_id.in_(owner_ids))
+                  .alias('ranked'))
+
+        overflow = (db.select([ranked.c.owner_id, ranked.c.message_id])
+                    .where(ranked.c.rank > self.length))
+
+        db.session.execute(TimelineEntry.__table__
+                           .delete()
+                           .where(tuple_(TimelineEntry.owner_id,
+                                         TimelineEntry.message_id)
+                                  .in_(overflow)))
+
+    def remove_author(self, owner_id, author_id):
+        (TimelineEntry
+         .query
+         .filter_by(owner_id=owner_id, author_id=author_id)
+         .delete())
+
+    def retract(self, message):
+        TimelineEntry.query.filter_by(message_id=message.id).delete()
+
+    def clear(self):
+        TimelineEntry.query.delete()
+
+
+# TIMELINE_BACKEND names one of these; register other stores here.
+STORE_BACKENDS = {
+    'sql': SQLTimelineStore,
+    'memory': MemoryTimelineStore,
+}
+
+
+class Timelines:
+    """Connects the configured timeline store to a Flask app.
+
+    Config:
+        TIMELINE_FANOUT: serve the homepage from stored timelines
+        TIMELINE_BACKEND: a key of STORE_BACKENDS (default 'sql')
+        TIMELINE_LENGTH: most messages kept per timeline (default 800)
+    """
+
+    def __init__(self, app=None):
+        self._stores = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_FANOUT', False)
+        app.config.setdefault('TIMELINE_BACKEND', 'sql')
+        app.config.setdefault('TIMELINE_LENGTH', 800)
+        app.extensions['timelines'] = self
+        app.cli.add_command(timelines_cli)
+
+    @property
+    def enabled(self):
+        return current_app.config['TIMELINE_FANOUT']
+
+    @property
+    def store(self):
+        backend = current_app.config['TIMELINE_BACKEND']
+
+        if backend not in self._stores:
+            store_class = STORE_BACKENDS[backend]
+            self._stores[backend] = store_class(
+                current_app.config['TIMELINE_LENGTH'])
+
+        return self._stores[backend]
+
+    def home(self, owner_id, cursor, newer, limit):
+        """A page of the owner's timeline, read from the store.
+
+        Takes the same arguments as the `fetch` callable of
+        pagination.paginate, with the owner's id first.
+        """
+
+        message_ids = self.store.fetch(owner_id, limit, cursor, newer)
+
+        if not message_ids:
+            return []
+
+        by_id = {msg.id: msg for msg
+                 in Message.timeline().filter(Message.id.in_(message_ids))}
+
+        return [by_id[message_id] for message_id in message_ids
+                if message_id in by_id]
+
+    def home_page(self, user, limit=None):
+        """A page of the user's home timeline, by the request's cursor.
+
+        Read from the store with fan-out on, otherwise from the messages of
+        the user and everyone they follow.
+        """
+
+        if self.enabled:
+            return paginate(partial(self.home, user.id), limit)
+
+        return paginate_messages(Message
+                                 .timeline()
+                                 .filter(Message.user_id.in_(
+                                     [user.id, *user.following_ids])),
+                                 limit)
+
+
+timelines = Timelines()
+
+
+##############################################################################
+# CLI: flask timelines backfill|repair
+
+timelines_cli = AppGroup('timelines', help="Manage fan-out home timelines.")
+
+BATCH_SIZE = 100
+
+
+def owner_ids(user_ids):
+    """The requested user ids, or every user id if none were given."""
+
+    if user_ids:
+        return list(user_ids)
+
+    return [user_id for (user_id,)
+            in db.session.query(User.id).order_by(User.id)]
+
+
+@timelines_cli.command('backfill')
+@click.option('--user-id', type=int, multiple=True,
+              help="Only rebuild these users' timelines.")
+def backfill(user_id):
+    """Rebuild stored timelines from the messages and follows tables."""
+
+    store = timelines.store
+    ids = owner_ids(user_id)
+
+    for count, owner_id in enumerate(ids, start=1):
+        store.rebuild(owner_id)
+
+        if count % BATCH_SIZE == 0:
+            db.session.commit()
+
+    db.session.commit()
+    click.echo(f"Backfilled {len(ids)} timelines.")
+
+
+@timelines_cli.command('repair')
+@click.option('--user-id', type=int, multiple=True,
+              help="Only check these users' timelines.")
+def repair(user_id):
+    """Rebuild only the timelines that have drifted from the source tables."""
+
+    store = timelines.store
+    ids = owner_ids(user_id)
+    repaired = 0
+
+    for owner_id in ids:
+        if store.is_stale(owner_id):
+            store.rebuild(owner_id)
+            repaired += 1
+
+            if repaired % BATCH_SIZE == 0:
+                db.session.commit()
+
+    db.session.commit()
+    click.echo(f"Checked {len(ids)} timelines, repaired {repaired}.")
@@ -0,0 +1,331 @@
+"""Trending messages, ranked by time-decayed like velocity.
+
+Each like adds 1 to its message's score, and every score halves each
+TRENDING_HALF_LIFE seconds, so a score is roughly "recent likes", counting
+newer ones for more. The scores live in memory, updated by the like and
+delete views, so the trending page never scans the likes table.
+
+Rather than touch every score as time passes, a like at time t adds
+2 ** ((t - base) / half life) for a shared `base` time; scores keep their
+order, and each is its current value times 2 ** ((base - now) / half life).
+Every TRENDING_DECAY_INTERVAL seconds the scores are rescaled to a new base,
+which keeps the numbers small, and the ones too small to matter are
+dropped. At most TRENDING_SIZE messages are kept, the lowest scores going
+first.
+
+Each process keeps its own scores, built from the likes of the last
+TRENDING_HORIZON half lives on first use and rebuilt in the background
+every TRENDING_MAX_AGE seconds to take in other processes' likes.
+
+    flask trending rebuild [--count N]
+"""
+
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Message, Likes
+
+EPOCH = datetime(1970, 1, 1)
+
+# scores below this are dropped when decaying: one like seven half lives old
+MIN_SCORE = 2 ** -7
+
+# rows fetched from the database at a time while rebuilding
+LOAD_BATCH_SIZE = 10000
+
+
+class TrendingScores:
+    """Bounded message id -> decayed like score. Not thread-safe."""
+
+    def __init__(self, half_life, size, now):
+        self.half_life = half_life
+        self.size = size
+        self.base = now
+        self._scores = {}
+
+    def __len__(self):
+        return len(self._scores)
+
+    def weight(self, at):
+        """What a like at time `at` adds, relative to `base`."""
+
+        return 2 ** ((at - self.base) / self.half_life)
+
+    def add(self, message_id, at, likes=1):
+        """Count `likes` likes (or unlikes, if negative) made at `at`."""
+
+        score = (self._scores.get(message_id, 0)
+                 + likes * self.weight(at))
+
+        # an unlike can't take back more than the message has left
+        if score <= 0:
+            self._scores.pop(message_id, None)
+            return
+
+        self._scores[message_id] = score
+
+        if len(self._scores) > self.size:
+            self._evict()
+
+    def _evict(self):
+        # trim to 90% at once, so inserts don't each pay for a trim
+        keep = heapq.nlargest(self.size * 9 // 10, self._scores.items(),
+                              key=lambda item: item[1])
+        self._scores = dict(keep)
+
+    def forget(self, message_id):
+        self._scores.pop(message_id, None)
+
+    def decay(self, now):
+        """Rebase the scores at `now`, dropping the negligible ones."""
+
+        factor = 1 / self.weight(now)
+        self._scores = {message_id: score * factor
+                        for message_id, score in self._scores.items()
+                        if score * factor >= MIN_SCORE}
+        self.base = now
+
+    def top(self, count, now):
+        """The `count` highest-scoring messages, as (message_id, score at
+        `now`)."""
+
+        factor = 1 / self.weight(now)
+
+        return [(message_id, score * factor) for message_id, score
+                in heapq.nlargest(count, self._scores.items(),
+                                  key=lambda item: item[1])]
+
+
+def timestamp(moment):
+    """Seconds since the epoch of a naive UTC datetime."""
+
+    return (moment - EPOCH).total_seconds()
+
+
+class Trending:
+    """Keeps each process's trending scores.
+
+    Config:
+        TRENDING_HALF_LIFE: seconds for a like's weight to halve
+            (default 6 hours)
+        TRENDING_HORIZON: half lives of likes read on a rebuild
+            (default 7)
+        TRENDING_SIZE: most messages scored (default 10000)
+        TRENDING_COUNT: messages on the trending page (default 50)
+        TRENDING_DECAY_INTERVAL: seconds between rescales (default 60)
+        TRENDING_MAX_AGE: seconds before scores are rebuilt from the likes
+            table (default 600)
+    """
+
+    def __init__(self, app=None, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.clear()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRENDING_HALF_LIFE', 6 * 60 * 60)
+        app.config.setdefault('TRENDING_HORIZON', 7)
+        app.config.setdefault('TRENDING_SIZE', 10000)
+        app.config.setdefault('TRENDING_COUNT', 50)
+        app.config.setdefault('TRENDING_DECAY_INTERVAL', 60)
+        app.config.setdefault('TRENDING_MAX_AGE', 600)
+        app.extensions['trending'] = self
+        app.cli.add_command(trending_cli)
+
+    def clear(self):
+        """Forget the scores; the next read rebuilds them."""
+
+        with self._lock:
+            self._scores = None
+            self._built = None
+            self._rebuilding = False
+            # (message_id, at, likes) recorded while a rebuild reads likes
+            self._pending = None
+
+    def load(self):
+        """New scores from the likes table, and the time of the snapshot
+        they were read from."""
+
+        config = current_app.config
+        half_life = config['TRENDING_HALF_LIFE']
+        now = self.clock()
+        scores = TrendingScores(half_life, config['TRENDING_SIZE'], now)
+        since = now - half_life * config['TRENDING_HORIZON']
+
+        rows = iter(db.session
+                    .query(Likes.message_id, Likes.created_at)
+                    .filter(Likes.created_at
+                            >= EPOCH + timedelta(seconds=since))
+                    .yield_per(LOAD_BATCH_SIZE))
+
+        # the SELECT has run: likes committed from here on aren't in it
+        snapshot = self.clock()
+
+        for message_id, created_at in rows:
+            scores.add(message_id, timestamp(created_at))
+
+        return scores, snapshot
+
+    def rebuild(self):
+        """Replace the scores with ones rebuilt from the likes table,
+        keeping the likes recorded since it was read."""
+
+        with self._lock:
+            self._pending = []
+
+        try:
+            scores, snapshot = self.load()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            # likes are recorded once committed, so the ones recorded
+            # before the snapshot are in it already
+            for message_id, at, likes in self._pending:
+                if at > snapshot:
+                    scores.add(message_id, at, likes)
+
+            self._scores = scores
+            self._built = self.clock()
+            self._pending = None
+
+    def _decay(self, now):
+        """Rescale the scores if it's time; call with the lock held."""
+
+        if (now - self._scores.base
+                >= current_app.config['TRENDING_DECAY_INTERVAL']):
+            self._scores.decay(now)
+
+    def _record(self, message_ids, likes):
+        now = self.clock()
+
+        with self._lock:
+            # a running rebuild replays these on its new scores; scores
+            # that aren't built at all will read them from the table
+            if self._pending is not None:
+                self._pending.extend((message_id, now, likes)
+                                     for message_id in message_ids)
+
+            if self._scores is not None:
+                self._decay(now)
+
+                for message_id in message_ids:
+                    self._scores.add(message_id, now, likes)
+
+    def liked(self, message_ids):
+        """Record committed likes."""
+
+        self._record(message_ids, 1)
+
+    def unliked(self, message_ids):
+        """Record committed unlikes."""
+
+        self._record(message_ids, -1)
+
+    def forget(self, message_ids):
+        """Drop deleted messages."""
+
+        with self._lock:
+            if self._pending is not None:
+                self._pending = [change for change in self._pending
+                                 if change[0] not in message_ids]
+
+            if self._scores is not None:
+                for message_id in message_ids:
+                    self._scores.forget(message_id)
+
+    def _refresh(self):
+        """Build the scores if there are none; decay them, or start
+        rebuilding them, when it's time."""
+
+        config = current_app.config
+
+        if self._scores is None:
+            self.rebuild()
+            return
+
+        now = self.clock()
+
+        with self._lock:
+            self._decay(now)
+
+            if (now - self._built < config['TRENDING_MAX_AGE']
+                    or self._rebuilding):
+                return
+
+            self._rebuilding = True
+
+        app = current_app._get_current_object()
+        threading.Thread(target=self._rebuild_in_background, args=(app,),
+                         daemon=True).start()
+
+    def _rebuild_in_background(self, app):
+        with app.app_context():
+            try:
+                self.rebuild()
+            finally:
+                db.session.remove()
+
+                with self._lock:
+                    self._rebuilding = False
+
+    def top(self, count=None):
+        """The top trending messages, as (message_id, score)."""
+
+        self._refresh()
+
+        with self._lock:
+            return self._scores.top(
+                count or current_app.config['TRENDING_COUNT'],
+                self.clock())
+
+    def messages(self, count=None):
+        """The top trending messages, as rendered in timelines; one query,
+        none if nothing is trending."""
+
+        message_ids = [message_id for message_id, _ in self.top(count)]
+
+        if not message_ids:
+            return []
+
+        by_id = {msg.id: msg for msg
+                 in Message.timeline().filter(Message.id.in_(message_ids))}
+
+        return [by_id[message_id] for message_id in message_ids
+                if message_id in by_id]
+
+
+trending = Trending()
+
+
+##############################################################################
+# CLI: flask trending rebuild
+
+trending_cli = AppGroup('trending', help="Trending messages.")
+
+
+@trending_cli.command('rebuild')
+@click.option('--count', default=10, show_default=True,
+              type=click.IntRange(min=1))
+def rebuild_command(count):
+    """Rebuild the scores from the likes table and show the top messages.
+
+    Each web process rebuilds its own scores when it starts serving them;
+    this checks what they'll be, e.g. after changing the half life.
+    """
+
+    trending.rebuild()
+
+    for message_id, score in trending.top(count):
+        click.echo(f"{message_id}\t{score:.2f}")
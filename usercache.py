@@ -0,0 +1,114 @@
+"""Identity cache for the logged-in user.
+
+add_user_to_g() runs on every request; with this cache it rebuilds g.user
+from cached core fields instead of a primary-key SELECT. The rebuilt user
+is attached to the session as if it had just been loaded, so anything not
+cached (counters, password) still loads on first access, in one query.
+
+Entries are bounded in number and expire after a TTL, which also bounds
+how stale another process's copy can be after a profile edit. A user
+another process deletes within the TTL fails on their first load; the app
+then logs them out and handles the request as anonymous (see
+curr_user_deleted() in app.py).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+# columns kept in the cache; counters change too often to be worth it
+CORE_FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url',
+               'bio', 'location')
+
+
+class UserCache:
+    """Bounded LRU of user id -> core fields, with TTL eviction.
+
+    Config:
+        CURR_USER_CACHE_SIZE: most users kept (default 1024)
+        CURR_USER_CACHE_TTL: seconds an entry stays fresh (default 60)
+    """
+
+    def __init__(self, app=None, clock=time.monotonic):
+        self.maxsize = 1024
+        self.ttl = 60
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.maxsize = app.config.setdefault('CURR_USER_CACHE_SIZE', 1024)
+        self.ttl = app.config.setdefault('CURR_USER_CACHE_TTL', 60)
+        app.extensions['user_cache'] = self
+
+    def get(self, user_id):
+        """Cached fields for `user_id`, or None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is None:
+                return None
+
+            expires, fields = entry
+
+            if expires <= self.clock():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return fields
+
+    def put(self, user):
+        fields = {name: getattr(user, name) for name in CORE_FIELDS}
+
+        with self._lock:
+            self._entries[user.id] = (self.clock() + self.ttl, fields)
+            self._entries.move_to_end(user.id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self, user_id):
+        """The user with `user_id`, attached to the session, or None."""
+
+        key = inspect(User).identity_key_from_primary_key((user_id,))
+        user = db.session.identity_map.get(key)
+
+        if user is not None:
+            return user
+
+        fields = self.get(user_id)
+
+        if fields is None:
+            user = User.query.get(user_id)
+
+            if user is not None:
+                self.put(user)
+
+            return user
+
+        user = User(**fields)
+        make_transient_to_detached(user)
+        db.session.add(user)
+
+        return user
+
+
+user_cache = UserCache()